@@ -28,33 +28,49 @@
 SerialTransfer myTransfer;
 
 //// EXPERIMENT METADATA ////
-// The maximum number of trials that can be run for a given experiment is 60
+// The array pool holds 60 trials of 32bit values, more if Python sends narrower ones
 const int MAX_NUM_TRIALS = 60;
 // Metadata is received as a struct and then renamed metadata
 // Struct allows for different datatypes of different sizes to be stored in an array
+// Generated from METADATA_SCHEMA in serialtransfer_utils.py, regenerate with
+// python serialtransfer_utils.py --metadata_struct
 struct __attribute__((__packed__)) metadata_struct {
-  uint8_t totalNumberOfTrials;              // total number of trials for experiment
-  uint16_t punishTone;                      // airpuff frequency tone in Hz
-  uint16_t rewardTone;                      // sucrose frequency tone in Hz
-  uint16_t USDeliveryTime_Sucrose;          // amount of time to open sucrose solenoid
-  uint16_t USDeliveryTime_Air;              // amount of time to open air solenoid
-  uint16_t USConsumptionTime_Sucrose;       // amount of time to wait for sucrose consumption
-  uint16_t stimDeliveryTime_Total;          // amount of time LED is scheduled to run
-  uint16_t USDelay;                         // amount of time to wait before delivering US after tone starts
-  bool lickContingency;                  // whether or not to wait for lick after tone starts
+  uint16_t totalNumberOfTrials;       // total number of trials for experiment
+  uint16_t punishTone;                // airpuff frequency tone in Hz
+  uint16_t rewardTone;                // sucrose frequency tone in Hz
+  uint16_t USDeliveryTime_Sucrose;    // amount of time to open sucrose solenoid
+  uint16_t USDeliveryTime_Air;        // amount of time to open air solenoid
+  uint16_t USConsumptionTime_Sucrose; // amount of time to wait for sucrose consumption
+  uint16_t stimDeliveryTime_Total;    // amount of time LED is scheduled to run
+  uint16_t USDelay;                   // amount of time to wait before delivering US after tone starts
+  bool lickContingency;               // whether or not to wait for lick after tone starts
 } metadata;
 
 //// EXPERIMENT ARRAYS ////
-// The order of stimuli to deliver is stored in the trial array
-// This is transmitted from Python to the Arduino
-// Uses int32_t as Python ints are stored as 32bit integers
-int32_t trialArray[MAX_NUM_TRIALS];
-// The ITI for each trial is transmitted from Python to the Arduino
-int32_t ITIArray[MAX_NUM_TRIALS];
-// The amount of time a tone is played is transmitted from Python to the Arudino
-int32_t toneArray[MAX_NUM_TRIALS];
-// The timepoints for stimulating the subject via LED are transmitted from Python to Arduino
-int32_t LEDArray[MAX_NUM_TRIALS];
+// The trial, ITI, tone and LED arrays are transmitted from Python to the
+// Arduino and share one pool of bytes. Python sends each array in the
+// narrowest width that holds its values and describes every array's width
+// and length before sending them, so narrow arrays leave room for more
+// trials than MAX_NUM_TRIALS. 1 and 2 byte values are unsigned, 4 byte values
+// are signed like Python's 32bit integers. Read values with array_value().
+const uint8_t NUM_EXPERIMENT_ARRAYS = 4;
+const uint8_t TRIAL_ARRAY = 0;
+const uint8_t ITI_ARRAY = 1;
+const uint8_t TONE_ARRAY = 2;
+const uint8_t LED_ARRAY = 3;
+const uint16_t ARRAY_POOL_BYTES = NUM_EXPERIMENT_ARRAYS * MAX_NUM_TRIALS * sizeof(int32_t);
+uint8_t arrayPool[ARRAY_POOL_BYTES];
+struct __attribute__((__packed__)) array_encoding_struct {
+  uint8_t width;                            // bytes per value: 1, 2, or 4
+  uint16_t length;                          // number of values in the array
+} arrayEncoding[NUM_EXPERIMENT_ARRAYS];
+// Where each array starts in the pool
+uint16_t arrayStart[NUM_EXPERIMENT_ARRAYS];
+// Tells Python whether the arrays it described fit in the pool
+struct __attribute__((__packed__)) encoding_reply_struct {
+  uint8_t accepted;                         // whether the arrays fit
+  uint16_t poolBytes;                       // size of the pool in bytes
+} encodingReply;
 
 //// PYTHON TRANSMISSION STATUS ////
 // Additional control is required for running the experiment correctly.
@@ -62,7 +78,111 @@ int32_t LEDArray[MAX_NUM_TRIALS];
 // sending all the relevant metadata. This will initiate the Bruker's
 // imaging trigger and start the experiment.
 int32_t pythonGo;
-int transmissionStatus = 0;
+
+//// SERIAL PROTOCOL ////
+// Packet IDs shared with serialtransfer_utils.py. Python dispatches on the
+// same values, so they MUST match the constants found there!
+const uint8_t METADATA_PACKET_ID = 0;
+const uint8_t PYTHON_STATUS_PACKET_ID = 5;
+const uint8_t CHUNK_PACKET_ID = 10;
+const uint8_t CHUNK_ACK_PACKET_ID = 11;
+const uint8_t DIGEST_PACKET_ID = 12;
+const uint8_t BAUD_PACKET_ID = 13;
+const uint8_t LOOPBACK_PACKET_ID = 14;
+const uint8_t IDENTITY_PACKET_ID = 15;
+const uint8_t ARRAY_ENCODING_PACKET_ID = 16;
+const uint8_t TELEMETRY_PACKET_ID = 17;
+const uint8_t TRIAL_REQUEST_PACKET_ID = 18;
+const uint8_t TRIAL_BLOCK_PACKET_ID = 19;
+const uint8_t CLOCK_SYNC_PACKET_ID = 20;
+// Python compiles a hash of this sketch's source and the board's fqbn in as
+// FIRMWARE_HASH. Reporting it lets Python skip uploading a sketch the board
+// is already running. Builds from the Arduino IDE report 0.
+#ifndef FIRMWARE_HASH
+#define FIRMWARE_HASH 0
+#endif
+const uint32_t firmwareHash = FIRMWARE_HASH;
+// The link to Python always starts at BASE_BAUD. Python can ask for a faster
+// rate, but if no valid packet arrives at that rate for BAUD_FALLBACK_MS
+// while receiving, the link drops back to BASE_BAUD. The fallback time MUST
+// match BAUD_FALLBACK in serialtransfer_utils.py!
+const uint32_t BASE_BAUD = 115200;
+const unsigned long BAUD_FALLBACK_MS = 2000;
+uint32_t linkBaud = BASE_BAUD;
+unsigned long lastPacketMS = 0;
+// Windowed transfers send the arrays as chunks that start with this header
+struct __attribute__((__packed__)) chunk_header_struct {
+  uint8_t seq;                              // chunk sequence number shared by all arrays
+  uint8_t arrayIdx;                         // 0 trial, 1 ITI, 2 tone, 3 LED
+  uint16_t offset;                          // array value the chunk's bytes start at
+} chunkHeader;
+// Next chunk sequence number that will be accepted
+uint8_t expectedChunk = 0;
+// Instead of echoing everything back, the Arduino keeps running CRC32s of
+// the bytes it stores for each array and for the whole session. Python asks
+// for these once everything is sent and compares them to its own.
+uint32_t arrayCRC[NUM_EXPERIMENT_ARRAYS] = {0xFFFFFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0xFFFFFFFF};
+uint32_t sessionCRC = 0xFFFFFFFF;
+// Single packet arrays can be resent when their reply is lost. Remember which
+// array came last and the session CRC from before it so a resend replaces it
+// in the session CRC instead of being folded in twice.
+uint8_t lastArrayPacket = 0;
+uint32_t sessionCRCBeforeArray = 0xFFFFFFFF;
+struct __attribute__((__packed__)) digest_struct {
+  uint32_t arrays[NUM_EXPERIMENT_ARRAYS];   // CRC32 of each array's received bytes
+  uint32_t session;                         // CRC32 of metadata and arrays in order
+} digest;
+// Once the session starts, behavioral events are sent to Python as they
+// happen. Event codes MUST match TELEMETRY_EVENTS in serialtransfer_utils.py!
+const uint8_t TRIAL_START_EVENT = 0;        // value is the trial type
+const uint8_t TONE_EVENT = 1;               // value is the tone duration
+const uint8_t US_EVENT = 2;                 // value is the trial type
+const uint8_t LICK_EVENT = 3;               // value is 1 on touch, 0 on release
+const uint8_t LED_EVENT = 4;                // value is the LED stimulation number
+const uint8_t TRIGGER_EVENT = 5;            // value is always 0, marks the T-Series' start
+struct __attribute__((__packed__)) telemetry_struct {
+  uint8_t event;                            // one of the event codes above
+  uint16_t trial;                           // trial the event happened in
+  uint32_t micros;                          // micros() when the event happened
+  int32_t value;                            // event specific value
+} telemetry;
+
+//// STREAMED TRIALS ////
+// Instead of sending every array up front, Python can stream the session's
+// trials while it runs. The Arduino then only holds a window of the next
+// STREAM_WINDOW_TRIALS trials, received in blocks of STREAM_BLOCK_TRIALS,
+// and asks for the next block once it's playing the newest one. Streamed
+// sessions aren't limited by MAX_NUM_TRIALS. Block sizes MUST match
+// STREAM_BLOCK_TRIALS and STREAM_WINDOW_BLOCKS in serialtransfer_utils.py!
+// A block has to fit in the board's 64 byte serial receive buffer.
+const uint8_t STREAM_BLOCK_TRIALS = 4;
+const uint8_t STREAM_WINDOW_TRIALS = 2 * STREAM_BLOCK_TRIALS;
+// Requests Python hasn't answered within this long are sent again
+const unsigned long STREAM_REQUEST_MS = 500;
+struct __attribute__((__packed__)) stream_header_struct {
+  uint16_t firstTrial;                      // trial the block starts at
+  uint8_t count;                            // number of trials in the block
+} streamHeader;
+struct __attribute__((__packed__)) stream_trial_struct {
+  uint8_t trialType;                        // trial type
+  uint32_t ITI;                             // ITI duration in ms
+  uint16_t toneDuration;                    // tone duration in ms
+  uint32_t LED;                             // LED stimulation delay in ms, 0 if none
+} streamWindow[STREAM_WINDOW_TRIALS];
+// Trial t is kept in streamWindow[t % STREAM_WINDOW_TRIALS]
+uint16_t streamedTrials = 0;                // trials received so far
+uint16_t trialRequest;                      // first trial of the requested block
+boolean requestPending = false;
+unsigned long requestMS = 0;
+
+//// CLOCK SYNC ////
+// Python relates micros() to its own clock by sending probes before, during
+// and after the session. Each is answered right away with micros() so
+// telemetry timestamps can be placed on Python's timeline.
+struct __attribute__((__packed__)) clock_sync_struct {
+  uint16_t probe;                           // sequence number of Python's probe
+  uint32_t micros;                          // micros() when the probe was answered
+} clockSync;
 
 //// TRIAL TYPES ////
 // trial variables are encoded as 0, 1, 2, 3, 4, 5, 6
@@ -92,12 +212,8 @@ unsigned long thisLED;
 //// FLAG ASSIGNMENT ////
 // Flags are categorized by purpose:
 // Serial Transfer Flags
-boolean acquireMetaData = true;
-boolean acquireTrials = false;
-boolean acquireITI = false;
-boolean acquireTone = false;
-boolean acquireLED = false;
 boolean rx = true;
+boolean streaming = false;
 boolean pythonGoSignal = false;
 boolean arduinoGoSignal = false;
 // Experiment State Flags
@@ -178,175 +294,486 @@ const int resetPin = 0;                       // Pin driven LOW for resetting th
 const int lickDetectPin = 23;                 // detect sucrose licks
 const int speakerDeliveryPin = 25;            // noise delivery
 
-// Metadata and flow-control functions
+// Transfer verification functions
 /**
-   Receives, parses, and sends back Arduino Metadata to PC. Increments the
-   transmissionStatus by 1.
+   Folds bytes from the receive buffer into a running CRC32. Uses the same
+   reflected polynomial as Python's zlib.crc32 without a lookup table to
+   save RAM. Start the CRC at 0xFFFFFFFF and invert it when finished.
+   @param crc Running CRC32 to update
+   @param start First index of the receive buffer to include
+   @param stop Index of the receive buffer to stop before
+   @return The updated running CRC32
 */
-int metadata_rx() {
-  if (acquireMetaData && transmissionStatus == 0) {
-    if (myTransfer.available())
-    {
-      myTransfer.rxObj(metadata);
-      Serial.println("Received Metadata");
+uint32_t crc32_buffer(uint32_t crc, uint16_t start, uint16_t stop) {
+  for (uint16_t i = start; i < stop; i++) {
+    crc ^= myTransfer.packet.rxBuff[i];
+    for (uint8_t bit = 0; bit < 8; bit++) {
+      if (crc & 1) {
+        crc = (crc >> 1) ^ 0xEDB88320;
+      }
+      else {
+        crc >>= 1;
+      }
+    }
+  }
+  return crc;
+}
 
-      myTransfer.sendDatum(metadata);
-      Serial.println("Sent Metadata");
+/**
+   Sends Python the finished CRC32s for each array and the whole session so
+   it can check them against what it sent.
+*/
+void digest_tx() {
+  for (uint8_t i = 0; i < NUM_EXPERIMENT_ARRAYS; i++) {
+    digest.arrays[i] = ~arrayCRC[i];
+  }
+  digest.session = ~sessionCRC;
+  myTransfer.sendDatum(digest, DIGEST_PACKET_ID);
+  Serial.println("Sent Transfer Digest");
+}
 
-      acquireMetaData = false;
-      transmissionStatus++;
-      acquireTrials = true;
-    }
+/**
+   Sends Python a timestamped behavioral event. Events are only sent once
+   Python has finished sending the session's data so they can't be mistaken
+   for replies during the transfer.
+   @param event One of the event codes, ie TRIAL_START_EVENT
+   @param value Event specific value
+*/
+void telemetry_tx(uint8_t event, int32_t value) {
+  if (rx) {
+    return;
   }
+  telemetry.event = event;
+  telemetry.trial = currentTrial;
+  telemetry.micros = micros();
+  telemetry.value = value;
+  myTransfer.sendDatum(telemetry, TELEMETRY_PACKET_ID);
 }
 
+// Link speed functions
 /**
-   Receives, parses, and sends back array of trial types to be performed
-   for given experiment. Increments transmission status by 1 if totalNumber
-   OfTrials is greater than 60, by 2 if less than 60.
+   Restarts the serial port connected to Python at a new baud rate.
+   @param baud Baud rate to restart the port at
 */
-int trials_rx() {
-  if (acquireTrials && transmissionStatus >= 1 && transmissionStatus < 3) {
-    if (myTransfer.available())
-    {
-      myTransfer.rxObj(trialArray);
-      Serial.println("Received Trial Array");
+void set_link_baud(uint32_t baud) {
+  Serial1.flush();
+  Serial1.end();
+  Serial1.begin(baud);
+  myTransfer.begin(Serial1, true);
+  linkBaud = baud;
+  lastPacketMS = millis();
+}
 
-      myTransfer.sendDatum(trialArray);
-      Serial.println("Sent Trial Array");
-      if (metadata.totalNumberOfTrials > 60) {
-        transmissionStatus++;
-      }
-      else {
-        transmissionStatus++;
-        transmissionStatus++;
-      }
-      acquireITI = true;
-    }
+/**
+   Receives a new baud rate from Python, acknowledges it at the current
+   rate, and then switches the link to the new rate.
+*/
+void baud_rx() {
+  uint32_t newBaud;
+  myTransfer.rxObj(newBaud);
+  myTransfer.sendDatum(newBaud, BAUD_PACKET_ID);
+  set_link_baud(newBaud);
+  Serial.println("Link Baud: " + String(linkBaud));
+}
+
+/**
+   Sends a loopback packet straight back to Python unchanged so Python
+   can measure the link's throughput and error rate.
+*/
+void loopback_rx() {
+  memcpy(myTransfer.packet.txBuff, myTransfer.packet.rxBuff, myTransfer.bytesRead);
+  myTransfer.sendData(myTransfer.bytesRead, LOOPBACK_PACKET_ID);
+}
+
+/**
+   Drops the link back to BASE_BAUD if Python hasn't been heard from at
+   a faster rate, meaning the faster rate isn't working.
+*/
+void baud_fallback() {
+  if (rx && linkBaud != BASE_BAUD && (millis() - lastPacketMS >= BAUD_FALLBACK_MS)) {
+    set_link_baud(BASE_BAUD);
+    Serial.println("Link Baud Fallback: " + String(linkBaud));
   }
 }
 
 /**
-   Receives, parses, and sends back array of Inter Trial Intervals (ITIs)
-   to be performed for given experiment. Increments transmission status by
-   1 if totalNumberOfTrials is greater than 60, by 2 if less than 60.
+   Sends Python the build hash this sketch was compiled with.
 */
-int iti_rx() {
-  if (acquireITI && transmissionStatus >= 3 && transmissionStatus < 5) {
-    acquireTrials = false;
-    if (myTransfer.available())
-    {
-      myTransfer.rxObj(ITIArray);
-      Serial.println("Received ITI Array");
+void identity_rx() {
+  myTransfer.sendDatum(firmwareHash, IDENTITY_PACKET_ID);
+}
 
-      myTransfer.sendDatum(ITIArray);
-      Serial.println("Sent ITI Array");
-      if (metadata.totalNumberOfTrials > 60) {
-        transmissionStatus++;
-      }
-      else {
-        transmissionStatus++;
-        transmissionStatus++;
-      }
-      acquireTone = true;
+// Metadata and flow-control functions
+/**
+   Receives, parses, and sends back Arduino Metadata to PC. Once the
+   metadata has arrived, Python's end of transmission status is accepted.
+   Metadata always starts a transfer over, so Python can send it again if
+   the echo is lost or the transfer fails.
+*/
+void metadata_rx() {
+  restart_transfer();
+  myTransfer.rxObj(metadata);
+  Serial.println("Received Metadata");
+  sessionCRC = crc32_buffer(sessionCRC, 0, myTransfer.bytesRead);
+
+  myTransfer.sendDatum(metadata);
+  Serial.println("Sent Metadata");
+
+  pythonGoSignal = true;
+}
+
+/**
+   Forgets every chunk, streamed trial and digest received so far.
+*/
+void restart_transfer() {
+  expectedChunk = 0;
+  for (uint8_t i = 0; i < NUM_EXPERIMENT_ARRAYS; i++) {
+    arrayCRC[i] = 0xFFFFFFFF;
+  }
+  sessionCRC = 0xFFFFFFFF;
+  lastArrayPacket = 0;
+  sessionCRCBeforeArray = 0xFFFFFFFF;
+  streaming = false;
+  streamedTrials = 0;
+  requestPending = false;
+}
+
+/**
+   Receives the width and length of every experiment array and lays them
+   out in the array pool. Python is told whether they fit before it sends
+   any of them. If they don't, every array's length is set to zero so
+   nothing is stored.
+*/
+void encoding_rx() {
+  myTransfer.rxObj(arrayEncoding);
+  uint32_t poolUsed = 0;
+  encodingReply.accepted = true;
+  for (uint8_t i = 0; i < NUM_EXPERIMENT_ARRAYS; i++) {
+    uint8_t width = arrayEncoding[i].width;
+    if (width != 1 && width != 2 && width != 4) {
+      encodingReply.accepted = false;
     }
+    arrayStart[i] = poolUsed;
+    poolUsed += (uint32_t) width * arrayEncoding[i].length;
   }
+  if (poolUsed > ARRAY_POOL_BYTES) {
+    encodingReply.accepted = false;
+  }
+  if (!encodingReply.accepted) {
+    for (uint8_t i = 0; i < NUM_EXPERIMENT_ARRAYS; i++) {
+      arrayEncoding[i].length = 0;
+    }
+  }
+  encodingReply.poolBytes = ARRAY_POOL_BYTES;
+  myTransfer.sendDatum(encodingReply, ARRAY_ENCODING_PACKET_ID);
+  Serial.println("Received Array Encodings");
 }
 
 /**
-   Receives, parses, and sends back array of Tone Durations to be performed
-   for given experiment. Increments transmission status by 1 if
-   totalNumberOfTrials is greater than 60, by 2 if less than 60.
+   Copies encoded values from the receive buffer into an experiment array's
+   part of the pool and folds them into the array's and session's CRC32s.
+   Bytes past the end of the array are dropped.
+   @param arrayIdx Index of the array as in the chunk header
+   @param idx Array value the bytes start at
+   @param start First index of the receive buffer to copy
+   @param stop Index of the receive buffer to stop before
+   @return Index of the receive buffer copying actually stopped before
 */
-int tone_rx() {
-  if (acquireTone && transmissionStatus >= 5 && transmissionStatus < 7) {
-    acquireITI = false;
-    if (myTransfer.available())
-    {
-      myTransfer.rxObj(toneArray);
-      Serial.println("Received Noise Array");
+uint16_t store_array_bytes(uint8_t arrayIdx, uint16_t idx, uint16_t start, uint16_t stop) {
+  uint8_t width = arrayEncoding[arrayIdx].width;
+  uint32_t first = (uint32_t) idx * width;
+  uint32_t arrayBytes = (uint32_t) arrayEncoding[arrayIdx].length * width;
+  if (first >= arrayBytes) {
+    return start;
+  }
+  if (stop - start > arrayBytes - first) {
+    stop = start + (arrayBytes - first);
+  }
+  memcpy(arrayPool + arrayStart[arrayIdx] + first, myTransfer.packet.rxBuff + start, stop - start);
+  arrayCRC[arrayIdx] = crc32_buffer(arrayCRC[arrayIdx], start, stop);
+  sessionCRC = crc32_buffer(sessionCRC, start, stop);
+  return stop;
+}
 
-      myTransfer.sendDatum(toneArray);
-      Serial.println("Sent Noise Array");
-      if (metadata.totalNumberOfTrials > 60) {
-        transmissionStatus++;
-      }
-      else {
-        transmissionStatus++;
-        transmissionStatus++;
-      }
-      acquireLED = true;
-    }
+/**
+   Reads one value out of an experiment array, decoding it according to
+   the width Python sent it with.
+   @param arrayIdx One of TRIAL_ARRAY, ITI_ARRAY, TONE_ARRAY, or LED_ARRAY
+   @param idx Index of the value in the array
+   @return The value, 0 if idx is past the end of the array
+*/
+int32_t array_value(uint8_t arrayIdx, uint16_t idx) {
+  if (idx >= arrayEncoding[arrayIdx].length) {
+    return 0;
   }
+  uint8_t width = arrayEncoding[arrayIdx].width;
+  uint8_t* value = arrayPool + arrayStart[arrayIdx] + idx * width;
+  int32_t wideValue;
+  switch (width) {
+    case 1:
+      return value[0];
+    case 2:
+      return value[0] | ((uint16_t) value[1] << 8);
+    case 4:
+      memcpy(&wideValue, value, sizeof(wideValue));
+      return wideValue;
+  }
+  return 0;
 }
 
 /**
- * Receives, parses, and sends back array of Stim Durations to be performed
- * for a given experiment. Increments transmission status by 1 if
- * totalNumberOfTrials is greater than 60, by 2 if less than 60.
- */
-int led_rx() {
-  if (acquireLED && transmissionStatus >= 7 && transmissionStatus < 9) {
-    acquireTone = false;
-    if (myTransfer.available())
-    {
-      myTransfer.rxObj(LEDArray);
+   Receives and parses a whole experiment array that was sent in a single
+   packet, then sends back the CRC32 of what was stored instead of the
+   array itself. Each packet holds the whole array, so one that's sent again
+   replaces the array and its CRC32s. The packet's ID determines which array
+   it is:
+    1. Trial types
+    2. ITI durations
+    3. Tone durations
+    4. LED Stimulation times
+   @param packetID ID of the packet currently in the receive buffer
+*/
+void array_rx(uint8_t packetID) {
+  if (packetID < 1 || packetID > NUM_EXPERIMENT_ARRAYS) {
+    return;
+  }
+  if (packetID == lastArrayPacket) {
+    sessionCRC = sessionCRCBeforeArray;
+  }
+  else {
+    sessionCRCBeforeArray = sessionCRC;
+    lastArrayPacket = packetID;
+  }
+  arrayCRC[packetID - 1] = 0xFFFFFFFF;
+  uint16_t len = store_array_bytes(packetID - 1, 0, 0, myTransfer.bytesRead);
+  switch (packetID) {
+    case 1:
+      Serial.println("Received Trial Array");
+      break;
+    case 2:
+      Serial.println("Received ITI Array");
+      break;
+    case 3:
+      Serial.println("Received Noise Array");
+      break;
+    case 4:
       Serial.println("Received LED Stim Array");
+      break;
+  }
+  uint32_t packetCRC = ~crc32_buffer(0xFFFFFFFF, 0, len);
+  myTransfer.sendDatum(packetCRC);
+}
 
-      myTransfer.sendDatum(LEDArray);
-      Serial.println("Sent LED Stim Array");
-      if (metadata.totalNumberOfTrials > 60) {
-        transmissionStatus++;
-      }
-      else {
-        transmissionStatus++;
-        transmissionStatus++;
-      }
-      acquireLED = false;
-      pythonGoSignal = true;
+/**
+   Receives one chunk of a windowed array transfer. Chunks are only accepted
+   in order. Their bytes are copied into the array named in the chunk
+   header starting at the header's offset. Whether or not the chunk was
+   accepted, the next expected sequence number is sent back so Python knows
+   every chunk before it has arrived and where to resend from.
+*/
+void chunk_rx() {
+  uint16_t pos = myTransfer.rxObj(chunkHeader);
+  if (chunkHeader.seq == expectedChunk) {
+    if (chunkHeader.arrayIdx < NUM_EXPERIMENT_ARRAYS) {
+      store_array_bytes(chunkHeader.arrayIdx, chunkHeader.offset, pos, myTransfer.bytesRead);
     }
+    expectedChunk++;
   }
+  myTransfer.sendDatum(expectedChunk, CHUNK_ACK_PACKET_ID);
 }
 
+// Clock sync functions
 /**
-   Unites receiving functions for serial comms of Python generated trial
-   values. Proceeds at the start of the experiment to set Arduino trials
-   up successfully. ALWAYS proceeds in the following order:
-    1. Metadata transmission
-    2. Trial type transmission
-    3. ITI duration transmission
-    4. Tone duration transmission
-    5. LED Stimulation time transmission
+   Answers Python's clock sync probe with the current micros().
 */
-void rx_function() {
+void clock_sync_rx() {
+  clockSync.micros = micros();
+  myTransfer.rxObj(clockSync.probe);
+  myTransfer.sendDatum(clockSync, CLOCK_SYNC_PACKET_ID);
+}
+
+// Trial streaming functions
+/**
+   Receives a block of streamed trials. Blocks are only stored in order and
+   when the window has room for them. Before the session starts, the first
+   window is sent like the rest of the session's data: the block is folded
+   into the session's CRC32 and its header is echoed back, with a count of
+   0 if it wasn't expected. Blocks sent during the session aren't echoed.
+*/
+void trial_block_rx() {
+  uint16_t pos = myTransfer.rxObj(streamHeader);
+  // Trials before the one being played are finished with
+  uint16_t windowStart = (currentTrial < 0) ? 0 : currentTrial;
+  boolean expected = (streamHeader.firstTrial == streamedTrials) &&
+                     (streamHeader.count <= STREAM_BLOCK_TRIALS) &&
+                     (streamedTrials + streamHeader.count <= windowStart + STREAM_WINDOW_TRIALS);
+  if (expected) {
+    for (uint8_t i = 0; i < streamHeader.count; i++) {
+      pos = myTransfer.rxObj(streamWindow[(streamedTrials + i) % STREAM_WINDOW_TRIALS], pos);
+    }
+    streamedTrials += streamHeader.count;
+    requestPending = false;
+  }
   if (rx) {
-    metadata_rx();
-    trials_rx();
-    iti_rx();
-    tone_rx();
-    led_rx();
+    // Repeats of blocks that were already stored are echoed as they were
+    if (expected) {
+      streaming = true;
+      sessionCRC = crc32_buffer(sessionCRC, 0, myTransfer.bytesRead);
+    }
+    else if (streamHeader.firstTrial > streamedTrials) {
+      streamHeader.firstTrial = streamedTrials;
+      streamHeader.count = 0;
+    }
+    myTransfer.sendDatum(streamHeader, TRIAL_BLOCK_PACKET_ID);
+    Serial.println("Received Trial Block");
+  }
+}
+
+/**
+   Asks Python for the next block of trials once the newest block starts
+   playing, and asks again if it hasn't arrived after STREAM_REQUEST_MS.
+*/
+void trial_request_tx() {
+  if (!streaming || rx || currentTrial < 0 || streamedTrials >= metadata.totalNumberOfTrials) {
+    return;
+  }
+  if (currentTrial + STREAM_BLOCK_TRIALS < streamedTrials) {
+    return;
+  }
+  if (!requestPending || (millis() - requestMS >= STREAM_REQUEST_MS)) {
+    trialRequest = streamedTrials;
+    myTransfer.sendDatum(trialRequest, TRIAL_REQUEST_PACKET_ID);
+    requestPending = true;
+    requestMS = millis();
+  }
+}
+
+/**
+   Checks whether a trial's values are on the board yet. Trials sent in
+   full arrays always are.
+   @param trial Index of the trial
+   @return Whether the trial can start
+*/
+boolean trial_ready(int trial) {
+  return !streaming || (trial < streamedTrials);
+}
+
+/**
+   Reads one of a trial's values from the streamed window, or from the
+   experiment arrays if the session isn't streamed.
+   @param arrayIdx One of TRIAL_ARRAY, ITI_ARRAY, TONE_ARRAY, or LED_ARRAY
+   @param trial Index of the trial
+   @return The value
+*/
+int32_t trial_value(uint8_t arrayIdx, uint16_t trial) {
+  if (!streaming) {
+    return array_value(arrayIdx, trial);
   }
+  stream_trial_struct &streamed = streamWindow[trial % STREAM_WINDOW_TRIALS];
+  switch (arrayIdx) {
+    case TRIAL_ARRAY:
+      return streamed.trialType;
+    case ITI_ARRAY:
+      return streamed.ITI;
+    case TONE_ARRAY:
+      return streamed.toneDuration;
+    case LED_ARRAY:
+      return streamed.LED;
+  }
+  return 0;
 }
 
 /**
    Confirms that Python has finished sending data for the session and
    increments the current trial from -1 to 0, meaning the first element
    of the trialArray received from Python. Starts the delay for the
-   Genie Nano so it can start up.
+   Genie Nano so it can start up. Python resends its status if the
+   confirmation is lost, so once the session has started the status is
+   only confirmed again.
 */
-int pythonGo_rx() {
-  if (pythonGoSignal && transmissionStatus == 9) {
-    if (myTransfer.available())
-    {
-      myTransfer.rxObj(pythonGo);
-      Serial.println("Python transmission complete!");
+void pythonGo_rx() {
+  if (pythonGoSignal) {
+    myTransfer.rxObj(pythonGo);
+    Serial.println("Python transmission complete!");
 
-      myTransfer.sendDatum(pythonGo);
-      Serial.println("Sent confirmation to Python");
+    myTransfer.sendDatum(pythonGo);
+    Serial.println("Sent confirmation to Python");
 
-      currentTrial++;
+    pythonGoSignal = false;
+    rx = false;
 
-      cameraDelay = true;
+    currentTrial++;
+
+    cameraDelay = true;
+  }
+  else if (!rx) {
+    myTransfer.rxObj(pythonGo);
+    myTransfer.sendDatum(pythonGo);
+  }
+}
+
+/**
+   Unites receiving functions for serial comms of Python generated trial
+   values. Proceeds at the start of the experiment to set Arduino trials
+   up successfully. Each packet is handed to its receiving function by the
+   ID Python gave it, ALWAYS starting with the metadata and ending with
+   Python's status. Once the session starts, only resent statuses, clock
+   sync probes and streamed trial blocks are received.
+*/
+void rx_function() {
+  if (myTransfer.available()) {
+    lastPacketMS = millis();
+    uint8_t packetID = myTransfer.currentPacketID();
+    if (!rx) {
+      switch (packetID) {
+        case PYTHON_STATUS_PACKET_ID:
+          pythonGo_rx();
+          break;
+        case CLOCK_SYNC_PACKET_ID:
+          clock_sync_rx();
+          break;
+        case TRIAL_BLOCK_PACKET_ID:
+          if (streaming) {
+            trial_block_rx();
+          }
+          break;
+      }
+      return;
+    }
+    switch (packetID) {
+      case BAUD_PACKET_ID:
+        baud_rx();
+        break;
+      case LOOPBACK_PACKET_ID:
+        loopback_rx();
+        break;
+      case IDENTITY_PACKET_ID:
+        identity_rx();
+        break;
+      case METADATA_PACKET_ID:
+        metadata_rx();
+        break;
+      case ARRAY_ENCODING_PACKET_ID:
+        encoding_rx();
+        break;
+      case CHUNK_PACKET_ID:
+        chunk_rx();
+        break;
+      case DIGEST_PACKET_ID:
+        digest_tx();
+        break;
+      case PYTHON_STATUS_PACKET_ID:
+        pythonGo_rx();
+        break;
+      case TRIAL_BLOCK_PACKET_ID:
+        trial_block_rx();
+        break;
+      case CLOCK_SYNC_PACKET_ID:
+        clock_sync_rx();
+        break;
+      default:
+        array_rx(packetID);
+        break;
     }
   }
 }
@@ -383,6 +810,7 @@ void bruker_trigger() {
   if (brukerTrigger) {
     arduinoGoSignal = false;
     digitalWriteFast(bruker2PTriggerPin, HIGH);
+    telemetry_tx(TRIGGER_EVENT, 0);
     Serial.println("Bruker Trigger Sent!");
     digitalWriteFast(bruker2PTriggerPin, LOW);
     brukerTrigger = false;
@@ -395,14 +823,9 @@ void bruker_trigger() {
    Resets the Arduino's flags to starting values.
 */
 void reset_board() {
-  transmissionStatus = 0;
+  restart_transfer();
   currentTrial = -1;
   currentLED = 0;
-  acquireMetaData = true;
-  acquireTrials = false;
-  acquireITI = false;
-  acquireTone = false;
-  acquireLED = false;
   rx = true;
   pythonGoSignal = false;
   arduinoGoSignal = false;
@@ -441,11 +864,13 @@ void lickDetect() {
   // if it is *currently* touched and *wasn't* touched before, alert!
   if ((currtouched & _BV(2)) && !(lasttouched & _BV(2))) {
     digitalWriteFast(lickDetectPin, HIGH);
+    telemetry_tx(LICK_EVENT, 1);
     contcurrent = true;
   }
   // if it *was* touched and now *isn't*, alert!
   if (!(currtouched & _BV(2)) && (lasttouched & _BV(2))) {
     digitalWriteFast(lickDetectPin, LOW);
+    telemetry_tx(LICK_EVENT, 0);
     contcurrent = false;
   }
   lasttouched = currtouched;
@@ -462,10 +887,11 @@ void lickDetect() {
    @param ms Current time in milliseconds (ms)
 */
 void startITI(unsigned long ms) {
-  if (newTrial) {                                 // start new ITI
+  if (newTrial && trial_ready(currentTrial)) {    // start new ITI once its trial has arrived
     Serial.print("Starting New Trial: ");
     Serial.println(currentTrial + 1);             // add 1 to current trial so user sees non zero-indexed value
-    trialType = trialArray[currentTrial];         // gather trial type
+    trialType = trial_value(TRIAL_ARRAY, currentTrial);  // gather trial type
+    telemetry_tx(TRIAL_START_EVENT, trialType);
     newTrial = false;
     if (trialType > 3) {
       LEDStart, LEDEnd = typeLED(trialType, ms);
@@ -475,7 +901,7 @@ void startITI(unsigned long ms) {
     }
     Serial.println("NOW" + String(ms));
     ITI = true;
-    thisITI = ITIArray[currentTrial];             // get ITI for this trial
+    thisITI = trial_value(ITI_ARRAY, currentTrial);  // get ITI for this trial
     Serial.println("ITI: " + String(thisITI) + " ms");
     ITIEnd = ms + thisITI;
     Serial.println("ITI END: " + String(ITIEnd));
@@ -555,7 +981,8 @@ long setLEDStart(unsigned long ms) {
   // Gives negative values for LEDEnd without this...
   LEDStart = 0UL;
   LEDEnd = 0UL;
-  thisLED = LEDArray[currentLED];
+  // Streamed trials carry their own LED delay
+  thisLED = streaming ? trial_value(LED_ARRAY, currentTrial) : array_value(LED_ARRAY, currentLED);
   LEDStart = ms + thisLED;
   LEDEnd = LEDStart + metadata.stimDeliveryTime_Total;
   
@@ -572,6 +999,7 @@ void brukerTriggerLED (unsigned long ms) {
     giveLED = false;
     LEDOn = true;
     digitalWriteFast(brukerLEDTriggerPin, HIGH);
+    telemetry_tx(LED_EVENT, currentLED);
     Serial.println("LED Trigger Sent!");
   }
 }
@@ -598,7 +1026,8 @@ void tonePlayer(unsigned long ms) {
   if (noise) {
     Serial.println("Tone Start" + String(ms));
     noise = false;
-    thisToneDuration = toneArray[currentTrial];
+    thisToneDuration = trial_value(TONE_ARRAY, currentTrial);
+    telemetry_tx(TONE_EVENT, thisToneDuration);
     toneDAQ = true;
     toneListeningMS = ms + thisToneDuration;
     USBegin = ms + metadata.USDelay;
@@ -740,6 +1169,7 @@ void USDelivery(unsigned long ms) {
     newUSDelivery = false;
     giveStim = false;
     solenoidOn = true;
+    telemetry_tx(US_EVENT, trialType);
     switch (trialType) {
       case 0:
         Serial.println("Delivering Airpuff");
@@ -788,6 +1218,7 @@ void USDelivery(unsigned long ms) {
     newUSDeliveryCatch = false;
     giveCatch = false;
     solenoidOn = true;
+    telemetry_tx(US_EVENT, trialType);
     switch (trialType) {
       case 2:
         Serial.println("Delivering Airpuff Catch");
@@ -888,7 +1319,7 @@ void setup() {
   Serial.begin(115200);
 
   // Begin communicating with Bruker PC on specified COM port.
-  Serial1.begin(115200);
+  Serial1.begin(BASE_BAUD);
   myTransfer.begin(Serial1, true);
 
   // -- DEFINE PINS -- //
@@ -918,11 +1349,12 @@ void setup() {
 //// THE BIZ ////
 void loop() {
   rx_function();
-  pythonGo_rx();
+  baud_fallback();
+  trial_request_tx();
   go_signal();
   camera_delay();
   bruker_trigger();
-  if (currentTrial < metadata.totalNumberOfTrials) {
+  if (currentTrial < (int) metadata.totalNumberOfTrials) {
     ms = millis();
     lickDetect();
     startITI(ms);
@@ -937,7 +1369,7 @@ void loop() {
     consuming(ms);
     vacuum(ms);
   }
-  else if (currentTrial == metadata.totalNumberOfTrials) {
+  else if (currentTrial == (int) metadata.totalNumberOfTrials) {
     reset_board();
   }
 }
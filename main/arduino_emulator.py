@@ -0,0 +1,1089 @@
+# Bruker 2-Photon Arduino Emulator
+# Emulates the bruker_disc sketches' side of the serial protocol on a pty so
+# serialtransfer_utils can be run without a board on COM12. Linux only.
+
+###############################################################################
+# Import Packages
+###############################################################################
+
+# Serial Transfer
+# Import pySerialTransfer for packetizing the emulator's side of the link
+from pySerialTransfer import pySerialTransfer as txfer
+
+# Import serialtransfer_utils for the protocol's packet IDs and layouts
+import serialtransfer_utils
+
+# Import trial_utils for generating a session for dry runs
+import trial_utils
+
+# Import Numpy for injecting byte errors
+import numpy as np
+
+# Import pty, tty, and os for creating the pseudo-terminal pair
+import pty
+import tty
+import os
+
+# Import fcntl and array for reading the baud rate Python opened the pty at
+import fcntl
+import array
+
+# Import select for checking if Python has sent anything
+import select
+
+# Import struct for packing replies the same way the sketches do
+import struct
+
+# Import zlib for computing the CRC32 digests the sketches report
+import zlib
+
+# Import threading for running the emulator alongside transfer_data
+import threading
+
+# Import time for emulating link speed and latency
+import time
+
+# Import json for reading configuration templates for dry runs
+import json
+
+# Import argparse for running a dry run from the command line
+import argparse
+
+# Import pathlib for finding configuration templates
+from pathlib import Path
+
+# Import typing for type hints
+from typing import Optional
+
+###############################################################################
+# Globals
+###############################################################################
+
+# Number of experiment arrays the sketches receive
+NUM_EXPERIMENT_ARRAYS = 4
+
+# Both sketches hold this many bytes of experiment arrays
+ARRAY_POOL_BYTES = NUM_EXPERIMENT_ARRAYS * 60 * 4
+
+# Widths the sketches accept for experiment array values
+ARRAY_WIDTHS = [1, 2, 4]
+
+# Layout of one array's width and length in the array encoding packet
+ENCODING_STRUCT = struct.Struct("<BH")
+
+# Layout of a windowed transfer chunk's header
+CHUNK_HEADER_STRUCT = struct.Struct("<BBH")
+
+# Seconds each streamed trial is played for by default
+TRIAL_S = 0.01
+
+# Linux ioctl that reads a tty's termios2, which holds any baud rate exactly,
+# and the index of the input speed in it
+TCGETS2 = 0x802C542A
+TERMIOS2_ISPEED = 9
+
+# Configuration template used for dry runs when none is given
+DRY_RUN_CONFIG = Path(__file__).parent.parent / "docs" / "configurations" / "complete_config.json"
+
+
+###############################################################################
+# Classes
+###############################################################################
+
+
+class EmulatedWire:
+    """
+    The emulator's end of a pty, standing in for the pyserial connection.
+
+    pySerialTransfer only needs in_waiting, read(), write(), open(), close(),
+    and is_open from its connection, so this provides those over the pty's
+    master file descriptor. Every byte is held for as long as it would take
+    to cross a serial link at bytes_per_s, and bytes can be corrupted on
+    their way in or out to emulate a noisy link. Like a real UART, only
+    garbage gets across while Python's end and the board are at different
+    baud rates or above the fastest rate the link can carry.
+
+    Attributes:
+        fd:
+            Master file descriptor of the pty
+        bytes_per_s:
+            Link speed, None to follow the baud rate like a real UART
+        baudrate:
+            Baud rate the emulated board's link is running at
+        error_rate:
+            Probability that any one byte is corrupted
+        max_baud:
+            Fastest baud rate the link can carry, None for no limit
+        is_open:
+            Whether the wire is still open
+    """
+
+    def __init__(self, fd: int, bytes_per_s: Optional[float] = None,
+                 error_rate: float = 0.0, seed: Optional[int] = None,
+                 slave_fd: Optional[int] = None,
+                 max_baud: Optional[int] = None):
+        """
+        Creates the wire on a pty's master file descriptor.
+
+        Args:
+            fd:
+                Master file descriptor of the pty
+            bytes_per_s:
+                Link speed, None to follow the baud rate like a real UART
+            error_rate:
+                Probability that any one byte is corrupted
+            seed:
+                Seed for the byte error generator
+            slave_fd:
+                Slave file descriptor of the pty to read Python's baud rate
+                from, None to never garble mismatched rates
+            max_baud:
+                Fastest baud rate the link can carry, None for no limit
+        """
+
+        self.fd = fd
+
+        self.slave_fd = slave_fd
+
+        self.max_baud = max_baud
+
+        self.bytes_per_s = bytes_per_s
+
+        self.baudrate = serialtransfer_utils.BASE_BAUD
+
+        self.error_rate = error_rate
+
+        self.is_open = True
+
+        self._rng = np.random.default_rng(seed)
+
+        self._buffer = bytearray()
+
+    def open(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+    def host_baud(self) -> Optional[int]:
+        """
+        Reads the baud rate Python's end of the pty is set to.
+
+        Returns:
+            Python's baud rate, None if it can't be read
+        """
+
+        if self.slave_fd is None:
+            return None
+
+        termios2 = array.array('I', [0] * 11)
+
+        try:
+            fcntl.ioctl(self.slave_fd, TCGETS2, termios2)
+
+        except OSError:
+            return None
+
+        return termios2[TERMIOS2_ISPEED]
+
+    def _transit(self, data: bytes) -> bytes:
+        """
+        Holds bytes for their time on the wire and corrupts some of them.
+
+        Args:
+            data:
+                Bytes crossing the wire
+
+        Returns:
+            Bytes as they arrive on the other end
+        """
+
+        # A UART frame is 10 bits: a start bit, 8 data bits, and a stop bit
+        bytes_per_s = self.bytes_per_s or self.baudrate / 10
+
+        time.sleep(len(data) / bytes_per_s)
+
+        host_baud = self.host_baud()
+
+        mismatched = host_baud is not None and host_baud != self.baudrate
+
+        too_fast = self.max_baud is not None and self.baudrate > self.max_baud
+
+        if mismatched or too_fast:
+            return self._rng.integers(0, 256, len(data), dtype=np.uint8).tobytes()
+
+        if self.error_rate > 0:
+
+            data = np.frombuffer(data, dtype=np.uint8).copy()
+
+            corrupted = self._rng.random(len(data)) < self.error_rate
+
+            # Flip one random bit of every corrupted byte
+            data[corrupted] ^= (1 << self._rng.integers(0, 8, corrupted.sum())).astype(np.uint8)
+
+            data = data.tobytes()
+
+        return data
+
+    def _fill(self):
+        """
+        Moves everything Python has sent into the receive buffer.
+        """
+
+        while select.select([self.fd], [], [], 0)[0]:
+
+            try:
+                data = os.read(self.fd, 4096)
+
+            # The pty raises once Python closes its end
+            except OSError:
+                return
+
+            if not data:
+                return
+
+            self._buffer += self._transit(data)
+
+    def reset_input_buffer(self):
+        self._fill()
+        self._buffer.clear()
+
+    @property
+    def in_waiting(self) -> int:
+        self._fill()
+        return len(self._buffer)
+
+    def read(self, size: int = 1) -> bytes:
+        self._fill()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def write(self, data: bytes) -> int:
+        os.write(self.fd, self._transit(bytes(data)))
+        return len(data)
+
+
+class ArduinoEmulator(threading.Thread):
+    """
+    Emulates a bruker_disc board on one end of a pty pair.
+
+    Answers every packet the sketches' rx_function() does: metadata, array
+    encodings, single packet arrays, windowed chunks, trial blocks, digests,
+    Python's status, clock sync probes, baud changes, loopback tests, and
+    build hash requests.
+    Streamed sessions are played one trial every trial_s seconds, asking for
+    blocks the way the sketches do. Like the sketches, the link falls back
+    to BASE_BAUD when Python goes quiet at a faster rate, and end_session()
+    resets the board as they do after their last trial. Python talks to it
+    by passing the emulator's port to transfer_data.
+
+    Attributes:
+        port:
+            Path of the pty Python should open, ie /dev/pts/3
+        latency:
+            Seconds the emulated board takes to start handling each packet
+        firmware_hash:
+            Build hash the emulated board reports
+        pool_bytes:
+            Bytes of experiment arrays the emulated board can hold
+        metadata:
+            Last metadata Python sent, decoded with METADATA_SCHEMA
+        arrays:
+            Experiment arrays as stored by the emulated board
+        running_session:
+            Whether Python has sent its status and the session has started
+        trial_s:
+            Seconds each streamed trial is played for
+        clock_drift_ppm:
+            How much faster the emulated board's micros() runs than the host
+        played_trials:
+            Values of every streamed trial played so far, in order
+    """
+
+    def __init__(self, bytes_per_s: Optional[float] = None,
+                 latency: float = 0.0, error_rate: float = 0.0,
+                 firmware_hash: int = 0,
+                 pool_bytes: int = ARRAY_POOL_BYTES,
+                 seed: Optional[int] = None,
+                 trial_s: float = TRIAL_S,
+                 clock_drift_ppm: float = 0.0,
+                 max_baud: Optional[int] = None):
+        """
+        Creates the pty pair and the emulated board on its master end.
+
+        Args:
+            bytes_per_s:
+                Link speed, None to follow the baud rate like a real UART
+            latency:
+                Seconds the emulated board takes to start handling each packet
+            error_rate:
+                Probability that any one byte on the wire is corrupted
+            firmware_hash:
+                Build hash the emulated board reports
+            pool_bytes:
+                Bytes of experiment arrays the emulated board can hold
+            seed:
+                Seed for the byte error generator
+            trial_s:
+                Seconds each streamed trial is played for
+            clock_drift_ppm:
+                How much faster the emulated board's micros() runs than the
+                host's clock
+            max_baud:
+                Fastest baud rate the emulated link can carry, None for no
+                limit
+        """
+
+        super().__init__(name="arduino_emulator", daemon=True)
+
+        master, slave = pty.openpty()
+
+        # Pass bytes through untouched, like a real serial port
+        tty.setraw(master)
+        tty.setraw(slave)
+
+        # Keep the slave end open so the pty isn't hung up between links
+        self._slave = slave
+
+        self.port = os.ttyname(slave)
+
+        self.wire = EmulatedWire(
+            master,
+            bytes_per_s,
+            error_rate,
+            seed,
+            slave_fd=slave,
+            max_baud=max_baud
+            )
+
+        self.link = txfer.SerialTransfer(self.port, restrict_ports=False, debug=False)
+
+        # Talk over the emulated wire instead of opening the port
+        self.link.connection = self.wire
+
+        # Start with an all zero receive buffer like the sketches do
+        self.link.rxBuff = [0] * txfer.MAX_PACKET_SIZE
+
+        self.latency = latency
+
+        self.firmware_hash = firmware_hash
+
+        self.pool_bytes = pool_bytes
+
+        self.trial_s = trial_s
+
+        self.clock_drift_ppm = clock_drift_ppm
+
+        # Like a real board, micros() starts from an arbitrary point
+        self._clock_start_s = time.perf_counter() - np.random.default_rng(seed).uniform(0, 4000)
+
+        self._stop_emulating = threading.Event()
+
+        # Set by end_session() and cleared once the board has reset
+        self._end_session = threading.Event()
+
+        # When the last valid packet arrived, for falling back to BASE_BAUD
+        self._last_packet_s = time.perf_counter()
+
+        self.reset_board()
+
+    def reset_board(self):
+        """
+        Resets the emulated board to its starting values.
+        """
+
+        self.metadata = None
+
+        self.encodings = [(4, 0)] * NUM_EXPERIMENT_ARRAYS
+
+        self.arrays = [bytearray() for _ in range(NUM_EXPERIMENT_ARRAYS)]
+
+        self.array_crcs = [0] * NUM_EXPERIMENT_ARRAYS
+
+        self.session_crc = 0
+
+        # Lets a resent single packet array replace itself in the session CRC
+        self.last_array_packet = 0
+
+        self.session_crc_before_array = 0
+
+        self.expected_chunk = 0
+
+        self.python_go_signal = False
+
+        self.running_session = False
+
+        self.streaming = False
+
+        # Streamed trials by trial number, only the window is kept
+        self.stream_window = {}
+
+        self.streamed_trials = 0
+
+        self.played_trials = []
+
+        self._next_trial_s = 0.0
+
+        self._request_s = None
+
+    def run(self):
+        """
+        Handles packets from Python until stop() is called.
+        """
+
+        while not self._stop_emulating.is_set():
+
+            if self._end_session.is_set():
+
+                self.reset_board()
+
+                self.set_link_baud(serialtransfer_utils.BASE_BAUD)
+
+                self._end_session.clear()
+
+            # A packet starting with START_BYTE can't be unstuffed and sends
+            # pySerialTransfer past the end of its buffer. The sketches just
+            # get garbage, so drop it and keep going.
+            try:
+                available = self.link.available()
+
+            except IndexError:
+                self.link.state = txfer.find_start_byte
+                continue
+
+            if available:
+
+                self._last_packet_s = time.perf_counter()
+
+                time.sleep(self.latency)
+
+                self.rx_function(self.link.idByte)
+
+            else:
+                time.sleep(0.0005)
+
+            if self.running_session and self.streaming:
+                self.play_streamed_trials()
+
+            self.baud_fallback()
+
+    def baud_fallback(self):
+        """
+        Drops the link back to BASE_BAUD if Python hasn't been heard from at
+        a faster rate, like the sketches' baud_fallback().
+        """
+
+        if self.running_session or self.wire.baudrate == serialtransfer_utils.BASE_BAUD:
+            return
+
+        if time.perf_counter() - self._last_packet_s >= serialtransfer_utils.BAUD_FALLBACK:
+            self.set_link_baud(serialtransfer_utils.BASE_BAUD)
+
+    def set_link_baud(self, baud: int):
+        """
+        Restarts the emulated link at a new baud rate. Like the sketches'
+        set_link_baud(), anything half received is thrown away.
+
+        Args:
+            baud:
+                Baud rate to restart the link at
+        """
+
+        self.wire.baudrate = baud
+
+        self.wire.reset_input_buffer()
+
+        self.link.state = txfer.find_start_byte
+
+        # The fallback timer starts over at the new rate
+        self._last_packet_s = time.perf_counter()
+
+    def stop(self):
+        """
+        Stops the emulated board and closes its end of the pty.
+        """
+
+        self._stop_emulating.set()
+
+        self.join()
+
+        self.wire.close()
+
+        os.close(self.wire.fd)
+
+        os.close(self._slave)
+
+    def end_session(self):
+        """
+        Resets the emulated board like the sketches do after their last trial,
+        which also drops the link back to BASE_BAUD. Returns once the board
+        has reset.
+        """
+
+        self._end_session.set()
+
+        while self._end_session.is_set() and self.is_alive():
+            time.sleep(0.001)
+
+    def payload(self) -> bytes:
+        """
+        Gives the payload of the packet currently in the receive buffer.
+
+        Returns:
+            Payload bytes
+        """
+
+        return bytes(self.link.rxBuff[:self.link.bytesRead])
+
+    def send_payload(self, payload: bytes, packet_id: int = 0):
+        """
+        Sends bytes to Python as one packet.
+
+        Args:
+            payload:
+                Bytes to send
+            packet_id:
+                ID of the packet
+        """
+
+        self.link.txBuff[:len(payload)] = payload
+
+        self.link.send(len(payload), packet_id=packet_id)
+
+    def rx_function(self, packet_id: int):
+        """
+        Hands a packet to its receiving function by the ID Python gave it.
+
+        Args:
+            packet_id:
+                ID of the packet currently in the receive buffer
+        """
+
+        # Only resent statuses, clock sync probes and streamed trials are
+        # received once the session starts
+        if self.running_session:
+
+            if packet_id == serialtransfer_utils.PYTHON_STATUS_PACKET_ID:
+                self.python_go_rx()
+
+            elif self.streaming and packet_id == serialtransfer_utils.TRIAL_BLOCK_PACKET_ID:
+                self.trial_block_rx()
+
+            elif packet_id == serialtransfer_utils.CLOCK_SYNC_PACKET_ID:
+                self.clock_sync_rx()
+
+            return
+
+        handlers = {
+            serialtransfer_utils.BAUD_PACKET_ID: self.baud_rx,
+            serialtransfer_utils.LOOPBACK_PACKET_ID: self.loopback_rx,
+            serialtransfer_utils.IDENTITY_PACKET_ID: self.identity_rx,
+            serialtransfer_utils.METADATA_PACKET_ID: self.metadata_rx,
+            serialtransfer_utils.ARRAY_ENCODING_PACKET_ID: self.encoding_rx,
+            serialtransfer_utils.CHUNK_PACKET_ID: self.chunk_rx,
+            serialtransfer_utils.DIGEST_PACKET_ID: self.digest_tx,
+            serialtransfer_utils.PYTHON_STATUS_PACKET_ID: self.python_go_rx,
+            serialtransfer_utils.TRIAL_BLOCK_PACKET_ID: self.trial_block_rx,
+            serialtransfer_utils.CLOCK_SYNC_PACKET_ID: self.clock_sync_rx,
+        }
+
+        if packet_id in handlers:
+            handlers[packet_id]()
+
+        elif 1 <= packet_id <= NUM_EXPERIMENT_ARRAYS:
+            self.array_rx(packet_id)
+
+    def baud_rx(self):
+        """
+        Acknowledges a new baud rate at the current rate, then switches.
+        """
+
+        self.send_payload(self.payload()[:4], serialtransfer_utils.BAUD_PACKET_ID)
+
+        self.set_link_baud(struct.unpack("<I", self.payload()[:4])[0])
+
+    def loopback_rx(self):
+        """
+        Sends a loopback packet straight back unchanged.
+        """
+
+        self.send_payload(self.payload(), serialtransfer_utils.LOOPBACK_PACKET_ID)
+
+    def identity_rx(self):
+        """
+        Sends the emulated board's build hash.
+        """
+
+        self.send_payload(
+            struct.pack("<I", self.firmware_hash),
+            serialtransfer_utils.IDENTITY_PACKET_ID
+            )
+
+    def metadata_rx(self):
+        """
+        Stores the metadata, starts the session digest, and echoes it back.
+        """
+
+        self.reset_board()
+
+        # The sketches copy exactly one metadata_struct out of the packet
+        metadata_payload = self.payload()[:serialtransfer_utils.METADATA_STRUCT.size]
+
+        metadata_payload = metadata_payload.ljust(serialtransfer_utils.METADATA_STRUCT.size, b"\x00")
+
+        self.metadata = serialtransfer_utils.decode_metadata(metadata_payload)
+
+        self.session_crc = zlib.crc32(metadata_payload)
+
+        self.python_go_signal = True
+
+        self.send_payload(metadata_payload)
+
+    def encoding_rx(self):
+        """
+        Lays out the experiment arrays and tells Python whether they fit.
+        """
+
+        payload = self.payload()
+
+        self.encodings = [
+            ENCODING_STRUCT.unpack_from(payload, idx * ENCODING_STRUCT.size)
+            for idx in range(NUM_EXPERIMENT_ARRAYS)
+            ]
+
+        accepted = all(width in ARRAY_WIDTHS for width, _ in self.encodings)
+
+        accepted = accepted and sum(
+            width * length for width, length in self.encodings
+            ) <= self.pool_bytes
+
+        if not accepted:
+            self.encodings = [(width, 0) for width, _ in self.encodings]
+
+        self.arrays = [
+            bytearray(width * length) for width, length in self.encodings
+            ]
+
+        self.send_payload(
+            struct.pack("<BH", accepted, self.pool_bytes),
+            serialtransfer_utils.ARRAY_ENCODING_PACKET_ID
+            )
+
+    def store_array_bytes(self, array_idx: int, idx: int, data: bytes) -> bytes:
+        """
+        Stores encoded values in an array and folds them into the digests.
+
+        Args:
+            array_idx:
+                Index of the array as in the chunk header
+            idx:
+                Array value the bytes start at
+            data:
+                Encoded values
+
+        Returns:
+            The bytes that were stored, anything past the array is dropped
+        """
+
+        width = self.encodings[array_idx][0]
+
+        first = idx * width
+
+        data = data[:max(len(self.arrays[array_idx]) - first, 0)]
+
+        self.arrays[array_idx][first:first + len(data)] = data
+
+        self.array_crcs[array_idx] = zlib.crc32(data, self.array_crcs[array_idx])
+
+        self.session_crc = zlib.crc32(data, self.session_crc)
+
+        return data
+
+    def array_rx(self, packet_id: int):
+        """
+        Stores an array sent in a single packet and replies with its CRC32.
+
+        A resent array replaces the one before it in the digests, like the
+        sketches do.
+
+        Args:
+            packet_id:
+                ID of the packet, 1 through 4
+        """
+
+        if packet_id == self.last_array_packet:
+            self.session_crc = self.session_crc_before_array
+
+        else:
+            self.session_crc_before_array = self.session_crc
+            self.last_array_packet = packet_id
+
+        self.array_crcs[packet_id - 1] = 0
+
+        stored = self.store_array_bytes(packet_id - 1, 0, self.payload())
+
+        self.send_payload(struct.pack("<I", zlib.crc32(stored)))
+
+    def chunk_rx(self):
+        """
+        Stores in order windowed chunks and acknowledges the next one expected.
+        """
+
+        payload = self.payload()
+
+        seq, array_idx, offset = CHUNK_HEADER_STRUCT.unpack_from(payload)
+
+        if seq == self.expected_chunk:
+
+            if array_idx < NUM_EXPERIMENT_ARRAYS:
+                self.store_array_bytes(
+                    array_idx,
+                    offset,
+                    payload[CHUNK_HEADER_STRUCT.size:]
+                    )
+
+            self.expected_chunk = (self.expected_chunk + 1) & 0xFF
+
+        self.send_payload(
+            struct.pack("<B", self.expected_chunk),
+            serialtransfer_utils.CHUNK_ACK_PACKET_ID
+            )
+
+    def trial_block_rx(self):
+        """
+        Stores in order trial blocks that fit in the window.
+
+        Before the session starts, blocks are folded into the session digest
+        and their header is echoed back, with a count of 0 if it was skipped
+        ahead.
+        """
+
+        payload = self.payload()
+
+        first_trial, count = serialtransfer_utils.STREAM_HEADER_STRUCT.unpack_from(payload)
+
+        # Trials before the one being played are finished with
+        window_start = max(len(self.played_trials) - 1, 0)
+
+        window_trials = (
+            serialtransfer_utils.STREAM_BLOCK_TRIALS
+            * serialtransfer_utils.STREAM_WINDOW_BLOCKS
+            )
+
+        expected = (
+            first_trial == self.streamed_trials
+            and count <= serialtransfer_utils.STREAM_BLOCK_TRIALS
+            and self.streamed_trials + count <= window_start + window_trials
+            )
+
+        if expected:
+
+            for idx in range(count):
+                self.stream_window[first_trial + idx] = serialtransfer_utils.STREAM_TRIAL_STRUCT.unpack_from(
+                    payload,
+                    serialtransfer_utils.STREAM_HEADER_STRUCT.size
+                    + idx * serialtransfer_utils.STREAM_TRIAL_STRUCT.size
+                    )
+
+            self.streamed_trials += count
+
+            self._request_s = None
+
+        if not self.running_session:
+
+            if expected:
+
+                self.streaming = True
+
+                self.session_crc = zlib.crc32(payload, self.session_crc)
+
+            elif first_trial > self.streamed_trials:
+                first_trial, count = self.streamed_trials, 0
+
+            self.send_payload(
+                serialtransfer_utils.STREAM_HEADER_STRUCT.pack(first_trial, count),
+                serialtransfer_utils.TRIAL_BLOCK_PACKET_ID
+                )
+
+    def play_streamed_trials(self):
+        """
+        Plays the next streamed trial when it's due and has arrived, and asks
+        for the next block like the sketches' trial_request_tx().
+        """
+
+        now = time.perf_counter()
+
+        total_trials = self.metadata["totalNumberOfTrials"]
+
+        current_trial = len(self.played_trials)
+
+        if current_trial < min(total_trials, self.streamed_trials) and now >= self._next_trial_s:
+
+            self.played_trials.append(self.stream_window.pop(current_trial))
+
+            self._next_trial_s = now + self.trial_s
+
+        # Trial being played
+        current_trial = len(self.played_trials) - 1
+
+        if current_trial < 0 or self.streamed_trials >= total_trials:
+            return
+
+        if current_trial + serialtransfer_utils.STREAM_BLOCK_TRIALS < self.streamed_trials:
+            return
+
+        if self._request_s is None or now - self._request_s >= serialtransfer_utils.STREAM_REQUEST_S:
+
+            self.send_payload(
+                struct.pack("<H", self.streamed_trials),
+                serialtransfer_utils.TRIAL_REQUEST_PACKET_ID
+                )
+
+            self._request_s = now
+
+    def micros(self) -> int:
+        """
+        Gives the emulated board's micros(), drifting from the host's clock.
+
+        Returns:
+            Microseconds since the emulated board started, wrapped to 32 bits
+        """
+
+        elapsed_s = time.perf_counter() - self._clock_start_s
+
+        return int(elapsed_s * (1 + self.clock_drift_ppm / 1e6) * 1e6) & 0xFFFFFFFF
+
+    def clock_sync_rx(self):
+        """
+        Answers a clock sync probe with the emulated board's micros().
+        """
+
+        self.send_payload(
+            serialtransfer_utils.CLOCK_SYNC_STRUCT.pack(
+                struct.unpack_from("<H", self.payload())[0],
+                self.micros()
+                ),
+            serialtransfer_utils.CLOCK_SYNC_PACKET_ID
+            )
+
+    def digest_tx(self):
+        """
+        Sends the CRC32 of each array and of the whole session.
+        """
+
+        self.send_payload(
+            struct.pack("<5I", *self.array_crcs, self.session_crc),
+            serialtransfer_utils.DIGEST_PACKET_ID
+            )
+
+    def python_go_rx(self):
+        """
+        Echoes Python's status and starts the emulated session. A status
+        resent once the session has started is only echoed again.
+        """
+
+        if self.python_go_signal:
+
+            self.send_payload(self.payload()[:4])
+
+            self.python_go_signal = False
+
+            self.running_session = True
+
+        elif self.running_session:
+            self.send_payload(self.payload()[:4])
+
+    def array_values(self, array_idx: int) -> list:
+        """
+        Decodes one of the stored experiment arrays.
+
+        Args:
+            array_idx:
+                Index of the array, 0 trial, 1 ITI, 2 tone, 3 LED
+
+        Returns:
+            List of the array's values
+        """
+
+        width = self.encodings[array_idx][0]
+
+        dtype = {1: "<u1", 2: "<u2", 4: "<i4"}[width]
+
+        return np.frombuffer(bytes(self.arrays[array_idx]), dtype=dtype).tolist()
+
+
+###############################################################################
+# Functions
+###############################################################################
+
+
+def dry_run(config_path: Path = DRY_RUN_CONFIG, transfer_mode: str = "windowed",
+            **emulator_kwargs) -> bool:
+    """
+    Runs a whole transfer against an emulated board.
+
+    Generates a session from a configuration template the same way
+    run_imaging_experiment does, or reuses the arrays of a finished session's
+    configuration, sends it with transfer_data, and checks that the emulated
+    board stored exactly what was sent. Streamed sessions are played to the
+    end and every trial played is checked instead.
+
+    Args:
+        config_path:
+            Path to a configuration template or finished session configuration
+        transfer_mode:
+            Either "windowed" (default), "onepacket" or "streaming"
+        emulator_kwargs:
+            Settings for the ArduinoEmulator, like bytes_per_s or error_rate
+
+    Returns:
+        Whether the emulated board ended up with the session's data
+    """
+
+    with open(config_path, 'r') as inFile:
+        config_template = json.load(inFile)
+
+    # Fields missing from older templates are sent as 0
+    arduino_metadata = {
+        name: config_template["beh_metadata"].get(name) or 0
+        for name, _, _ in serialtransfer_utils.METADATA_SCHEMA
+        }
+
+    # Finished session configs already hold their arrays, so resend those
+    array_names = ["trialArray", "ITIArray", "toneArray", "LEDArray"]
+
+    if all(name in config_template["beh_metadata"] for name in array_names):
+        experiment_arrays = [
+            config_template["beh_metadata"][name] for name in array_names
+            ]
+
+    else:
+        experiment_arrays = trial_utils.generate_arrays(config_template)
+
+    emulator = ArduinoEmulator(**emulator_kwargs)
+
+    emulator.start()
+
+    start = time.perf_counter()
+
+    telemetry_reader = serialtransfer_utils.transfer_data(
+        arduino_metadata,
+        experiment_arrays,
+        transfer_mode=transfer_mode,
+        port=emulator.port
+        )
+
+    if transfer_mode == "streaming":
+
+        # Each trial takes trial_s, give the link plenty of time on top
+        deadline = time.perf_counter() + 2 * len(experiment_arrays[0]) * emulator.trial_s + 10
+
+        while len(emulator.played_trials) < len(experiment_arrays[0]) and time.perf_counter() < deadline:
+            time.sleep(0.01)
+
+        if telemetry_reader is not None:
+            telemetry_reader.stop()
+
+    elapsed = time.perf_counter() - start
+
+    emulator.stop()
+
+    if transfer_mode == "streaming":
+        received = emulator.running_session and emulator.played_trials == list(
+            serialtransfer_utils.stream_trials(experiment_arrays)
+            )
+
+    else:
+        received = emulator.running_session and all(
+            emulator.array_values(array_idx) == list(array)
+            for array_idx, array in enumerate(experiment_arrays)
+            )
+
+    print(f"Dry run {'passed' if received else 'FAILED'} in {elapsed:.2f} s")
+
+    return received
+
+
+###############################################################################
+# Main Function
+###############################################################################
+
+
+if __name__ == "__main__":
+
+    # Create argument parser for the emulator
+    emulator_parser = argparse.ArgumentParser(
+        description='Run a transfer against an emulated Arduino',
+        prog='Bruker Arduino Emulator'
+    )
+
+    # Add config argument
+    emulator_parser.add_argument(
+        '--config',
+        type=Path,
+        action='store',
+        dest='config_path',
+        help='Configuration template to generate the session from',
+        default=DRY_RUN_CONFIG,
+        required=False
+    )
+
+    # Add link speed argument
+    emulator_parser.add_argument(
+        '--bytes_per_s',
+        type=float,
+        action='store',
+        dest='bytes_per_s',
+        help='Link speed in bytes/s (default follows the baud rate)',
+        default=None,
+        required=False
+    )
+
+    # Add latency argument
+    emulator_parser.add_argument(
+        '--latency',
+        type=float,
+        action='store',
+        dest='latency',
+        help='Seconds the board takes to start handling each packet',
+        default=0.0,
+        required=False
+    )
+
+    # Add error rate argument
+    emulator_parser.add_argument(
+        '--error_rate',
+        type=float,
+        action='store',
+        dest='error_rate',
+        help='Probability that any one byte is corrupted',
+        default=0.0,
+        required=False
+    )
+
+    # Add transfer mode argument
+    emulator_parser.add_argument(
+        '--transfer_mode',
+        type=str,
+        action='store',
+        dest='transfer_mode',
+        help='Either windowed, onepacket or streaming',
+        default="windowed",
+        required=False
+    )
+
+    # Add trial length argument
+    emulator_parser.add_argument(
+        '--trial_s',
+        type=float,
+        action='store',
+        dest='trial_s',
+        help='Seconds each streamed trial is played for',
+        default=TRIAL_S,
+        required=False
+    )
+
+    emulator_args = vars(emulator_parser.parse_args())
+
+    dry_run(**emulator_args)
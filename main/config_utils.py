@@ -199,7 +199,9 @@ def read_config(config_path: Path) -> dict:
 
 def write_experiment_config(config_template: dict, experiment_arrays: list,
                             dropped_frames: list, project: str, subject_id: str,
-                            imaging_plane: str, current_plane: int):
+                            imaging_plane: str, current_plane: int,
+                            serial_packets: dict = None,
+                            clock_sync: dict = None):
     """
     Writes experiental configuration file to Raw Data drive.
 
@@ -224,6 +226,12 @@ def write_experiment_config(config_template: dict, experiment_arrays: list,
             Plane 2P images were acquired at, the Z-axis value
         current_plane:
             Current plane being imaged as in 1st, 2nd, 3rd, etc
+        serial_packets:
+            Per packet timings and errors from the transfer to the Arduino,
+            from serialtransfer_utils.PacketLog.to_dict()
+        clock_sync:
+            Model relating the Arduino's micros() to the host's clock, from
+            serialtransfer_utils.ClockSync.fit()
     """
 
     # Gather session date using datetime
@@ -265,6 +273,17 @@ def write_experiment_config(config_template: dict, experiment_arrays: list,
     # Assign dropped_frames key the dropped_frames data.
     config_template["beh_metadata"]["dropped_frames"] = dropped_frames
 
+    # Assign serial_packets key the transfer's packet log so slow or flaky
+    # links can be tracked down later
+    if serial_packets is not None:
+        config_template["beh_metadata"]["serial_packets"] = serial_packets
+
+    # Assign clock_sync key the clock model so the Arduino's event timestamps
+    # can be placed on the host's timeline with
+    # serialtransfer_utils.arduino_to_host()
+    if clock_sync is not None:
+        config_template["beh_metadata"]["clock_sync"] = clock_sync
+
     # Write the completed configuration file
     with open(config_fullpath, 'w') as outFile:
 
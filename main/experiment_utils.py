@@ -19,15 +19,117 @@ import prairieview_utils
 # Import the Flight Manifest GUI
 import flight_manifest
 
+# Import sync_utils for aligning each session's recordings
+import sync_utils
+
 # Import sys to safely exit
 import sys
 
-# Import multiprocessing for async writing of video to disk
-import multiprocessing
+# Import pathlib for telemetry log paths
+from pathlib import Path
 
 # TODO: Move to next plane, create mouse configuration that defines planes of
 # interest and distance between them
 
+# Number of times a plane's trials are sent to the Arduino before the rest of
+# the subject's planes are skipped
+UPLOAD_ATTEMPTS = 3
+
+# How trials are sent to the Arduino unless the configuration asks for
+# something else with its transfer_mode field. Sessions too long to fit on
+# the board are streamed instead.
+TRANSFER_MODE = "windowed"
+
+# Video is written raw during each session and transcoded to .mp4 in the
+# background, so encoding never costs the camera frames. Sessions fall back
+# to encoding as they're captured when the Raw Data drive is short on space.
+VIDEO_MODE = "raw"
+
+
+def session_transfer_mode(config_template: dict, experiment_arrays: list) -> str:
+    """
+    Picks how a plane's trials are sent to the Arduino.
+
+    Trials are sent windowed before the session unless the configuration's
+    transfer_mode field says otherwise. Streaming is only used when asked for
+    or when the arrays don't fit on the board.
+
+    Args:
+        config_template:
+            Configuration template value dictionary gathered from team's
+            configuration .json file
+        experiment_arrays:
+            List of arrays generated for the plane's session
+
+    Returns:
+        Either "windowed", "onepacket" or "streaming"
+    """
+
+    if "transfer_mode" in config_template:
+        return config_template["transfer_mode"]
+
+    session_bytes = serialtransfer_utils.experiment_array_bytes(experiment_arrays)
+
+    if session_bytes > serialtransfer_utils.ARRAY_POOL_BYTES:
+
+        print(
+            f"Trials take {session_bytes} bytes, more than the Arduino's "
+            f"{serialtransfer_utils.ARRAY_POOL_BYTES}, streaming them instead"
+            )
+
+        return "streaming"
+
+    return TRANSFER_MODE
+
+
+def start_arduino_session(session_upload: serialtransfer_utils.SessionUpload,
+                          telemetry_path: Path) -> tuple:
+    """
+    Starts the Arduino's session, sending the plane's trials again if needed.
+
+    The T-Series keeps waiting for its trigger while the trials are resent,
+    so a failed upload doesn't need the plane to be set up again. If every
+    attempt fails, the last TransferError is raised.
+
+    Args:
+        session_upload:
+            SessionUpload started for the plane
+        telemetry_path:
+            Path of the session's binary event log
+
+    Returns:
+        session_upload, telemetry_reader
+            The upload that succeeded and its running TelemetryReader
+    """
+
+    for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+
+        try:
+            telemetry_reader = session_upload.start_session(
+                telemetry_path=telemetry_path
+                )
+
+            return session_upload, telemetry_reader
+
+        except serialtransfer_utils.TransferError as error:
+
+            print(error)
+
+            if attempt == UPLOAD_ATTEMPTS:
+                raise
+
+            print(f"Sending trials again, attempt {attempt + 1} of {UPLOAD_ATTEMPTS}...")
+
+            # The scope is already waiting, so upload in this thread
+            session_upload = serialtransfer_utils.SessionUpload(
+                session_upload.arduino_metadata,
+                session_upload.experiment_arrays,
+                session_upload.transfer_mode,
+                session=session_upload.session
+                )
+
+            session_upload.run()
+
 
 def run_imaging_experiment(metadata_args):
 
@@ -39,7 +141,13 @@ def run_imaging_experiment(metadata_args):
 
     # Get value of subject's experimental/control type
     group_type = metadata_args["group"]
-    
+
+    # Use new Arduino class to verify and upload available Arduino sketches
+    # automatically. This runs in the background while the manifest is
+    # filled out, the template loads and Prairie View connects.
+    sketch_upload = serialtransfer_utils.SketchUpload(project)
+    sketch_upload.start()
+
     # Get which mice are being imaged that day
     passengers = flight_manifest.run(project)
 
@@ -50,10 +158,6 @@ def run_imaging_experiment(metadata_args):
     # Get configuration template with config_utils.get_template
     config_template = config_utils.get_template(project)
 
-    # Use new Arduino class to verify and upload available Arduino sketches
-    # automatically
-    serialtransfer_utils.upload_arduino_sketch(project)
-
     # TODO: After updating how weights are represented, this should
     # basically tell the user to input a weight (in kg? maybe just g
     # and conver to NWB for them later...) and then append that to
@@ -68,6 +172,10 @@ def run_imaging_experiment(metadata_args):
     # Connect to Prairie View
     prairieview_utils.pv_connect()
 
+    # One link to the Arduino is kept open for every plane of every subject.
+    # It's opened at the first transfer, after the sketch is uploaded.
+    serial_session = serialtransfer_utils.SerialSession()
+
     # Run experiments for each subject contained on the flight manifest.
     for subject_id in passengers:
 
@@ -143,6 +251,21 @@ def run_imaging_experiment(metadata_args):
             # Calculate session length in seconds
             session_len_s = trial_utils.calculate_session_length(experiment_arrays)
 
+            transfer_mode = session_transfer_mode(config_template, experiment_arrays)
+
+            # Send the trials to the Arduino while the preview runs and the
+            # T-Series is set up. The board has to be running the project's
+            # sketch first, so only the first upload waits on it.
+            session_upload = serialtransfer_utils.SessionUpload(
+                arduino_metadata,
+                experiment_arrays,
+                transfer_mode=transfer_mode,
+                session=serial_session,
+                sketch_upload=sketch_upload
+                )
+
+            session_upload.start()
+
             # Start preview of animal's face.  Zero microscope over lens here.
             video_utils.capture_preview(
                 project,
@@ -179,12 +302,31 @@ def run_imaging_experiment(metadata_args):
                 framerate
                 )
 
-            # Now that the Bruker scope is ready and waiting, send the data to
-            # the Arduino through pySerialTransfer
-            serialtransfer_utils.transfer_data(
-                arduino_metadata,
-                experiment_arrays
-                )
+            # Now that the Bruker scope is ready and waiting, tell the Arduino
+            # to start once its trials are uploaded. The link stays open to
+            # record the Arduino's behavior events during the session.
+            try:
+                session_upload, telemetry_reader = start_arduino_session(
+                    session_upload,
+                    serialtransfer_utils.telemetry_log_path(
+                        project,
+                        subject_id,
+                        current_plane,
+                        str(imaging_plane)
+                        )
+                    )
+
+            # If the trials still can't be sent, move on to the next subject
+            # instead of ending the day
+            except serialtransfer_utils.TransferError:
+
+                print("Skipping remaining planes for", subject_id)
+
+                prairieview_utils.end_tseries()
+
+                exp_running = False
+
+                continue
 
             dropped_frames = video_utils.capture_recording(
                 framerate,
@@ -192,9 +334,14 @@ def run_imaging_experiment(metadata_args):
                 current_plane,
                 str(imaging_plane),
                 project,
-                subject_id
+                subject_id,
+                recording_mode=VIDEO_MODE
             )
 
+            # The session is over, stop recording behavior events
+            if telemetry_reader is not None:
+                telemetry_reader.stop()
+
             prairieview_utils.end_tseries()
 
             config_utils.write_experiment_config(
@@ -204,9 +351,25 @@ def run_imaging_experiment(metadata_args):
                 project,
                 subject_id,
                 str(imaging_plane),
-                current_plane
+                current_plane,
+                serial_packets=session_upload.packet_log.to_dict(),
+                clock_sync=session_upload.clock_sync.fit()
             )
 
+            # Line up the behavior events, video and 2P frames once everything
+            # is on disk. A missing stream shouldn't end the day, the index
+            # can be built again later with sync_utils.sync_session().
+            try:
+                sync_utils.sync_session(
+                    project,
+                    subject_id,
+                    current_plane,
+                    str(imaging_plane)
+                    )
+
+            except sync_utils.SyncError as error:
+                print(error)
+
             if current_plane == requested_planes:
 
                 print("Experiment Completed for", subject_id)
@@ -216,8 +379,14 @@ def run_imaging_experiment(metadata_args):
             else:
                 current_plane += 1
 
+    # Close the link to the Arduino
+    serial_session.close()
+
     # Disconnect from Prairie View and end the experiments for the day
     prairieview_utils.pv_disconnect()
 
+    # Finish writing the day's videos before exiting
+    video_utils.wait_for_transcodes()
+
     print("Exiting...")
     sys.exit()
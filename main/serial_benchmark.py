@@ -0,0 +1,500 @@
+# Bruker 2-Photon Serial Transfer Benchmark
+# Times each way of sending a session to the Arduino against an emulated
+# board, sweeping session length, baud rate, and injected byte errors. Linux
+# only, since the emulated board runs on a pty.
+
+###############################################################################
+# Import Packages
+###############################################################################
+
+# Import serialtransfer_utils for the transfer paths being benchmarked
+import serialtransfer_utils
+
+# Import arduino_emulator for a board to benchmark against
+import arduino_emulator
+
+# Import Numpy for building sessions and summarizing repeats
+import numpy as np
+
+# Import multiprocessing for running the emulated board outside of the
+# benchmarked process so its CPU time isn't counted
+import multiprocessing
+
+# Import time for timing transfers
+import time
+
+# Import json for reading the dry run configuration and writing results
+import json
+
+# Import argparse for running the benchmark from the command line
+import argparse
+
+# Import pathlib for results paths
+from pathlib import Path
+
+# Import typing for type hints
+from typing import List, Optional
+
+###############################################################################
+# Globals
+###############################################################################
+
+# Paths through the serial layer that can be benchmarked. metadata only sends
+# the metadata, the rest send a whole session and check its digest:
+#   onepacket: one packet per array, sessions of up to ONEPACKET_MAX_TRIALS only
+#   chunked: windowed chunks, waiting on each chunk's acknowledgement
+#   pipelined: windowed chunks, WINDOW_SIZE in flight at once
+TRANSFER_PATHS = ["metadata", "onepacket", "chunked", "pipelined"]
+
+# Session lengths in trials swept by default
+SESSION_LENGTHS = [60, 120, 500]
+
+# Baud rates swept by default
+BENCHMARK_BAUDS = serialtransfer_utils.CANDIDATE_BAUDS
+
+# Probabilities that any one byte is corrupted swept by default
+ERROR_RATES = [0.0, 1e-3, 1e-2]
+
+# Number of times each combination is run, the median is reported
+REPEATS = 3
+
+###############################################################################
+# Functions
+###############################################################################
+
+
+def benchmark_arrays(num_trials: int, seed: Optional[int] = None) -> list:
+    """
+    Builds a session of any length by resampling the dry run session's trials.
+
+    The dry run configuration's trials are drawn with replacement, so the
+    values, and therefore the encodings they're sent with, look like a
+    real session's.
+
+    Args:
+        num_trials:
+            Number of trials in the session
+        seed:
+            Seed for drawing trials
+
+    Returns:
+        experiment_arrays
+            List of the trialArray, ITIArray, toneArray, and LEDArray
+    """
+
+    with open(arduino_emulator.DRY_RUN_CONFIG, 'r') as inFile:
+        beh_metadata = json.load(inFile)["beh_metadata"]
+
+    rng = np.random.default_rng(seed)
+
+    trials = rng.integers(0, len(beh_metadata["trialArray"]), num_trials)
+
+    trial_array = [beh_metadata["trialArray"][trial] for trial in trials]
+
+    iti_array = [beh_metadata["ITIArray"][trial] for trial in trials]
+
+    tone_array = [beh_metadata["toneArray"][trial] for trial in trials]
+
+    # Only LED trials, types above 3, have an LED stimulation time
+    led_trials = sum(trial_type > 3 for trial_type in trial_array)
+
+    led_array = rng.choice(
+        beh_metadata["LEDArray"] or [0],
+        led_trials
+        ).tolist()
+
+    return [trial_array, iti_array, tone_array, led_array]
+
+
+def benchmark_metadata() -> dict:
+    """
+    Gets the dry run configuration's Arduino metadata.
+
+    Returns:
+        arduino_metadata
+            Dictionary of each METADATA_SCHEMA field's value
+    """
+
+    with open(arduino_emulator.DRY_RUN_CONFIG, 'r') as inFile:
+        beh_metadata = json.load(inFile)["beh_metadata"]
+
+    # Fields missing from older templates are sent as 0
+    return {
+        name: beh_metadata.get(name) or 0
+        for name, _, _ in serialtransfer_utils.METADATA_SCHEMA
+        }
+
+
+def run_emulator(connection, **emulator_kwargs):
+    """
+    Runs an emulated board in its own process until told to stop.
+
+    The board's port is sent back over the connection once it's running.
+
+    Args:
+        connection:
+            multiprocessing Pipe end to send the port on and wait for a stop
+        emulator_kwargs:
+            Settings for the ArduinoEmulator, like error_rate
+    """
+
+    emulator = arduino_emulator.ArduinoEmulator(**emulator_kwargs)
+
+    emulator.start()
+
+    connection.send(emulator.port)
+
+    # Anything sent back means stop
+    connection.recv()
+
+    emulator.stop()
+
+
+def run_transfer_path(path: str, arduino_metadata: dict,
+                      experiment_arrays: list,
+                      link: serialtransfer_utils.InstrumentedTransfer):
+    """
+    Sends a session to the Arduino one of the benchmarked ways.
+
+    Args:
+        path:
+            One of TRANSFER_PATHS
+        arduino_metadata:
+            Metadata sent to the Arduino
+        experiment_arrays:
+            List of arrays sent to the Arduino
+        link:
+            Link to the emulated board
+    """
+
+    metadata_payload = serialtransfer_utils.transfer_metadata(arduino_metadata, link)
+
+    if path == "metadata":
+        return
+
+    serialtransfer_utils.transfer_array_encodings(experiment_arrays, link)
+
+    if path == "onepacket":
+        serialtransfer_utils.onepacket_transfer(experiment_arrays, link)
+
+    elif path == "chunked":
+        serialtransfer_utils.windowed_transfer(experiment_arrays, link, window_size=1)
+
+    else:
+        serialtransfer_utils.windowed_transfer(experiment_arrays, link)
+
+    serialtransfer_utils.verify_session_digest(metadata_payload, experiment_arrays, link)
+
+
+def benchmark_transfer(path: str, num_trials: int, baud: int,
+                       error_rate: float, repeats: int = REPEATS,
+                       seed: Optional[int] = None) -> dict:
+    """
+    Times one transfer path for one session length, baud rate and error rate.
+
+    A fresh emulated board is started in another process for each
+    combination so that only this process's work is counted as CPU time.
+    The emulated board is given room for the whole session, since this
+    measures the link rather than the Mega's RAM.
+
+    Args:
+        path:
+            One of TRANSFER_PATHS
+        num_trials:
+            Number of trials in the session
+        baud:
+            Baud rate to run the link at
+        error_rate:
+            Probability that any one byte is corrupted
+        repeats:
+            Number of times to send the session
+        seed:
+            Seed for the session's trials and the emulated board's errors
+
+    Returns:
+        Dictionary of the combination, the baud rate the link actually ran
+        at, and the median elapsed_s, cpu_s, bytes_per_s, rtt_ms, retries and
+        crc_failures over the repeats. error holds the first error raised, if
+        any, in which case the timings are None.
+    """
+
+    result = {
+        "path": path,
+        "num_trials": num_trials,
+        "baud": baud,
+        "error_rate": error_rate,
+        "link_baud": None,
+        "elapsed_s": None,
+        "cpu_s": None,
+        "bytes_per_s": None,
+        "rtt_ms": None,
+        "retries": None,
+        "crc_failures": None,
+        "error": None,
+        }
+
+    # Longer one packet sessions are sent windowed, which the chunked and
+    # pipelined paths already cover
+    if path == "onepacket" and num_trials > serialtransfer_utils.ONEPACKET_MAX_TRIALS:
+        result["error"] = (
+            f"onepacket only handles up to "
+            f"{serialtransfer_utils.ONEPACKET_MAX_TRIALS} trials"
+            )
+        return result
+
+    arduino_metadata = benchmark_metadata()
+
+    arduino_metadata["totalNumberOfTrials"] = num_trials
+
+    experiment_arrays = benchmark_arrays(num_trials, seed)
+
+    connection, emulator_connection = multiprocessing.Pipe()
+
+    emulator_process = multiprocessing.Process(
+        target=run_emulator,
+        args=(emulator_connection,),
+        kwargs={
+            "error_rate": error_rate,
+            "pool_bytes": 4 * arduino_emulator.NUM_EXPERIMENT_ARRAYS * num_trials,
+            "seed": seed,
+            },
+        daemon=True
+        )
+
+    emulator_process.start()
+
+    link = serialtransfer_utils.InstrumentedTransfer(
+        connection.recv(),
+        serialtransfer_utils.BASE_BAUD,
+        restrict_ports=False,
+        debug=False
+        )
+
+    link.open()
+
+    runs = []
+
+    try:
+        serialtransfer_utils.change_link_baud(link, baud)
+
+        result["link_baud"] = link.connection.baudrate
+
+        for _ in range(repeats):
+
+            packet_log = serialtransfer_utils.PacketLog()
+
+            link.packet_log = packet_log
+
+            start_s = time.perf_counter()
+
+            start_cpu_s = time.process_time()
+
+            try:
+                run_transfer_path(path, arduino_metadata, experiment_arrays, link)
+
+            finally:
+                link.packet_log = None
+
+            elapsed_s = time.perf_counter() - start_s
+
+            rows = packet_log.rows()
+
+            rtt_ms = rows["rtt_s"][~np.isnan(rows["rtt_s"])] * 1000
+
+            runs.append(
+                {
+                    "elapsed_s": elapsed_s,
+                    "cpu_s": time.process_time() - start_cpu_s,
+                    "bytes_per_s": rows["payload_bytes"].sum() / elapsed_s,
+                    "rtt_ms": np.median(rtt_ms) if len(rtt_ms) else np.nan,
+                    "retries": rows["retries"].sum(),
+                    "crc_failures": rows["crc_failures"].sum(),
+                }
+            )
+
+    except (serialtransfer_utils.TransferError, OSError) as error:
+        result["error"] = str(error)
+
+    finally:
+        link.close()
+
+        connection.send(None)
+
+        emulator_process.join()
+
+    if result["error"] is None:
+        for name in runs[0]:
+            result[name] = float(np.median([run[name] for run in runs]))
+
+    return result
+
+
+def run_benchmarks(paths: List[str] = TRANSFER_PATHS,
+                   session_lengths: List[int] = SESSION_LENGTHS,
+                   bauds: List[int] = BENCHMARK_BAUDS,
+                   error_rates: List[float] = ERROR_RATES,
+                   repeats: int = REPEATS,
+                   seed: Optional[int] = 0) -> List[dict]:
+    """
+    Benchmarks every combination of transfer path, session length, baud rate
+    and error rate.
+
+    Args:
+        paths:
+            Transfer paths to benchmark, from TRANSFER_PATHS
+        session_lengths:
+            Session lengths in trials
+        bauds:
+            Baud rates to run the link at
+        error_rates:
+            Probabilities that any one byte is corrupted
+        repeats:
+            Number of times each combination is run
+        seed:
+            Seed for sessions and byte errors, so runs can be compared
+
+    Returns:
+        List of benchmark_transfer() results
+    """
+
+    results = []
+
+    for error_rate in error_rates:
+        for baud in bauds:
+            for num_trials in session_lengths:
+                for path in paths:
+
+                    result = benchmark_transfer(
+                        path,
+                        num_trials,
+                        baud,
+                        error_rate,
+                        repeats,
+                        seed
+                        )
+
+                    print_result(result)
+
+                    results.append(result)
+
+    return results
+
+
+def print_result(result: dict):
+    """
+    Prints one benchmark result as a row of the results table.
+
+    Args:
+        result:
+            Result from benchmark_transfer()
+    """
+
+    combination = (
+        f"{result['path']:>9} {result['num_trials']:>4} trials "
+        f"{result['baud']:>7} baud {result['error_rate']:>6.0e} errors"
+        )
+
+    if result["error"] is not None:
+        print(f"{combination}: {result['error']}")
+        return
+
+    print(
+        f"{combination}: {result['elapsed_s'] * 1000:8.1f} ms, "
+        f"{result['bytes_per_s']:8.0f} bytes/s, "
+        f"{result['cpu_s'] * 1000:8.1f} ms CPU, "
+        f"rtt {result['rtt_ms']:5.1f} ms, "
+        f"{result['retries']:.0f} retries, "
+        f"{result['crc_failures']:.0f} CRC failures, "
+        f"at {result['link_baud']} baud"
+        )
+
+
+###############################################################################
+# Main Function
+###############################################################################
+
+
+if __name__ == "__main__":
+
+    # Create argument parser for the benchmark
+    benchmark_parser = argparse.ArgumentParser(
+        description='Benchmark serial transfers against an emulated Arduino',
+        prog='Bruker Serial Transfer Benchmark'
+    )
+
+    # Add transfer paths argument
+    benchmark_parser.add_argument(
+        '--paths',
+        type=str,
+        nargs='+',
+        choices=TRANSFER_PATHS,
+        dest='paths',
+        help='Transfer paths to benchmark',
+        default=TRANSFER_PATHS,
+        required=False
+    )
+
+    # Add session lengths argument
+    benchmark_parser.add_argument(
+        '--trials',
+        type=int,
+        nargs='+',
+        dest='session_lengths',
+        help='Session lengths in trials',
+        default=SESSION_LENGTHS,
+        required=False
+    )
+
+    # Add baud rates argument
+    benchmark_parser.add_argument(
+        '--bauds',
+        type=int,
+        nargs='+',
+        dest='bauds',
+        help='Baud rates to run the link at',
+        default=BENCHMARK_BAUDS,
+        required=False
+    )
+
+    # Add error rates argument
+    benchmark_parser.add_argument(
+        '--error_rates',
+        type=float,
+        nargs='+',
+        dest='error_rates',
+        help='Probabilities that any one byte is corrupted',
+        default=ERROR_RATES,
+        required=False
+    )
+
+    # Add repeats argument
+    benchmark_parser.add_argument(
+        '--repeats',
+        type=int,
+        action='store',
+        dest='repeats',
+        help='Number of times each combination is run',
+        default=REPEATS,
+        required=False
+    )
+
+    # Add output argument
+    benchmark_parser.add_argument(
+        '--output',
+        type=Path,
+        action='store',
+        dest='output',
+        help='JSON file to write every result to',
+        default=None,
+        required=False
+    )
+
+    benchmark_args = vars(benchmark_parser.parse_args())
+
+    output = benchmark_args.pop("output")
+
+    benchmark_results = run_benchmarks(**benchmark_args)
+
+    if output is not None:
+        with open(output, 'w') as outFile:
+            json.dump(benchmark_results, outFile, indent=4)
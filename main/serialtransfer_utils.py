@@ -12,6 +12,9 @@
 # Import pySerialTransfer for serial comms with Arduino
 from pySerialTransfer import pySerialTransfer as txfer
 
+# Import pyserial's port listing for finding a board's serial number
+from serial.tools import list_ports
+
 # Import Numpy for splitting arrays
 import numpy as np
 
@@ -26,7 +29,7 @@ import subprocess as sp
 from pathlib import Path
 
 # Import typing for type hints
-from typing import List
+from typing import Iterator, List, Optional
 
 # Import os for gathering which user is currently running the experiment
 import os
@@ -35,6 +38,41 @@ import os
 # experiment can find the Arduino being used before running the session
 import json
 
+# Import time for timing out packets that the Arduino hasn't acknowledged
+import time
+
+# Import zlib for computing the CRC32 digests the Arduino reports back
+import zlib
+
+# Import argparse for running the baud rate benchmark from the command line
+import argparse
+
+# Import hashlib for identifying which build of a sketch a board is running
+import hashlib
+
+# Import re for finding the libraries a sketch includes
+import re
+
+# Import shutil for clearing out failed builds from the build cache
+import shutil
+
+# Import threading for compiling and uploading sketches in the background
+import threading
+
+# Import struct for packing the metadata packet from its schema
+import struct
+
+# Import datetime for naming each session's telemetry log
+from datetime import datetime
+
+# Import queue and itertools for streaming trials during a session
+import queue
+import itertools
+
+# Import ThreadPoolExecutor for uploading to and transferring with several
+# boards at once
+from concurrent.futures import ThreadPoolExecutor
+
 # Gather username of whoever is signed into the computer that day for
 # grepping the appropriate sketches
 # For appropriate RTD autodoc functionality, check to see if
@@ -54,6 +92,283 @@ else:
 # in this manner is how things like this will have to be done...
 SKETCH_PATHS = Path(f"C:/Users/{USERNAME}/Documents/gitrepos/bruker_control/")
 
+# The Arduino's serial link is wired to this COM port on machine BRUKER
+SERIAL_PORT = "COM12"
+
+# Every sketch starts its link at this baud rate. Faster rates are only used
+# once the board has passed a loopback test at that rate.
+BASE_BAUD = 115200
+
+# Rates tried during negotiation, slowest first. The Mega's 16MHz clock divides
+# evenly into the rates above 115200.
+CANDIDATE_BAUDS = [115200, 250000, 500000, 1000000, 2000000]
+
+# Number of loopback packets and payload bytes used to test each rate
+LOOPBACK_PACKETS = 50
+LOOPBACK_PAYLOAD = 200
+
+# Seconds to wait for any single reply from the Arduino before calling it lost
+REPLY_TIMEOUT = 0.5
+
+# Seconds the Arduino waits at a new baud rate without a valid packet before
+# it falls back to BASE_BAUD. Must match BAUD_FALLBACK_MS in the sketches!
+BAUD_FALLBACK = 2.0
+
+# Seconds between keepalive pings while a SerialSession's link is idle. Well
+# under BAUD_FALLBACK so the Arduino never drops a negotiated rate between
+# planes.
+KEEPALIVE_INTERVAL = BAUD_FALLBACK / 4
+
+# Seconds to wait for the Arduino to come back at BASE_BAUD after a session.
+# The sketches wait 3 seconds after their last trial before resetting, and
+# Python's recording can end a little before that trial does.
+SESSION_RESET_TIMEOUT = 30.0
+
+# Machine-local caches (negotiated baud rates and the like) live here
+CACHE_PATH = Path.home() / ".bruker_control"
+
+# Negotiated baud rates are cached per board serial number in this file
+BAUD_CACHE = CACHE_PATH / "baud_rates.json"
+
+# Boards found by arduino-cli are remembered here by USB VID:PID:serial so the
+# (slow) CLI only has to be asked again when a board's port goes away
+BOARD_REGISTRY = CACHE_PATH / "boards.json"
+
+# Several boards can be uploaded to and negotiated with at once, so reading
+# and rewriting either cache file is done while holding this lock
+CACHE_LOCK = threading.Lock()
+
+# Packet IDs shared with the team sketches. The Arduino dispatches on these
+# values, so they MUST match the constants at the top of each .ino file!
+METADATA_PACKET_ID = 0
+PYTHON_STATUS_PACKET_ID = 5
+CHUNK_PACKET_ID = 10
+CHUNK_ACK_PACKET_ID = 11
+DIGEST_PACKET_ID = 12
+BAUD_PACKET_ID = 13
+LOOPBACK_PACKET_ID = 14
+IDENTITY_PACKET_ID = 15
+ARRAY_ENCODING_PACKET_ID = 16
+TELEMETRY_PACKET_ID = 17
+TRIAL_REQUEST_PACKET_ID = 18
+TRIAL_BLOCK_PACKET_ID = 19
+CLOCK_SYNC_PACKET_ID = 20
+
+# Opening a board's own USB port resets it, so give the bootloader this many
+# seconds to hand over to the sketch before deciding it won't identify itself
+IDENTITY_TIMEOUT = 3.0
+
+# Source files that make up a sketch's build hash
+SKETCH_SOURCE_SUFFIXES = [".ino", ".h", ".cpp"]
+
+# Compiled sketches are kept here in folders named by the hash of everything
+# that went into them, so every project's sketch shares one cache
+BUILD_CACHE = CACHE_PATH / "builds"
+
+# Library source files that make up a build's cache key
+LIBRARY_SOURCE_SUFFIXES = [".h", ".hpp", ".c", ".cpp", ".S"]
+
+# Matches the header named in an #include line
+INCLUDE_PATTERN = re.compile(r'#include\s*[<"]([^>"]+)[>"]')
+
+# Windowed transfers split every array into chunks of this many bytes of
+# encoded values. 48 bytes plus the 4 byte chunk header keeps each framed
+# packet under the 64 byte hardware receive buffer on the Mega.
+CHUNK_BYTES = 48
+
+# Encodings an experiment array can be sent with as (struct format character,
+# numpy dtype) pairs, narrowest first. The Arduino decodes values by their
+# width alone: 1 and 2 byte values are unsigned and 4 byte values are signed.
+ARRAY_ENCODINGS = [
+    ("B", "<u1"),
+    ("H", "<u2"),
+    ("i", "<i4"),
+]
+
+# Bytes of experiment arrays the sketches can hold, 4 arrays of 60 four byte
+# values. MUST match ARRAY_POOL_BYTES at the top of each .ino file!
+ARRAY_POOL_BYTES = 4 * 60 * 4
+
+# Longest session that one packet transfers can send. Each array has to fit in
+# a single packet, and 60 trials of the widest values fill one.
+ONEPACKET_MAX_TRIALS = 60
+
+# Number of chunks allowed in flight before Python waits for an acknowledgement
+WINDOW_SIZE = 4
+
+# Seconds to wait on the oldest unacknowledged chunk before it and every chunk
+# after it are sent again
+CHUNK_TIMEOUT = 0.25
+
+# Number of times the window can time out without the oldest chunk being
+# acknowledged before the transfer is abandoned
+MAX_RETRANSMISSIONS = 10
+
+# Number of times a packet that's answered by the Arduino is sent before the
+# transfer is abandoned
+MAX_PACKET_ATTEMPTS = 4
+
+# Seconds to wait before the first resend of a packet, doubled for every
+# resend after it
+RETRY_BACKOFF = 0.05
+
+
+# Metadata packet layout, in the order the fields are packed. Each field is
+# (name, struct format character, description). The Python encoder and
+# decoder and the Arduino's metadata_struct are all generated from this.
+METADATA_SCHEMA = [
+    ("totalNumberOfTrials", "H", "total number of trials for experiment"),
+    ("punishTone", "H", "airpuff frequency tone in Hz"),
+    ("rewardTone", "H", "sucrose frequency tone in Hz"),
+    ("USDeliveryTime_Sucrose", "H", "amount of time to open sucrose solenoid"),
+    ("USDeliveryTime_Air", "H", "amount of time to open air solenoid"),
+    ("USConsumptionTime_Sucrose", "H", "amount of time to wait for sucrose consumption"),
+    ("stimDeliveryTime_Total", "H", "amount of time LED is scheduled to run"),
+    ("USDelay", "H", "amount of time to wait before delivering US after tone starts"),
+    ("lickContingency", "?", "whether or not to wait for lick after tone starts"),
+]
+
+# Arduino types matching each struct format character used in the schema
+C_TYPES = {
+    "?": "bool",
+    "B": "uint8_t",
+    "b": "int8_t",
+    "H": "uint16_t",
+    "h": "int16_t",
+    "I": "uint32_t",
+    "i": "int32_t",
+}
+
+# Precompiled little endian packer for the whole metadata packet, the same
+# byte order and packing as the Arduino's __packed__ struct
+METADATA_STRUCT = struct.Struct(
+    "<" + "".join(field_format for _, field_format, _ in METADATA_SCHEMA)
+    )
+
+
+# Behavioral event codes sent by the sketches once the session starts. These
+# MUST match the event codes found in the sketches!
+TELEMETRY_EVENTS = {
+    0: "trial_start",
+    1: "tone",
+    2: "US",
+    3: "lick",
+    4: "LED",
+    5: "bruker_trigger",
+}
+
+# Layout of a telemetry packet: event code, trial, the board's micros() when
+# it happened and an event specific value
+TELEMETRY_STRUCT = struct.Struct("<BHIi")
+
+# Telemetry events are kept in memory and logged to disk with the time Python
+# received them tacked on. Read a log back with np.fromfile(path, TELEMETRY_DTYPE)
+TELEMETRY_DTYPE = np.dtype(
+    [
+        ("event", "<u1"),
+        ("trial", "<u2"),
+        ("micros", "<u4"),
+        ("value", "<i4"),
+        ("host_s", "<f8"),
+    ]
+    )
+
+# Number of most recent events kept in memory
+TELEMETRY_RING_SIZE = 4096
+
+# Directory telemetry logs are written to, one per session
+TELEMETRY_PATH = Path("E:/")
+
+
+# Streamed sessions are sent to the Arduino in blocks of this many trials.
+# The Arduino holds a window of STREAM_WINDOW_BLOCKS blocks and asks for the
+# next one once it's playing the newest. Both MUST match the sketches!
+STREAM_BLOCK_TRIALS = 4
+STREAM_WINDOW_BLOCKS = 2
+
+# Seconds the Arduino waits for a requested block before asking again, the
+# sketches' STREAM_REQUEST_MS
+STREAM_REQUEST_S = 0.5
+
+# Layout of a trial block's header: the trial it starts at and how many
+# trials it holds
+STREAM_HEADER_STRUCT = struct.Struct("<HB")
+
+# Layout of each streamed trial: trial type, ITI, tone duration and LED
+# stimulation delay, the same as the sketches' stream_trial_struct. A block
+# of STREAM_BLOCK_TRIALS trials stays under the Mega's 64 byte receive buffer.
+STREAM_TRIAL_STRUCT = struct.Struct("<BIHI")
+
+# Layout of a clock sync probe's reply: the probe's sequence number and the
+# Arduino's micros() when it answered
+CLOCK_SYNC_STRUCT = struct.Struct("<HI")
+
+# Number of probes exchanged back to back before and after each session
+CLOCK_SYNC_PROBES = 32
+
+# Seconds between single probes sent while the session runs
+CLOCK_SYNC_PERIOD = 1.0
+
+# Probes have to span at least this many seconds before drift is fit,
+# otherwise only the offset is
+CLOCK_SYNC_MIN_SPAN = 10.0
+
+# A probe is dropped when its micros() is further than this many seconds
+# (plus a 1000 ppm drift allowance) from where the previous probe predicts.
+# That only happens when the Arduino has reset and its clock started over.
+CLOCK_SYNC_TOLERANCE = 0.05
+
+# Residuals beyond this many robust standard deviations are downweighted
+CLOCK_SYNC_HUBER_K = 1.345
+
+
+# Names used for each packet in transfer summaries
+PACKET_NAMES = {
+    METADATA_PACKET_ID: "metadata",
+    PYTHON_STATUS_PACKET_ID: "status",
+    CHUNK_PACKET_ID: "chunk",
+    DIGEST_PACKET_ID: "digest",
+    BAUD_PACKET_ID: "baud",
+    LOOPBACK_PACKET_ID: "loopback",
+    IDENTITY_PACKET_ID: "identity",
+    ARRAY_ENCODING_PACKET_ID: "encoding",
+    TRIAL_BLOCK_PACKET_ID: "trial block",
+    CLOCK_SYNC_PACKET_ID: "clock sync",
+}
+
+# Packets the Arduino answers with a different packet ID. Every other packet
+# is answered with its own ID. Python's status and one-packet arrays (IDs 1-4)
+# are echoed with sendDatum()'s default ID.
+REPLY_PACKET_IDS = {
+    PYTHON_STATUS_PACKET_ID: METADATA_PACKET_ID,
+    CHUNK_PACKET_ID: CHUNK_ACK_PACKET_ID,
+    1: METADATA_PACKET_ID,
+    2: METADATA_PACKET_ID,
+    3: METADATA_PACKET_ID,
+    4: METADATA_PACKET_ID,
+}
+
+# One row per packet sent during a transfer. Times are seconds, send_s since
+# the log started and the rest since the packet was (last) sent. Packets that
+# were never answered keep NaN times.
+PACKET_LOG_DTYPE = np.dtype(
+    [
+        ("packet_id", "<u1"),
+        ("payload_bytes", "<u1"),
+        ("send_s", "<f8"),
+        ("first_byte_s", "<f4"),
+        ("rtt_s", "<f4"),
+        ("retries", "<u1"),
+        ("crc_failures", "<u1"),
+    ]
+    )
+
+# Rows preallocated for a packet log, doubled whenever it fills
+PACKET_LOG_SIZE = 256
+
+# pySerialTransfer statuses for packets that arrived damaged
+PACKET_ERRORS = [txfer.CRC_ERROR, txfer.PAYLOAD_ERROR, txfer.STOP_BYTE_ERROR]
+
 
 ###############################################################################
 # Classes
@@ -66,26 +381,39 @@ class Arduino:
 
     Class for discovering boards available on the system with ability
     to select arbitrary Arduino boards discovered on the machine. Compiles
-    and uploads sketches to the board before the experiment starts.
+    and uploads sketches to the board before the experiment starts. A board
+    can be picked by its index in find_boards() or given as its registry
+    entry directly.
     """
 
-    def __init__(self, sketch_path:Path, idx:int=0):
+    def __init__(self, sketch_path:Path, idx:int=0, board:Optional[dict]=None):
         self.sketch_path = sketch_path
 
-        properties = self.list_boards()
+        if board is None:
 
-        if idx > len(properties):
-            raise ValueError(f"Requested board with index {idx}, but {len(properties)} boards found")
-        
-        self.board_name = properties[idx][0]
-        self.fqbn = properties[idx][1]
-        self.board_com = properties[idx][2]
+            properties = find_boards()
+
+            if idx >= len(properties):
+                raise ValueError(f"Requested board with index {idx}, but {len(properties)} boards found")
+
+            board = properties[idx]
+
+        self.board_key = board["key"]
+        self.board_name = board["name"]
+        self.fqbn = board["fqbn"]
+        self.board_com = board["port"]
+        self.link_com = board_link_port(board)
+        self.build_hash = sketch_build_hash(sketch_path, self.fqbn)
+        self.build_dir = None
 
 
     @classmethod
     def list_boards(cls) -> List[tuple]:
         """
         Query CLI for finding available Arduinos on the machine.
+
+        Every board the CLI finds is recorded in the board registry so later
+        runs can skip the CLI while the board stays on the same port.
         """
 
         print("Determining Board Properties...")
@@ -105,44 +433,68 @@ class Arduino:
         # Load json formatted output for parsing
         decoded_com_list = json.loads(com_list)
 
-        # For each address found in the com_list (the CLI)
+        # Newer versions of the CLI nest the port list inside a dictionary
+        if isinstance(decoded_com_list, dict):
+            decoded_com_list = decoded_com_list.get("detected_ports", [])
+
+        # For each address found in the com_list (the CLI
         # will report all noted COM addresses even if its
         # not sure what it is), find its name, fully-qualified
         # board name (fqbn) and the COM ports associated with it
+        # and create list of tuples with the name, fqbn, and port
+        # that will be used to update the class properties
+        boards = []
+
         for address in decoded_com_list:
-            if "matching_boards" in address:
-                matching_boards = address["matching_boards"]
-                # If only one board is found, having the port
-                # addresses in a list makes list comprehension
-                # easier later...
-                addresses = [address["port"]]
-                break
+            for matching_board in address.get("matching_boards", []):
+                boards.append(
+                    (
+                        matching_board["name"],
+                        matching_board["fqbn"],
+                        address["port"]["address"]
+                    )
+                )
 
-        # Create list of tuples with the name, fqbn, and port
-        # that will be used to update the class properties
-        boards = [
-            (
-                matching_boards[board]["name"], 
-                matching_boards[board]["fqbn"],
-                addresses[board]["address"]) for board in range(0, len(matching_boards)
-            )
-        ]
+        update_board_registry(boards)
 
         return boards
 
     def compile_sketch(self):
         """
         Use the CLI to compile the project's Arduino sketch
+
+        Builds are cached by the hash of the sketch's sources, the sources of
+        the libraries it includes, and the fqbn. If that exact build has been
+        compiled before, the cached build is used instead.
         """
 
+        self.build_dir = BUILD_CACHE / build_cache_key(
+            self.sketch_path,
+            self.fqbn
+            )
+
+        if self.build_dir.exists():
+            print("Using cached build of sketch!")
+            return
+
         print("Compiling Sketch...")
 
+        # Compile somewhere temporary first so an interrupted or failed build
+        # never looks like a cached one
+        partial_dir = self.build_dir.with_name(self.build_dir.name + "_partial")
+
+        BUILD_CACHE.mkdir(parents=True, exist_ok=True)
+
         compile_sketch = sp.run(
             [
                 "arduino-cli",
                 "compile",
                 "--fqbn",
                 self.fqbn,
+                "--build-property",
+                f"compiler.cpp.extra_flags=-DFIRMWARE_HASH=0x{self.build_hash:08X}",
+                "--output-dir",
+                str(partial_dir),
                 str(self.sketch_path),
                 "-v",
                 "--format",
@@ -154,10 +506,12 @@ class Arduino:
         compile_output = json.loads(compile_sketch.stdout.decode())
 
         if compile_output["success"]:
+            partial_dir.rename(self.build_dir)
             print("Sketch compiled successfully!")
         
         # TODO: Things like this should be logged...
         else:
+            shutil.rmtree(partial_dir, ignore_errors=True)
             print("COMPILATION ERROR!!! Error in Arduino Script!")
             print(compile_output)
             print(compile_sketch.stderr.decode())   
@@ -166,9 +520,12 @@ class Arduino:
     def upload_sketch(self):
         """
         Use the CLI to upload the sketch to the Arduino.
+
+        Uploads straight from the build cache, so compile_sketch() must be
+        run first.
         """
 
-        print("Uploading Sketch...")
+        print(f"Uploading Sketch to {self.board_name} on {self.board_com}...")
 
         upload_sketch = sp.run(
             [
@@ -178,6 +535,8 @@ class Arduino:
                 self.board_com,
                 "--fqbn",
                 self.fqbn,
+                "--input-dir",
+                str(self.build_dir),
                 str(self.sketch_path),
                 "--format",
                 "json",
@@ -195,523 +554,2994 @@ class Arduino:
         else:
             print("Upload successful!")
 
+            # Remember which sketch the board is now running
+            with CACHE_LOCK:
+                board_registry = read_board_registry()
+                board_registry[self.board_key]["sketch"] = self.sketch_path.name
+                board_registry[self.board_key]["firmware"] = f"{self.build_hash:08X}"
+                write_board_registry(board_registry)
 
-###############################################################################
-# Exceptions
-###############################################################################
+    def read_firmware_hash(self) -> Optional[int]:
+        """
+        Asks the sketch running on the board for its build hash.
 
+        Returns:
+            Build hash the running sketch was compiled with, None if the board
+            didn't answer
+        """
 
-class SketchError(Exception):
-    """
-    Exception for when there's an error finding or using an Arduino sketch.
-    """
-    def __init__(self, *args):
-        if args:
-            self.message = args[0]
-        else:
-            self.message = None
+        try:
+            link = txfer.SerialTransfer(self.link_com, BASE_BAUD, debug=False)
 
-    def __str__(self):
-        if self.message:
-            return "SketchError: " + "{0}".format(self.message)
-        else:
-            return "SKETCH ERROR"
+        except txfer.InvalidSerialPort:
+            return None
 
+        if not link.open():
+            return None
 
-###############################################################################
-# Functions
-###############################################################################
+        firmware_hash = None
 
+        deadline = time.perf_counter() + IDENTITY_TIMEOUT
 
-def upload_arduino_sketch(project: Path):
-    """
-    Takes project name running experiment and finds sketch, uploads to board.
+        # Keep asking in case the request arrived while the board was resetting
+        while firmware_hash is None and time.perf_counter() < deadline:
 
-    Uses project name to grab .ino file for given team, compiles it, and
-    finally sends it to the Arduino using the arduino-cli.
+            request_size = link.tx_obj(0, val_type_override='B')
 
-    Args:
-        project:
-            The team and project conducting the experiment (ie teamname_projectname)
-    """
+            link.send(request_size, packet_id=IDENTITY_PACKET_ID)
 
-    # Currently teams that have separate projects use just one sketch (by design for now...)
-    # The teamname is just the first part of the project name separated by an "_".
-    team_name = project.split("_")[0]
+            if wait_for_packet(link, IDENTITY_PACKET_ID):
+                firmware_hash = link.rx_obj(obj_type='I')
 
-    # Assemble what should be the full path of the Arduino sketch in use
-    project_sketch = SKETCH_PATHS / ("bruker_disc_" + team_name)
+        link.close()
 
-    # Glob whatever sketch is found inside the directory
-    arduino_sketches = [sketch for sketch in project_sketch.glob("*.ino")]
+        return firmware_hash
 
-    # If the length of the list for the sketch is greater than 1,
-    # something is wrong. Raise an exception.    
-    if len(arduino_sketches) > 1:
-        raise SketchError(
-        "Project has multiple Arduino sketches! Check your local bruker_control repo in your project's sketch folder."
-        )
+    def firmware_is_current(self) -> bool:
+        """
+        Checks if the board is already running this build of the sketch.
 
-    # Otherwise, try to load the one present file. If it's not there,
-    # an index error occurs and an exception is raised.
-    else:
-        try:
-            arduino_sketch = arduino_sketches[0]
+        Returns:
+            Whether the board's build hash matches the local sketch's
+        """
 
-        except IndexError:
-            raise SketchError(
-                "Project Arduino sketch is missing! Check your local bruker_control repo in your project's sketch folder."
-                )
-    
-    # Tell the user that their sketch was found.
-    # TODO This should all be piped to a logs file of some sort...
-    # and ideally it would all be part of the Arduino object...
-    print("Sketch found!")
+        firmware_hash = self.read_firmware_hash()
 
-    # Initialize Arduino object
-    arduino = Arduino(arduino_sketch)
+        if firmware_hash is None:
+            print(f"{self.board_name} did not report a build hash")
+            return False
 
-    # Use instance method to compile the sketch
-    arduino.compile_sketch()
+        print(
+            f"{self.board_name} build hash: {firmware_hash:08X}, "
+            f"local build hash: {self.build_hash:08X}"
+            )
 
-    # # Use instance method to upload to board
-    arduino.upload_sketch()
+        return firmware_hash == self.build_hash
 
 
-def transfer_data(arduino_metadata: str, experiment_arrays: list):
+class SketchUpload(threading.Thread):
     """
-    Sends metadata and trial information to the Arduino.
-
-    Takes each array assembled for transmission to the Arduino and stuffs it
-    into packets to be sent via pySerialTransfer. Unites several functions used
-    for transmitting, receiving, and checking data during transfer.
+    Compiles and uploads a project's sketch in the background.
 
-    Args:
-        arduino_metadata:
-            Metadata gathered from config_template that's relevant for Arduino
-            runtime. Formatted as a json string.
-        experiment_arrays:
-            List of arrays generated for a given microscopy session's behavior.
-            0th index is trialArray, 1st is ITIArray, 2nd is toneArray, and 3rd
-            is the LEDArray.
+    Compiling and uploading blocks on arduino-cli for a while, so it's started
+    as soon as the project is known and left running while the operator fills
+    out the flight manifest and Prairie View connects. Errors raised while
+    uploading, including the exit from a failed compile, are held onto and
+    raised again by wait() so the experiment stops the same way it would have
+    without the thread.
 
+    Attributes:
+        project:
+            The team and project conducting the experiment (ie teamname_projectname)
+        boards:
+            Indices of the boards in find_boards() to upload to, board 0 if None
+        error:
+            Exception raised while uploading, None if the upload succeeded
     """
 
-    try:
-        # Initialize COM Port for Serial Transfer
-        link = txfer.SerialTransfer('COM12', 115200, debug=True)
-
-        # Start communicating with the Arduino
-        link.open()
+    def __init__(self, project: str, boards: Optional[List[int]] = None):
+        """
+        Creates the upload thread for a project's sketch.
+
+        Args:
+            project:
+                The team and project conducting the experiment (ie teamname_projectname)
+            boards:
+                Indices of the boards in find_boards() to upload to, board 0
+                if None
+        """
 
-        transfer_metadata(arduino_metadata, link)
+        # Daemon thread so a crash elsewhere doesn't hang on arduino-cli
+        super().__init__(name="sketch_upload", daemon=True)
 
-        transfer_experiment_arrays(experiment_arrays, link)
+        self.project = project
 
-        link.close()
+        self.boards = boards
 
-    except KeyboardInterrupt:
-        try:
-            link.close()
-        except:
-            pass
+        self.error = None
 
-    except:
-        import traceback
-        traceback.print_exc()
+    def run(self):
+        """
+        Runs upload_arduino_sketch, holding onto anything it raises.
+        """
 
+        # Catch BaseException since a failed compile or upload calls
+        # sys.exit(), which would otherwise only end this thread
         try:
-            link.close()
-        except:
-            pass
+            upload_arduino_sketch(self.project, self.boards)
 
+        except BaseException as error:
+            self.error = error
 
-def transfer_experiment_arrays(experiment_arrays: list,
-                               link: txfer.SerialTransfer):
-    """
-    Transfers experimental arrays to Arduino via pySerialTransfer.
+    def wait(self):
+        """
+        Blocks until the board is running the project's sketch.
 
-    Determines what type of packet transfer is required (single or multi) for
-    the generated trials.  If the number of trials is greater than 60, then
-    multiple packets are required for transferring each array.  If less, then
-    only one packet is required for each array.
+        Returns immediately once the upload has already been waited on, so
+        it's safe to call before every transfer.
+        """
 
-    Args:
-        experiment_arrays:
-            List of arrays generated for a given microscopy session's behavior.
-            0th index is trialArray, 1st is ITIArray, 2nd is toneArray, 3rd is
-            the LEDArray.
-        link:
-            pySerialTransfer transmission object
-    """
+        if self.is_alive():
+            print("Waiting for Arduino sketch upload to finish...")
 
-    if len(experiment_arrays[0]) > 60:
+        self.join()
 
-        multipacket_transfer(experiment_arrays, link)
+        # Raise the upload's error in the experiment's thread
+        if self.error is not None:
+            raise self.error
 
-    else:
 
-        onepacket_transfer(experiment_arrays, link)
+class PacketLog:
+    """
+    Records how every packet of a transfer fared on the link.
+
+    Each packet sent gets a row in a preallocated table. Replies are matched to
+    the oldest unanswered packet they answer, which is how the Arduino handles
+    them. A packet sent again with the same payload is counted as a retry of
+    the first one rather than getting a row of its own, and its times are
+    taken from the last time it was sent.
+
+    Attributes:
+        table:
+            Structured array of PACKET_LOG_DTYPE rows, only the first count
+            rows are used
+        count:
+            Number of packets logged
+    """
 
+    def __init__(self, size: int = PACKET_LOG_SIZE):
+        """
+        Creates an empty packet log.
 
-###############################################################################
-# Serial Transfer to Arduino: Error Checking
-###############################################################################
+        Args:
+            size:
+                Number of rows to preallocate
+        """
 
+        self.table = np.zeros(size, dtype=PACKET_LOG_DTYPE)
 
-def array_error_check(transmitted_array: list, received_array: list):
-    """
-    Performs Python side error checking for array transmission.
+        self.count = 0
 
-    While pySerialTransfer performs error checking for different errors, this
-    allows for something simple that is independent of the package for error
-    checking.
+        # Times are counted from the first packet sent
+        self._start = None
 
-    Args:
-        transmitted_array:
-            Array that was sent to the Arduino
-        received_array:
-            Array that was received by the Arduino
-    """
+        # Row each (packet ID, payload) was logged in
+        self._rows = {}
 
-    # If the transmitted array and received array are equal
-    if transmitted_array == received_array:
+        # Rows of packets still waiting on a reply, oldest first
+        self._pending = []
 
-        pass
+    def sent(self, packet_id: int, payload: tuple):
+        """
+        Logs a packet as it's put on the wire.
 
-    # TODO: Raise an exception here that quits the program
-    # If the transmission failed
-    else:
+        Args:
+            packet_id:
+                ID the packet was sent with
+            payload:
+                Payload bytes of the packet before they're stuffed
+        """
 
-        # Tell the user an error occured
-        print("Transmission Error!")
+        if self._start is None:
+            self._start = time.perf_counter()
 
-        # Tell the user the program is exiting
-        print("Exiting...")
+        now = time.perf_counter() - self._start
 
-        # Exit the program
-        sys.exit()
+        row = self._rows.get((packet_id, payload))
 
+        # The same packet again means the first one is being retried
+        if row is not None:
+            self.table["retries"][row] += 1
+            self.table["send_s"][row] = now
+            self.table["first_byte_s"][row] = np.nan
+            self.table["rtt_s"][row] = np.nan
 
-###############################################################################
-# Serial Transfer to Arduino: One Packet
-###############################################################################
+            if row not in self._pending:
+                self._pending.append(row)
 
+            return
 
-# -----------------------------------------------------------------------------
-# Send an Individual Packet
-# -----------------------------------------------------------------------------
+        if self.count == len(self.table):
+            self.table = np.concatenate([self.table, np.zeros_like(self.table)])
 
+        row = self.count
 
-def transfer_packet(array: list, packet_id: int, link: txfer.SerialTransfer):
-    """
-    Transfers an individual packet to the Arduino.
+        self.table[row] = (packet_id, len(payload), now, np.nan, np.nan, 0, 0)
 
-    Each packet is given a unique ID the Arduino can identify and transmitted
-    through the pySerialTransfer link. While the link is unavailable, that is
-    there's an active transfer, the function passes. When finished
-    transmitting, the function receives what the Arduino encoded and an error
-    check is performed. If it passes, the program continues.  If it fails,
-    an exception is raised and the program exits.
+        self.count += 1
 
-    Args:
-        array:
-            Experimental array to be transferred
-        packet_id:
-            Unique ID for encoding an array
-        link:
-            pySerialTransfer transmission object
-    """
+        self._rows[(packet_id, payload)] = row
 
-    try:
+        self._pending.append(row)
 
-        # Initialize array_size of 0
-        array_size = 0
+    def first_byte(self, polled: float):
+        """
+        Logs that reply bytes are waiting for the oldest packet without any yet.
 
-        # Stuff packet with size of experiental array
-        array_size = link.tx_obj(array)
+        Args:
+            polled:
+                time.perf_counter() of the poll that found the bytes
+        """
 
-        # Send the array
-        link.send(array_size, packet_id=packet_id)
+        for row in self._pending:
 
-        # While transferring, the link is unavailable.  While this happens,
-        # pass.
-        while not link.available():
-            pass
+            if np.isnan(self.table["first_byte_s"][row]):
+                self.table["first_byte_s"][row] = (
+                    polled - self._start - self.table["send_s"][row]
+                    )
+                return
 
-        # Receive trial array:
-        rxarray = link.rx_obj(obj_type=type(array),
-                              obj_byte_size=array_size,
-                              list_format='i')
+    def received(self, packet_id: int):
+        """
+        Logs a reply against the oldest packet it answers.
 
-        array_error_check(array, rxarray)
+        Packets that don't answer anything, like telemetry, are ignored.
 
-    except KeyboardInterrupt:
-        try:
-            link.close()
-        except:
-            pass
+        Args:
+            packet_id:
+                ID of the packet that arrived
+        """
 
-    except:
-        import traceback
-        traceback.print_exc()
+        for idx, row in enumerate(self._pending):
 
-        try:
-            link.close()
-        except:
-            pass
+            sent_id = int(self.table["packet_id"][row])
 
+            if REPLY_PACKET_IDS.get(sent_id, sent_id) == packet_id:
+                self.table["rtt_s"][row] = (
+                    time.perf_counter() - self._start - self.table["send_s"][row]
+                    )
+                del self._pending[idx]
+                return
 
-# -----------------------------------------------------------------------------
-# Configuration/Metadata File Transfer
-# -----------------------------------------------------------------------------
+    def failed(self):
+        """
+        Logs a damaged reply against the oldest unanswered packet.
+        """
 
+        if self._pending:
+            self.table["crc_failures"][self._pending[0]] += 1
 
-# TODO: Add error checking function for configuration
-def transfer_metadata(arduino_metadata: str, link: txfer.SerialTransfer):
-    """
-    Transfers arduino_metadata to the Arduino.
+    def rows(self) -> np.ndarray:
+        """
+        Gets the logged rows.
 
-    Arduino metadata collected from config_template is formatted into a json
-    string that the Arduino knows how to interpret.  Each variable is encoded
-    according to a specific byte size depending on the variable type.
+        Returns:
+            Structured array of PACKET_LOG_DTYPE rows
+        """
 
-    Args:
-        arduino_metadata:
-            Metadata gathered from config_template that's relevant for Arduino
-            runtime. Formatted as a json string.
-        link:
-            pySerialTransfer transmission object
-    """
+        return self.table[:self.count]
 
-    try:
+    def to_dict(self) -> dict:
+        """
+        Gets the logged rows as columns for writing into a config file.
 
-        # stuff TX buffer (https://docs.python.org/3/library/struct.html#format-characters)
-        metaData_size = 0
-        metaData_size = link.tx_obj(arduino_metadata['totalNumberOfTrials'],       metaData_size, val_type_override='B')
-        metaData_size = link.tx_obj(arduino_metadata['punishTone'],                metaData_size, val_type_override='H')
-        metaData_size = link.tx_obj(arduino_metadata['rewardTone'],                metaData_size, val_type_override='H')
-        metaData_size = link.tx_obj(arduino_metadata['USDeliveryTime_Sucrose'],    metaData_size, val_type_override='H')
-        metaData_size = link.tx_obj(arduino_metadata['USDeliveryTime_Air'],        metaData_size, val_type_override='H')
-        metaData_size = link.tx_obj(arduino_metadata['USConsumptionTime_Sucrose'], metaData_size, val_type_override='H')
-        metaData_size = link.tx_obj(arduino_metadata['stimDeliveryTime_Total'],    metaData_size, val_type_override='H')
-        metaData_size = link.tx_obj(arduino_metadata['USDelay'],                   metaData_size, val_type_override='H')
-        # val_type_override not needed because it's a built in Python type (https://github.com/PowerBroker2/pySerialTransfer/issues/64#issuecomment-1272163696)
-        metaData_size = link.tx_obj(arduino_metadata['lickContingency'],           metaData_size)
-
-        # Send the metadata to the Arduino.  The metadata is transferred first
-        # and therefore receives the packet_id of 0.
-        link.send(metaData_size, packet_id=0)
-
-        # While sending the data, the link is unavailable.  Pass this state
-        # until done.
-        while not link.available():
-            pass
-
-        # Receive packet from Arduino
-        # Create rxmetaData dictionary
-        rxmetaData = {}
-
-        # Start rxmetaData reception size of 0
-        rxmetaData_size = 0
-
-        # Receive each field from the Arduino
-        rxmetaData['totalNumberOfTrials'] = link.rx_obj(obj_type='B', start_pos=rxmetaData_size)
-        rxmetaData_size += txfer.ARRAY_FORMAT_LENGTHS['B']
-        rxmetaData['punishTone'] = link.rx_obj(obj_type='H', start_pos=rxmetaData_size)
-        rxmetaData_size += txfer.ARRAY_FORMAT_LENGTHS['H']
-        rxmetaData['rewardTone'] = link.rx_obj(obj_type='H', start_pos=rxmetaData_size)
-        rxmetaData_size += txfer.ARRAY_FORMAT_LENGTHS['H']
-        rxmetaData['USDeliveryTime_Sucrose'] = link.rx_obj(obj_type='B', start_pos=rxmetaData_size)
-        rxmetaData_size += txfer.ARRAY_FORMAT_LENGTHS['B']
-        rxmetaData['USDeliveryTime_Air'] = link.rx_obj(obj_type='B', start_pos=rxmetaData_size)
-        rxmetaData_size += txfer.ARRAY_FORMAT_LENGTHS['B']
-        rxmetaData['USConsumptionTime_Sucrose'] = link.rx_obj(obj_type='H', start_pos=rxmetaData_size)
-        rxmetaData_size += txfer.ARRAY_FORMAT_LENGTHS['H']
-        rxmetaData['stimDeliveryTime_Total'] = link.rx_obj(obj_type='H', start_pos=rxmetaData_size)
-
-
-    except KeyboardInterrupt:
-        try:
-            link.close()
-        except:
-            pass
-    except:
-        import traceback
-        traceback.print_exc()
+        Returns:
+            Dictionary of column name: list of values, NaN times are None
+        """
 
-        try:
-            link.close()
-        except:
-            pass
+        rows = self.rows()
 
+        columns = {}
 
-# -----------------------------------------------------------------------------
-# Trial Array Transfers: One Packet
-# -----------------------------------------------------------------------------
+        for name in PACKET_LOG_DTYPE.names:
 
+            if rows[name].dtype.kind == "f":
+                columns[name] = [
+                    None if np.isnan(value) else round(value, 6)
+                    for value in rows[name].tolist()
+                    ]
 
-def onepacket_transfer(experiment_arrays: list, link: txfer.SerialTransfer):
-    """
-    Function for completing experiment arrays one packet transfers to Arduino.
+            else:
+                columns[name] = rows[name].tolist()
 
-    Iterates over transfer_packet() function for each experiment array and
-    invoked if the session length is less than or equal to 60 trials.  Finally
-    invokes the update_python_status() function to say transmission is
-    complete.
+        return columns
 
-    Args:
-        experiment_arrays:
-            List of arrays generated for a given microscopy session's behavior.
-            0th index is trialArray, 1st is ITIArray, 2nd is toneArray.
-        link:
-            pySerialTransfer transmission object
-    """
+    def print_summary(self, title: str = "Serial transfer summary"):
+        """
+        Prints packet counts, latencies and errors for each kind of packet.
 
-    # Start out transmission with packet_id of 1.  The 0th packet is the
-    # arduino_metadata variable
-    packet_id = 1
+        The summary is printed all at once so summaries from boards
+        transferring at the same time don't interleave.
 
-    # For each array in the list of arrays defining trial data
-    for array in experiment_arrays:
+        Args:
+            title:
+                Heading printed above the summary
+        """
 
-        # Transfer the packet
-        transfer_packet(array, packet_id, link)
+        rows = self.rows()
 
-        packet_id += 1
+        lines = [f"{title}:"]
 
-    # Once all arrays are transferred, send signal that Python is ready to
-    # continue!
-    update_python_status(packet_id, link)
+        for packet_id in np.unique(rows["packet_id"]):
 
+            packets = rows[rows["packet_id"] == packet_id]
 
-###############################################################################
-# Serial Transfer to Arduino: Multi-packet
-###############################################################################
+            rtt_ms = packets["rtt_s"][~np.isnan(packets["rtt_s"])] * 1000
 
+            name = PACKET_NAMES.get(int(packet_id), str(packet_id))
 
-# -----------------------------------------------------------------------------
-# Trial Array Splitting for Multipacket Transfers
-# -----------------------------------------------------------------------------
+            if len(rtt_ms):
+                latency = f"rtt {np.median(rtt_ms):.1f} ms median, {rtt_ms.max():.1f} ms max"
 
+            else:
+                latency = "no replies"
 
-def split_multipacket_array(array):
+            lines.append(
+                f"  {name}: {len(packets)} packets, "
+                f"{packets['payload_bytes'].sum()} bytes, {latency}, "
+                f"{packets['retries'].sum()} retries, "
+                f"{packets['crc_failures'].sum()} CRC failures, "
+                f"{len(packets) - len(rtt_ms)} unanswered"
+                )
 
-    # This function receives a large list of trial variables.  It needs to be
-    # split into two arrays using np.array_split.
-    split_ndarray = np.array_split(array, 2)
+        print("\n".join(lines))
 
-    # Return the split numpy arrays
-    return split_ndarray
 
+class InstrumentedTransfer(txfer.SerialTransfer):
+    """
+    pySerialTransfer link that logs its packets while a PacketLog is attached.
 
-# -----------------------------------------------------------------------------
-# Trial Array Transfers: Multi-packet
-# -----------------------------------------------------------------------------
+    Attributes:
+        packet_log:
+            PacketLog packets are recorded in, None to record nothing
+    """
 
+    def __init__(self, *args, **kwargs):
+        """
+        Creates the link exactly like pySerialTransfer's SerialTransfer.
+        """
 
-def multipacket_transfer(array_list):
+        super().__init__(*args, **kwargs)
 
-    packet_id = 1
-    # For each array in the list of trial arrays
-    for array in array_list:
+        self.packet_log = None
 
-        # Split the array into packets small enough to transfer
-        split_array = split_multipacket_array(array)
+        # pySerialTransfer fills its receive buffer with strings, which a
+        # corrupted packet can walk into while unstuffing. Start it all zero
+        # like the sketches do.
+        self.rxBuff = [0] * txfer.MAX_PACKET_SIZE
 
-        # Transfer the arrays as multiple packets
-        transfer_arrays_multipacket(split_array, packet_id)
-        # multipacket_dev(split_array, packet_id)
+        # Held while the TX buffer is filled and sent, since trial blocks and
+        # clock sync probes are sent from different threads during a session
+        self._tx_lock = threading.Lock()
 
-        packet_id += 1
+    def send_payload(self, payload: bytes, packet_id: int = 0) -> bool:
+        """
+        Sends bytes as one packet, safe to call from several threads.
 
+        Args:
+            payload:
+                Bytes to send
+            packet_id:
+                ID to send the packet with
 
-def transfer_arrays_multipacket(split_array, packet_id):
+        Returns:
+            Whether the packet was sent
+        """
 
-    # For each array received by the splitting function
-    for array in split_array:
+        with self._tx_lock:
 
-        # Save the array as a list for transfer
-        array = array.tolist()
+            self.txBuff[:len(payload)] = payload
 
-        # Send the array
-        transfer_packet(array, packet_id)
+            return self.send(len(payload), packet_id=packet_id)
 
-        # Increment the packet number for sending next array
-        packet_id += 1
+    def send(self, message_len: int, packet_id: int = 0) -> bool:
+        """
+        Sends a packet, logging it first.
 
+        Args:
+            message_len:
+                Number of bytes from the TX buffer to send as the payload
+            packet_id:
+                ID to send the packet with
 
-def multipacket_dev(split_array, packet_id):
+        Returns:
+            Whether the packet was sent
+        """
 
-    print(packet_id)
-    new_array = []
+        # Sending stuffs the TX buffer in place, so log the payload first
+        if self.packet_log is not None:
+            self.packet_log.sent(packet_id, tuple(self.txBuff[:message_len]))
 
-    for array in split_array:
-        new_array.append(array.tolist())
+        return super().send(message_len, packet_id=packet_id)
 
-    try:
+    def available(self) -> int:
+        """
+        Parses waiting bytes like SerialTransfer, logging replies and errors.
 
-        # Initialize COM Port for Serial Transfer
-        link = txfer.SerialTransfer('COM12', 115200, debug=True)
+        Returns:
+            Number of payload bytes in a newly received packet, else 0
+        """
 
-        # Initialize array_size of 0
-        first_array_size = 0
-        second_array_size = 0
+        polled = time.perf_counter()
 
-        # Stuff packet with size of trialArray
-        first_array_size = link.tx_obj(new_array[0])
+        # A corrupted overhead byte isn't covered by the CRC and can send
+        # unstuffing past the end of the buffer. Drop the packet like any
+        # other bad one.
+        try:
+            bytes_read = super().available()
 
-        # Open communication link
-        link.open()
+        except IndexError:
+            self.state = txfer.find_start_byte
+            self.status = txfer.PAYLOAD_ERROR
+            bytes_read = 0
 
-        # Send array
-        link.send(first_array_size, packet_id=packet_id)
+        if self.packet_log is None:
+            return bytes_read
 
-        # print("Sent Array")
-        # print(new_array[0])
+        # Anything but NO_DATA means there were bytes waiting at this poll
+        if self.status != txfer.NO_DATA:
+            self.packet_log.first_byte(polled)
 
-        while not link.available():
-            pass
+        if bytes_read:
+            self.packet_log.received(self.idByte)
 
-        # Receive trial array:
-        first_rxarray = link.rx_obj(obj_type=type(new_array[0]),
-                                    obj_byte_size=first_array_size,
-                                    list_format='i')
+        elif self.status in PACKET_ERRORS:
+            self.packet_log.failed()
 
-        # print("Received Array")
-        # print(first_rxarray)
+        return bytes_read
 
-        packet_id += 1
 
-        second_array_size = link.tx_obj(new_array[1])
+class SerialSession:
+    """
+    Keeps one link to the Arduino open for a whole run.
+
+    Opening the link and negotiating its baud rate only happens once, no
+    matter how many planes and subjects are run. While nothing is using the
+    link, a keepalive ping is sent every KEEPALIVE_INTERVAL so the Arduino
+    keeps its negotiated rate. If a ping goes unanswered, the link is tried at
+    BASE_BAUD in case the board fell back to it. The port is only reopened
+    when reading or writing it fails, since reopening a port can reset the
+    board.
+
+    Once Python's status is sent the Arduino ignores pings until it resets at
+    the end of its session, so keepalives stop while the session runs. The
+    next acquire() waits for the reset before handing the link over.
+
+    Attributes:
+        port:
+            Port the Arduino's link is on, None for the registered link port
+        link:
+            InstrumentedTransfer link, None until first acquired
+        reconnects:
+            Number of times the port had to be reopened
+    """
+
+    def __init__(self, port: Optional[str] = None):
+        """
+        Creates the session without opening the link yet.
+
+        The link is opened the first time it's acquired so that it's never
+        opened while the sketch is still being uploaded.
+
+        Args:
+            port:
+                Port to talk to the board on instead of the registered link
+                port, like an arduino_emulator pty
+        """
+
+        self.port = port
+
+        self.link = None
+
+        self.reconnects = 0
+
+        # Held by whoever is currently talking over the link
+        self._lock = threading.Lock()
+
+        # Set while a transfer or telemetry owns the link
+        self._busy = False
+
+        # Set from Python's status until the Arduino resets after the session
+        self._running = False
+
+        self._stop_keepalive = threading.Event()
+
+        self._keepalive_thread = threading.Thread(
+            target=self._keepalive,
+            name="serial_keepalive",
+            daemon=True
+            )
+
+    def _connect(self, forget_failed: bool = True):
+        """
+        Opens the port and moves the link to the board's negotiated rate.
+
+        Args:
+            forget_failed:
+                Whether to drop the board's cached rate if it doesn't work
+        """
+
+        if self.link is not None:
+            self.link.close()
+
+        # Initialize COM Port for Serial Transfer
+        if self.port is None:
+            self.link = InstrumentedTransfer(get_link_port(), BASE_BAUD, debug=True)
+
+        else:
+            self.link = InstrumentedTransfer(
+                self.port,
+                BASE_BAUD,
+                restrict_ports=False,
+                debug=True
+                )
+
+        # Start communicating with the Arduino
+        self.link.open()
+
+        # Move the link up to the fastest rate this board has proven reliable
+        use_negotiated_baud(self.link, forget_failed)
+
+    def ping(self) -> bool:
+        """
+        Checks that the Arduino is answering on the link.
+
+        Returns:
+            Whether the Arduino answered
+        """
+
+        # Stuff a single byte so the request isn't an empty packet
+        request_size = self.link.tx_obj(0, val_type_override='B')
+
+        self.link.send(request_size, packet_id=IDENTITY_PACKET_ID)
+
+        return wait_for_packet(self.link, IDENTITY_PACKET_ID)
+
+    def _ensure_link(self, forget_failed: bool = True):
+        """
+        Makes sure the link is open and answering.
+
+        The port is only reopened if reading or writing it fails. If the
+        Arduino just doesn't answer, a TransferError is raised instead.
+
+        Args:
+            forget_failed:
+                Whether to drop the board's cached rate if it doesn't work
+        """
+
+        if self.link is None:
+            self._connect(forget_failed)
+            return
+
+        baud = self.link.connection.baudrate
+
+        # pyserial's SerialException is an OSError
+        try:
+            if self.ping():
+                return
+
+            # The board may have fallen back to BASE_BAUD, so try there too
+            if baud != BASE_BAUD:
+
+                self.link.connection.baudrate = BASE_BAUD
+
+                self.link.connection.reset_input_buffer()
+
+                if self.ping():
+                    use_negotiated_baud(self.link, forget_failed)
+                    return
+
+                # Neither rate answered, so leave the link where it was
+                self.link.connection.baudrate = baud
+
+        except OSError as error:
+
+            print(f"Arduino link failed ({error}), reconnecting...")
+
+            self.reconnects += 1
+
+            self._connect(forget_failed)
+
+            return
+
+        raise TransferError("Arduino is not answering on the link")
+
+    def _wait_for_reset(self):
+        """
+        Waits for the Arduino to reset after its session, then moves the link
+        back to the board's negotiated rate.
+
+        If the Arduino still answers at the negotiated rate, its session never
+        started and there's nothing to wait for.
+        """
+
+        if self.ping():
+            self._running = False
+            return
+
+        print("Waiting for the Arduino to reset after its session...")
+
+        self.link.connection.baudrate = BASE_BAUD
+
+        deadline = time.perf_counter() + SESSION_RESET_TIMEOUT
+
+        while time.perf_counter() < deadline:
+
+            self.link.connection.reset_input_buffer()
+
+            if self.ping():
+
+                self._running = False
+
+                use_negotiated_baud(self.link)
+
+                return
+
+        raise TransferError("Arduino didn't reset after its session")
+
+    def _keepalive(self):
+        """
+        Pings the Arduino whenever the link is idle until the session closes.
+
+        Nothing is sent while a session runs. A ping that goes unanswered is
+        only reported, the next one tries again.
+        """
+
+        while not self._stop_keepalive.wait(KEEPALIVE_INTERVAL):
+
+            with self._lock:
+
+                if self._busy or self._running:
+                    continue
+
+                try:
+                    # A missed ping doesn't mean the cached rate is bad
+                    self._ensure_link(forget_failed=False)
+
+                except TransferError as error:
+                    print(f"Keepalive: {error.message}")
+
+                except:
+                    import traceback
+                    traceback.print_exc()
+
+    def acquire(self) -> txfer.SerialTransfer:
+        """
+        Hands over a healthy link and pauses the keepalive until release().
+
+        Returns:
+            pySerialTransfer transmission object
+        """
+
+        with self._lock:
+
+            if self._running:
+                self._wait_for_reset()
+
+            else:
+                self._ensure_link()
+
+            self._busy = True
+
+        if not self._keepalive_thread.is_alive():
+            self._keepalive_thread.start()
+
+        return self.link
+
+    def start_running(self):
+        """
+        Stops keepalives until the Arduino resets after its session.
+
+        Called just before Python's status is sent, since the Arduino may
+        start the session even if its confirmation is lost.
+        """
+
+        with self._lock:
+            self._running = True
+
+    def release(self):
+        """
+        Gives the link back to the session and resumes the keepalive unless a
+        session is running.
+        """
+
+        with self._lock:
+            self._busy = False
+
+    def close(self):
+        """
+        Stops the keepalive and closes the link for good.
+        """
+
+        self._stop_keepalive.set()
+
+        if self._keepalive_thread.is_alive():
+            self._keepalive_thread.join()
+
+        if self.link is not None:
+            self.link.close()
+
+
+class TelemetryReader(threading.Thread):
+    """
+    Records the behavioral events the Arduino sends during a session.
+
+    Takes over the link once the session's data is sent and reads telemetry
+    packets until stopped. Each event is stored in a preallocated ring buffer
+    of the most recent events and appended to the session's binary event log
+    as it arrives, so nothing has to be parsed out of text. When trials are
+    streamed, the Arduino's requests for more are handed to the TrialServer.
+    A clock sync probe is sent every CLOCK_SYNC_PERIOD, and a last burst of
+    probes once the session is stopped.
+
+    Attributes:
+        link:
+            pySerialTransfer transmission object the Arduino sends events on
+        log_path:
+            Path of the session's binary event log, None to keep no log
+        trial_server:
+            TrialServer answering the Arduino's trial requests, if streaming
+        clock_sync:
+            ClockSync the session's probes are recorded in, if any
+        ring:
+            Preallocated array of the most recent TELEMETRY_DTYPE events
+        num_events:
+            Number of events received so far
+    """
+
+    def __init__(self, link: txfer.SerialTransfer, log_path: Optional[Path],
+                 ring_size: int = TELEMETRY_RING_SIZE,
+                 session: Optional[SerialSession] = None,
+                 close_session: bool = False,
+                 trial_server: Optional["TrialServer"] = None,
+                 clock_sync: Optional["ClockSync"] = None):
+        """
+        Creates the reader and opens the session's event log.
+
+        Args:
+            link:
+                pySerialTransfer transmission object the Arduino sends events on
+            log_path:
+                Path of the session's binary event log, None to keep no log
+            ring_size:
+                Number of most recent events kept in memory
+            session:
+                SerialSession the link belongs to. The link is released back
+                to it when the reader stops instead of being closed.
+            close_session:
+                Whether to close the session instead, for one off sessions
+            trial_server:
+                Running TrialServer to hand the Arduino's trial requests to
+            clock_sync:
+                ClockSync to keep probing the Arduino's clock with
+        """
+
+        super().__init__(name="telemetry_reader", daemon=True)
+
+        self.link = link
+
+        self.session = session
+
+        self.close_session = close_session
+
+        self.log_path = log_path
+
+        self.trial_server = trial_server
+
+        self.clock_sync = clock_sync
+
+        self.ring = np.zeros(ring_size, dtype=TELEMETRY_DTYPE)
+
+        self.num_events = 0
+
+        self._stop_reading = threading.Event()
+
+        # Guards the ring while events are read out of it
+        self._ring_lock = threading.Lock()
+
+        self._log_file = None
+
+        if self.log_path is not None:
+
+            self.log_path.parent.mkdir(parents=True, exist_ok=True)
+
+            # Append only, so a crash never loses events that were already
+            # logged
+            self._log_file = open(self.log_path, 'ab')
+
+    def run(self):
+        """
+        Reads telemetry packets until stop() is called.
+        """
+
+        next_probe_s = time.perf_counter()
+
+        while not self._stop_reading.is_set():
+
+            if self.clock_sync is not None and time.perf_counter() >= next_probe_s:
+
+                self.clock_sync.probe(self.link)
+
+                next_probe_s += CLOCK_SYNC_PERIOD
+
+            if not self.link.available():
+
+                # Don't spin the CPU while the Arduino is quiet
+                time.sleep(0.0005)
+
+            elif self.link.idByte == TRIAL_REQUEST_PACKET_ID:
+
+                if self.trial_server is not None:
+                    self.trial_server.request(self.link.rx_obj(obj_type='H'))
+
+            elif self.link.idByte == CLOCK_SYNC_PACKET_ID:
+
+                if self.clock_sync is not None:
+                    self.clock_sync.reply(self.link)
+
+            elif self.link.idByte == TELEMETRY_PACKET_ID:
+
+                host_s = time.perf_counter()
+
+                event, trial, micros, value = TELEMETRY_STRUCT.unpack(
+                    bytes(self.link.rxBuff[:TELEMETRY_STRUCT.size])
+                    )
+
+                with self._ring_lock:
+
+                    record = self.ring[self.num_events % len(self.ring)]
+
+                    record["event"] = event
+                    record["trial"] = trial
+                    record["micros"] = micros
+                    record["value"] = value
+                    record["host_s"] = host_s
+
+                    if self._log_file is not None:
+                        self._log_file.write(record.tobytes())
+
+                    self.num_events += 1
+
+    def recent_events(self, num_events: Optional[int] = None) -> np.ndarray:
+        """
+        Copies the most recent events out of the ring buffer, oldest first.
+
+        Args:
+            num_events:
+                Number of events to copy, all that are held if None
+
+        Returns:
+            Array of TELEMETRY_DTYPE events
+        """
+
+        with self._ring_lock:
+
+            held = min(self.num_events, len(self.ring))
+
+            if num_events is None or num_events > held:
+                num_events = held
+
+            idx = np.arange(self.num_events - num_events, self.num_events)
+
+            return self.ring[idx % len(self.ring)].copy()
+
+    def stop(self):
+        """
+        Stops reading and streaming, then closes the event log and the link or
+        releases it back to its session.
+        """
+
+        self._stop_reading.set()
+
+        self.join()
+
+        if self.trial_server is not None:
+            self.trial_server.stop()
+
+        # The board may already be resetting, which ends the burst early
+        if self.clock_sync is not None:
+            self.clock_sync.exchange(self.link)
+
+        if self._log_file is not None:
+            self._log_file.close()
+
+        if self.session is None:
+            self.link.close()
+
+        else:
+            end_transfer(self.session, self.close_session)
+
+        if self.log_path is not None:
+            print(f"Recorded {self.num_events} behavior events to {self.log_path}")
+
+
+class TrialServer(threading.Thread):
+    """
+    Streams blocks of upcoming trials to the Arduino during a session.
+
+    In streaming mode the Arduino only holds STREAM_WINDOW_BLOCKS blocks of
+    trials at a time, so sessions aren't limited by the board's RAM. The first
+    window is sent with the rest of the session's data and the Arduino asks
+    for each block after that as it plays through them. Blocks are made from
+    the trial generator as they're first asked for and kept until the Arduino
+    can no longer ask for them again.
+
+    Attributes:
+        link:
+            pySerialTransfer transmission object blocks are sent on
+        blocks_sent:
+            Number of blocks sent during the session
+    """
+
+    def __init__(self, trials: Iterator[tuple]):
+        """
+        Creates the server for a session's trials.
+
+        Args:
+            trials:
+                Generator of (trial type, ITI, tone duration, LED delay) for
+                every trial in order, like stream_trials()
+        """
+
+        super().__init__(name="trial_server", daemon=True)
+
+        self.link = None
+
+        self.blocks_sent = 0
+
+        self._trials = iter(trials)
+
+        # First trial of the next block to be made
+        self._next_trial = 0
+
+        # Packed blocks by the trial they start at
+        self._blocks = {}
+
+        self._requests = queue.Queue()
+
+    def block(self, first_trial: int) -> Optional[bytes]:
+        """
+        Gets the packed block of trials starting at a trial.
+
+        Args:
+            first_trial:
+                Trial the block starts at
+
+        Returns:
+            Payload of the block, None if the session has no such block
+        """
+
+        # Pull trials from the generator until the block has been made
+        while self._next_trial <= first_trial:
+
+            trials = list(itertools.islice(self._trials, STREAM_BLOCK_TRIALS))
+
+            if not trials:
+                break
+
+            self._blocks[self._next_trial] = STREAM_HEADER_STRUCT.pack(
+                self._next_trial,
+                len(trials)
+                ) + b"".join(STREAM_TRIAL_STRUCT.pack(*trial) for trial in trials)
+
+            self._next_trial += len(trials)
+
+        # Blocks older than the Arduino's window won't be asked for again
+        window_start = first_trial - STREAM_BLOCK_TRIALS * STREAM_WINDOW_BLOCKS
+
+        for old_trial in [trial for trial in self._blocks if trial < window_start]:
+            del self._blocks[old_trial]
+
+        return self._blocks.get(first_trial)
+
+    def send_window(self, link: txfer.SerialTransfer) -> List[bytes]:
+        """
+        Sends the session's first window of blocks before the session starts.
+
+        Each block's header is echoed back by the Arduino.
+
+        Args:
+            link:
+                pySerialTransfer transmission object
+
+        Returns:
+            Payloads of the blocks sent, for the session digest
+        """
+
+        self.link = link
+
+        payloads = []
+
+        for _ in range(STREAM_WINDOW_BLOCKS):
+
+            payload = self.block(self._next_trial)
+
+            if payload is None:
+                break
+
+            request_reply(
+                link,
+                payload,
+                TRIAL_BLOCK_PACKET_ID,
+                check=lambda reply, payload=payload: array_error_check(
+                    payload[:STREAM_HEADER_STRUCT.size],
+                    reply[:STREAM_HEADER_STRUCT.size]
+                    )
+                )
+
+            payloads.append(payload)
+
+        return payloads
+
+    def request(self, first_trial: int):
+        """
+        Queues the Arduino's request for the block starting at a trial.
+
+        Args:
+            first_trial:
+                Trial the requested block starts at
+        """
+
+        self._requests.put(first_trial)
+
+    def run(self):
+        """
+        Answers the Arduino's requests until stop() is called.
+        """
+
+        while True:
+
+            first_trial = self._requests.get()
+
+            if first_trial is None:
+                return
+
+            payload = self.block(first_trial)
+
+            # The Arduino never asks past the end of the session, but don't
+            # answer if it does
+            if payload is None:
+                continue
+
+            self.link.send_payload(payload, TRIAL_BLOCK_PACKET_ID)
+
+            self.blocks_sent += 1
+
+    def stop(self):
+        """
+        Stops answering requests.
+        """
+
+        self._requests.put(None)
+
+        if self.ident is not None:
+            self.join()
+
+
+class ClockSync:
+    """
+    Measures how the Arduino's micros() clock relates to the host's clock.
+
+    Probes are sent to the Arduino, which answers each with its micros() as
+    soon as it arrives. Each answer is paired with the host's perf_counter()
+    halfway between sending and receiving, the same clock telemetry events
+    are stamped with. A burst of probes is exchanged before the session
+    starts and after it ends, and single probes are sent while it runs.
+    fit() turns them into an offset and drift that arduino_to_host() uses to
+    place the Arduino's timestamps on the host's timeline.
+
+    Attributes:
+        host_s:
+            Host time of each probe, halfway between sending and receiving
+        arduino_micros:
+            Arduino's micros() for each probe, unwrapped past 32 bits
+        rtt_s:
+            Round trip time of each probe
+    """
+
+    def __init__(self):
+        """
+        Creates an empty set of probes.
+        """
+
+        self.host_s = []
+
+        self.arduino_micros = []
+
+        self.rtt_s = []
+
+        # Send times of probes that haven't been answered, by sequence number
+        self._pending = {}
+
+        self._seq = 0
+
+    def probe(self, link: txfer.SerialTransfer):
+        """
+        Sends one probe without waiting for its answer.
+
+        Args:
+            link:
+                InstrumentedTransfer link to the Arduino
+        """
+
+        self._seq = (self._seq + 1) & 0xFFFF
+
+        # Forget probes that were never answered
+        self._pending.pop(self._seq, None)
+
+        self._pending[self._seq] = time.perf_counter()
+
+        link.send_payload(struct.pack("<H", self._seq), CLOCK_SYNC_PACKET_ID)
+
+    def reply(self, link: txfer.SerialTransfer) -> bool:
+        """
+        Records the answer to a probe that's in the link's receive buffer.
+
+        Answers that don't fit the probes before them, because the Arduino
+        reset and its clock started over, are dropped.
+
+        Args:
+            link:
+                InstrumentedTransfer link to the Arduino
+
+        Returns:
+            Whether the answer was recorded
+        """
+
+        received_s = time.perf_counter()
+
+        seq, micros = CLOCK_SYNC_STRUCT.unpack(
+            bytes(link.rxBuff[:CLOCK_SYNC_STRUCT.size])
+            )
+
+        if seq not in self._pending:
+            return False
+
+        sent_s = self._pending.pop(seq)
+
+        host_s = (sent_s + received_s) / 2
+
+        # micros() wraps every 71.6 minutes, so pick whichever wrap of it
+        # lands closest to where the previous probe says it should be
+        if self.arduino_micros:
+
+            elapsed_s = host_s - self.host_s[-1]
+
+            predicted = self.arduino_micros[-1] + elapsed_s * 1e6
+
+            micros += round((predicted - micros) / 2**32) * 2**32
+
+            tolerance = (CLOCK_SYNC_TOLERANCE + 1e-3 * abs(elapsed_s)) * 1e6
+
+            if abs(micros - predicted) > tolerance:
+                return False
+
+        self.host_s.append(host_s)
+
+        self.arduino_micros.append(micros)
+
+        self.rtt_s.append(received_s - sent_s)
+
+        return True
+
+    def exchange(self, link: txfer.SerialTransfer,
+                 num_probes: int = CLOCK_SYNC_PROBES) -> int:
+        """
+        Exchanges probes back to back, stopping at the first one unanswered.
+
+        Args:
+            link:
+                InstrumentedTransfer link to the Arduino
+            num_probes:
+                Number of probes to send
+
+        Returns:
+            Number of probes recorded
+        """
+
+        recorded = 0
+
+        for _ in range(num_probes):
+
+            self.probe(link)
+
+            if not wait_for_packet(link, CLOCK_SYNC_PACKET_ID):
+                break
+
+            recorded += self.reply(link)
+
+        return recorded
+
+    def fit(self) -> Optional[dict]:
+        """
+        Fits host time against Arduino time by robust linear regression.
+
+        Each probe is weighted by how quickly it was answered, since a slow
+        round trip leaves more room for the midpoint to be off. Outliers are
+        then downweighted with Huber weights until the fit settles. Drift is
+        only fit once the probes span CLOCK_SYNC_MIN_SPAN.
+
+        Returns:
+            clock_model
+                Dictionary with the Arduino's micros() at the first probe, the
+                host time it maps to, the drift in ppm, the residual spread in
+                us, and every probe. None if there are no probes.
+        """
+
+        if not self.host_s:
+            return None
+
+        host_s = np.array(self.host_s)
+
+        arduino_micros = np.array(self.arduino_micros, dtype=np.int64)
+
+        rtt_s = np.array(self.rtt_s)
+
+        arduino_s = (arduino_micros - arduino_micros[0]) / 1e6
+
+        fit_drift = arduino_s[-1] - arduino_s[0] >= CLOCK_SYNC_MIN_SPAN
+
+        design = np.column_stack([np.ones_like(arduino_s), arduino_s])
+
+        # Without enough span the slope is fixed at 1, so only fit the offset
+        target = host_s if fit_drift else host_s - arduino_s
+
+        if not fit_drift:
+            design = design[:, :1]
+
+        rtt_weights = 1 / np.maximum(rtt_s, 1e-4)
+
+        weights = rtt_weights
+
+        for _ in range(20):
+
+            coefficients = np.linalg.lstsq(
+                design * np.sqrt(weights)[:, None],
+                target * np.sqrt(weights),
+                rcond=None
+                )[0]
+
+            residuals = target - design @ coefficients
+
+            # Median absolute deviation as a robust standard deviation
+            scale = max(1.4826 * np.median(np.abs(residuals - np.median(residuals))), 1e-6)
+
+            huber_weights = np.minimum(
+                1,
+                CLOCK_SYNC_HUBER_K * scale / np.maximum(np.abs(residuals), 1e-12)
+                )
+
+            new_weights = rtt_weights * huber_weights
+
+            if np.allclose(new_weights, weights):
+                break
+
+            weights = new_weights
+
+        slope = coefficients[1] if fit_drift else 1.0
+
+        return {
+            "ref_micros": int(arduino_micros[0] % 2**32),
+            "ref_host_s": float(coefficients[0]),
+            "drift_ppm": float((slope - 1) * 1e6),
+            "residual_us": float(scale * 1e6),
+            "num_probes": len(host_s),
+            "probes": {
+                "host_s": [round(value, 6) for value in self.host_s],
+                "arduino_micros": [int(value) for value in self.arduino_micros],
+                "rtt_s": [round(value, 6) for value in self.rtt_s],
+            },
+        }
+
+
+class SessionUpload(threading.Thread):
+    """
+    Sends a plane's metadata and trial arrays to the Arduino in the background.
+
+    The arrays are ready long before the scope is, so they're sent while the
+    preview runs and the T-Series is set up. In streaming mode only the first
+    window of trials is sent and a TrialServer streams the rest during the
+    session. Python's status is held back until start_session() because it's
+    what tells the Arduino to trigger the scope. Until then the link is given
+    back to its session so keepalives hold the negotiated baud rate.
+
+    Attributes:
+        arduino_metadata:
+            Metadata gathered from config_template that's relevant for Arduino
+            runtime
+        experiment_arrays:
+            List of arrays generated for a given microscopy session's behavior
+        transfer_mode:
+            Either "windowed", "onepacket" or "streaming"
+        trial_server:
+            TrialServer for the session's trials if streaming, else None
+        session:
+            SerialSession the link is borrowed from
+        own_session:
+            Whether the session was opened only for this upload
+        sketch_upload:
+            SketchUpload to wait for before talking to the board, if any
+        error:
+            Exception raised while uploading, None if the upload succeeded
+        upload_s:
+            Seconds the metadata and arrays took to send, None until sent
+        clock_sync:
+            ClockSync of the probes exchanged with the Arduino this session
+        packet_log:
+            PacketLog of every packet sent for this session
+    """
+
+    def __init__(self, arduino_metadata: dict, experiment_arrays: list,
+                 transfer_mode: str = "windowed",
+                 port: Optional[str] = None,
+                 session: Optional[SerialSession] = None,
+                 sketch_upload: Optional[SketchUpload] = None):
+        """
+        Creates the upload for one plane's session.
+
+        Args:
+            arduino_metadata:
+                Metadata gathered from config_template that's relevant for
+                Arduino runtime
+            experiment_arrays:
+                List of arrays generated for a given microscopy session's
+                behavior
+            transfer_mode:
+                Either "windowed" (default), "onepacket" or "streaming"
+            port:
+                Port for a one off session when no session is given
+            session:
+                SerialSession to borrow the link from. If None, one is opened
+                for this upload and closed once the session is over.
+            sketch_upload:
+                SketchUpload to wait for before talking to the board
+        """
+
+        super().__init__(name="session_upload", daemon=True)
+
+        self.arduino_metadata = arduino_metadata
+
+        self.experiment_arrays = experiment_arrays
+
+        self.transfer_mode = transfer_mode
+
+        self.trial_server = None
+
+        if transfer_mode == "streaming":
+            self.trial_server = TrialServer(stream_trials(experiment_arrays))
+
+        self.own_session = session is None
+
+        if self.own_session:
+            session = SerialSession(port)
+
+        self.session = session
+
+        self.sketch_upload = sketch_upload
+
+        self.error = None
+
+        self.upload_s = None
+
+        self.clock_sync = ClockSync()
+
+        self.packet_log = PacketLog()
+
+    def run(self):
+        """
+        Sends the metadata and arrays, then checks the Arduino's digests.
+        """
+
+        # Catch BaseException since a failed sketch upload calls sys.exit(),
+        # which would otherwise only end this thread
+        try:
+
+            # The board has to be running the project's sketch first
+            if self.sketch_upload is not None:
+                self.sketch_upload.wait()
+
+            # Borrow a healthy link that's already at the negotiated rate
+            link = self.session.acquire()
+
+            # Only this upload's packets are logged, not the keepalives
+            link.packet_log = self.packet_log
+
+            start = time.perf_counter()
+
+            try:
+                metadata_payload = transfer_metadata(self.arduino_metadata, link)
+
+                # Only the first window of trials is sent before the session,
+                # none of the arrays are
+                if self.trial_server is not None:
+
+                    block_payloads = self.trial_server.send_window(link)
+
+                    verify_session_digest(
+                        metadata_payload,
+                        [[] for _ in self.experiment_arrays],
+                        link,
+                        block_payloads
+                        )
+
+                else:
+
+                    transfer_experiment_arrays(
+                        self.experiment_arrays,
+                        link,
+                        self.transfer_mode
+                        )
+
+                    verify_session_digest(
+                        metadata_payload,
+                        self.experiment_arrays,
+                        link
+                        )
+
+                self.upload_s = time.perf_counter() - start
+
+                # Start relating the Arduino's clock to the host's
+                if not self.clock_sync.exchange(link):
+                    raise TransferError("Arduino didn't answer any clock sync probes")
+
+            finally:
+                link.packet_log = None
+
+                self.session.release()
+
+        except BaseException as error:
+            self.error = error
+
+    def start_session(self, telemetry_path: Optional[Path] = None) -> Optional[TelemetryReader]:
+        """
+        Waits for the upload, then tells the Arduino to start the session.
+
+        Args:
+            telemetry_path:
+                Path of the session's binary event log. If given, the Arduino's
+                behavior events are recorded until the returned reader is
+                stopped.
+
+        Returns:
+            telemetry_reader
+                Running TelemetryReader if telemetry_path was given or trials
+                are streamed, else None. The upload's error is raised here if
+                it failed.
+        """
+
+        # Only join if the upload was run in the background
+        if self.ident is not None:
+
+            if self.is_alive():
+                print("Waiting for trial upload to finish...")
+
+            self.join()
+
+        # Raise the upload's error in the experiment's thread
+        if self.error is not None:
+
+            if self.own_session:
+                self.session.close()
+
+            raise self.error
+
+        link = self.session.acquire()
+
+        link.packet_log = self.packet_log
+
+        # The Arduino stops answering pings once it has the status
+        self.session.start_running()
+
+        try:
+            update_python_status(PYTHON_STATUS_PACKET_ID, link)
+
+        except BaseException:
+            end_transfer(self.session, self.own_session)
+            raise
+
+        finally:
+            link.packet_log = None
+
+            # Name the board when several are transferring
+            if self.session.port is None:
+                self.packet_log.print_summary()
+
+            else:
+                self.packet_log.print_summary(
+                    f"Serial transfer summary for {self.session.port}"
+                    )
+
+        # Streamed trials are sent on whatever link the session has now
+        if self.trial_server is not None:
+
+            self.trial_server.link = link
+
+            self.trial_server.start()
+
+        # Keep listening to the Arduino for the rest of the session
+        if telemetry_path is not None or self.trial_server is not None:
+
+            # A one off session is closed once telemetry stops
+            telemetry_reader = TelemetryReader(
+                link,
+                telemetry_path,
+                session=self.session,
+                close_session=self.own_session,
+                trial_server=self.trial_server,
+                clock_sync=self.clock_sync
+                )
+
+            telemetry_reader.start()
+
+            return telemetry_reader
+
+        end_transfer(self.session, self.own_session)
+
+    def transfer(self, telemetry_path: Optional[Path] = None) -> Optional[TelemetryReader]:
+        """
+        Uploads in the calling thread instead of the background, then starts
+        the session.
+
+        Args:
+            telemetry_path:
+                Path of the session's binary event log, if any
+
+        Returns:
+            telemetry_reader
+                Running TelemetryReader if telemetry_path was given or trials
+                are streamed, else None
+        """
+
+        self.run()
+
+        return self.start_session(telemetry_path)
+
+
+###############################################################################
+# Exceptions
+###############################################################################
+
+
+class SketchError(Exception):
+    """
+    Exception for when there's an error finding or using an Arduino sketch.
+    """
+    def __init__(self, *args):
+        if args:
+            self.message = args[0]
+        else:
+            self.message = None
+
+    def __str__(self):
+        if self.message:
+            return "SketchError: " + "{0}".format(self.message)
+        else:
+            return "SKETCH ERROR"
+
+
+class TransferError(Exception):
+    """
+    Exception for when data can't be sent to the Arduino intact.
+    """
+    def __init__(self, *args):
+        if args:
+            self.message = args[0]
+        else:
+            self.message = None
+
+    def __str__(self):
+        if self.message:
+            return "TransferError: " + "{0}".format(self.message)
+        else:
+            return "TRANSFER ERROR"
+
+
+###############################################################################
+# Functions
+###############################################################################
+
+
+# -----------------------------------------------------------------------------
+# Telemetry Logs
+# -----------------------------------------------------------------------------
+
+
+def telemetry_log_path(project: str, subject_id: str, current_plane: int,
+                       imaging_plane: str) -> Path:
+    """
+    Builds the path of a session's binary behavior event log.
+
+    Named the same way as the session's video and configuration file.
+
+    Args:
+        project:
+            The team and project conducting the experiment (ie teamname_projectname)
+        subject_id:
+            The subject being recorded
+        current_plane:
+            Current plane being imaged as in 1st, 2nd, 3rd, etc
+        imaging_plane:
+            Plane 2P images were acquired at, the Z-axis value
+
+    Returns:
+        Path of the session's event log
+    """
+
+    # Gather session date using datetime
+    session_date = datetime.today().strftime("%Y%m%d")
+
+    # Set session name by joining variables with underscores
+    session_name = "_".join(
+        [session_date, subject_id, "plane{}".format(current_plane), imaging_plane]
+        )
+
+    return TELEMETRY_PATH / project / "telemetry" / (session_name + "_events.bin")
+
+
+# -----------------------------------------------------------------------------
+# Board Registry
+# -----------------------------------------------------------------------------
+
+
+def port_key(port: str) -> Optional[str]:
+    """
+    Builds the registry key for whatever USB device is on a given port.
+
+    Keys are the device's USB VID:PID:serial number, which stay the same
+    no matter which port Windows assigns the device.
+
+    Args:
+        port:
+            Port to look up, ie COM12
+
+    Returns:
+        Registry key, None if there's no USB device on the port
+    """
+
+    for port_info in list_ports.comports():
+        if port_info.device == port and port_info.vid is not None:
+            return f"{port_info.vid:04X}:{port_info.pid:04X}:{port_info.serial_number}"
+
+    return None
+
+
+def read_board_registry() -> dict:
+    """
+    Reads the registry of Arduinos this machine has seen.
+
+    Returns:
+        Dictionary of VID:PID:serial keys and each board's port, name, fqbn,
+        last-known sketch, and (optionally) the key of the UART converter
+        used as its serial transfer link
+    """
+
+    if BOARD_REGISTRY.exists():
+        with open(BOARD_REGISTRY, 'r') as inFile:
+            return json.load(inFile)
+
+    return {}
+
+
+def write_board_registry(board_registry: dict):
+    """
+    Writes the registry of Arduinos this machine has seen to disk.
+
+    Args:
+        board_registry:
+            Dictionary from read_board_registry()
+    """
+
+    CACHE_PATH.mkdir(parents=True, exist_ok=True)
+
+    with open(BOARD_REGISTRY, 'w') as outFile:
+        json.dump(board_registry, outFile, indent=4)
+
+
+def update_board_registry(boards: List[tuple]):
+    """
+    Records boards reported by arduino-cli in the board registry.
+
+    Boards already in the registry keep their last-known sketch and link.
+
+    Args:
+        boards:
+            List of (name, fqbn, port) tuples from Arduino.list_boards()
+    """
+
+    with CACHE_LOCK:
+
+        board_registry = read_board_registry()
+
+        for name, fqbn, port in boards:
+
+            key = port_key(port)
+
+            if key is None:
+                continue
+
+            board = board_registry.setdefault(key, {"sketch": None, "link": None})
+
+            board.update({"name": name, "fqbn": fqbn, "port": port})
+
+        write_board_registry(board_registry)
+
+
+def find_boards(refresh: bool = False) -> List[dict]:
+    """
+    Finds the Arduinos connected to the machine, using the registry if it can.
+
+    Listing USB ports with pyserial is nearly instant, so each registered
+    board is checked for still being on its cached port. arduino-cli is only
+    queried when no registered board is where it was last seen.
+
+    Args:
+        refresh:
+            Query arduino-cli even if the registry is up to date
+
+    Returns:
+        List of registry entries, with their keys, for each connected board
+    """
+
+    connected = [
+        dict(board, key=key) for (key, board) in read_board_registry().items()
+        if port_key(board["port"]) == key
+    ]
+
+    if refresh or not connected:
+
+        Arduino.list_boards()
+
+        connected = [
+            dict(board, key=key) for (key, board) in read_board_registry().items()
+            if port_key(board["port"]) == key
+        ]
+
+    return connected
+
+
+def get_link_port(idx: int = 0) -> str:
+    """
+    Resolves which port the serial transfer link to a board is on.
+
+    Falls back on SERIAL_PORT if no board can be found.
+
+    Args:
+        idx:
+            Index of the board in find_boards()
+
+    Returns:
+        Port to open the pySerialTransfer link on
+    """
+
+    boards = find_boards()
+
+    if idx >= len(boards):
+        print(f"No board found, using {SERIAL_PORT}")
+        return SERIAL_PORT
+
+    return board_link_port(boards[idx])
+
+
+def board_link_port(board: dict) -> str:
+    """
+    Resolves which port the serial transfer link to a registered board is on.
+
+    Boards that talk to Python through a UART converter (like Serial1 on the
+    BRUKER rig) have the converter's key registered as their link. Both
+    sketches transfer over Serial1, so the board's own USB port is never
+    used. Opening it would also reset the board. Falls back on SERIAL_PORT if
+    no link is registered or the converter can't be found.
+
+    Args:
+        board:
+            Registry entry from find_boards()
+
+    Returns:
+        Port to open the pySerialTransfer link on
+    """
+
+    # The sketches only talk over Serial1, so never guess the USB port
+    if board["link"] is None:
+        print(
+            f"No link registered for {board['name']}, using {SERIAL_PORT}. "
+            "Run serialtransfer_utils.py --register_link <port> to set it."
+            )
+        return SERIAL_PORT
+
+    for port_info in list_ports.comports():
+        if port_key(port_info.device) == board["link"]:
+            return port_info.device
+
+    print(f"Link for {board['name']} not found, using {SERIAL_PORT}")
+
+    return SERIAL_PORT
+
+
+def register_link_port(link_port: str, idx: int = 0):
+    """
+    Registers the UART converter on a port as a board's serial transfer link.
+
+    Args:
+        link_port:
+            Port the UART converter is on, ie COM12
+        idx:
+            Index of the board in find_boards()
+    """
+
+    board_key = find_boards()[idx]["key"]
+
+    with CACHE_LOCK:
+
+        board_registry = read_board_registry()
+
+        board_registry[board_key]["link"] = port_key(link_port)
+
+        write_board_registry(board_registry)
+
+
+def sketch_build_hash(sketch_path: Path, fqbn: str) -> int:
+    """
+    Hashes a sketch's source files together with the board it's built for.
+
+    The hash is compiled into the sketch as FIRMWARE_HASH so a running board
+    can report exactly which build it has.
+
+    Args:
+        sketch_path:
+            Path to the sketch's .ino file
+        fqbn:
+            Fully qualified board name the sketch is compiled for
+
+    Returns:
+        First 32 bits of the SHA-256 of the sources and fqbn
+    """
+
+    sketch_hash = hashlib.sha256()
+
+    sources = sorted(
+        source for source in sketch_path.parent.iterdir()
+        if source.suffix in SKETCH_SOURCE_SUFFIXES
+        )
+
+    for source in sources:
+        sketch_hash.update(source.name.encode())
+        sketch_hash.update(source.read_bytes())
+
+    sketch_hash.update(fqbn.encode())
+
+    return int.from_bytes(sketch_hash.digest()[:4], byteorder="little")
+
+
+def sketch_libraries(sketch_path: Path) -> List[Path]:
+    """
+    Finds the source folders of the libraries a sketch includes.
+
+    Asks arduino-cli for every installed and platform bundled library and
+    keeps the ones providing a header the sketch includes.
+
+    Args:
+        sketch_path:
+            Path to the sketch's .ino file
+
+    Returns:
+        List of library source folders
+    """
+
+    includes = set()
+
+    for source in sketch_path.parent.iterdir():
+        if source.suffix in SKETCH_SOURCE_SUFFIXES:
+            includes.update(INCLUDE_PATTERN.findall(source.read_text(errors="ignore")))
+
+    lib_list = sp.run(
+        [
+            "arduino-cli",
+            "lib",
+            "list",
+            "--all",
+            "--format",
+            "json"
+        ],
+        capture_output=True
+    ).stdout.decode()
+
+    decoded_lib_list = json.loads(lib_list or "[]")
+
+    # Newer versions of the CLI nest the library list inside a dictionary
+    if isinstance(decoded_lib_list, dict):
+        decoded_lib_list = decoded_lib_list.get("installed_libraries", [])
+
+    libraries = []
+
+    for installed in decoded_lib_list:
+
+        library = installed["library"]
+
+        source_dir = Path(library.get("source_dir") or library["install_dir"])
+
+        if any((source_dir / header).exists() for header in includes):
+            libraries.append(source_dir)
+
+    return sorted(set(libraries))
+
+
+def build_cache_key(sketch_path: Path, fqbn: str) -> str:
+    """
+    Hashes everything that goes into compiling a sketch.
+
+    Combines the sketch's build hash (its sources and fqbn) with the sources
+    of every library it includes, like digitalWriteFast.h, so updating a
+    library also misses the cache.
+
+    Args:
+        sketch_path:
+            Path to the sketch's .ino file
+        fqbn:
+            Fully qualified board name the sketch is compiled for
+
+    Returns:
+        Hex digest naming the build's folder in the build cache
+    """
+
+    cache_key = hashlib.sha256()
+
+    cache_key.update(sketch_build_hash(sketch_path, fqbn).to_bytes(4, "little"))
+
+    for library in sketch_libraries(sketch_path):
+
+        sources = sorted(
+            source for source in library.rglob("*")
+            if source.suffix in LIBRARY_SOURCE_SUFFIXES
+            )
+
+        for source in sources:
+            cache_key.update(source.relative_to(library).as_posix().encode())
+            cache_key.update(source.read_bytes())
+
+    return cache_key.hexdigest()
+
+
+def find_project_sketch(project: str) -> Path:
+    """
+    Finds the Arduino sketch a project's team uses.
+
+    Args:
+        project:
+            The team and project conducting the experiment (ie teamname_projectname)
+
+    Returns:
+        arduino_sketch
+            Path to the team's .ino file
+    """
+
+    # Currently teams that have separate projects use just one sketch (by design for now...)
+    # The teamname is just the first part of the project name separated by an "_".
+    team_name = project.split("_")[0]
+
+    # Assemble what should be the full path of the Arduino sketch in use
+    project_sketch = SKETCH_PATHS / ("bruker_disc_" + team_name)
+
+    # Glob whatever sketch is found inside the directory
+    arduino_sketches = [sketch for sketch in project_sketch.glob("*.ino")]
+
+    # If the length of the list for the sketch is greater than 1,
+    # something is wrong. Raise an exception.    
+    if len(arduino_sketches) > 1:
+        raise SketchError(
+        "Project has multiple Arduino sketches! Check your local bruker_control repo in your project's sketch folder."
+        )
+
+    # Otherwise, try to load the one present file. If it's not there,
+    # an index error occurs and an exception is raised.
+    else:
+        try:
+            arduino_sketch = arduino_sketches[0]
+
+        except IndexError:
+            raise SketchError(
+                "Project Arduino sketch is missing! Check your local bruker_control repo in your project's sketch folder."
+                )
+    
+    # Tell the user that their sketch was found.
+    # TODO This should all be piped to a logs file of some sort...
+    # and ideally it would all be part of the Arduino object...
+    print("Sketch found!")
+
+    return arduino_sketch
+
+
+def upload_arduino_sketch(project: str, boards: Optional[List[int]] = None) -> List[Arduino]:
+    """
+    Takes project name running experiment and finds sketch, uploads to boards.
+
+    Uses project name to grab .ino file for given team, compiles it, and
+    finally sends it to the Arduinos using the arduino-cli. The sketch is
+    compiled once for each kind of board (fqbn) and every board that needs
+    it is uploaded to at the same time.
+
+    Args:
+        project:
+            The team and project conducting the experiment (ie teamname_projectname)
+        boards:
+            Indices of the boards in find_boards() to upload to, board 0 if
+            None
+
+    Returns:
+        arduinos
+            Arduino object for each board, in the order given
+    """
+
+    arduino_sketch = find_project_sketch(project)
+
+    if boards is None:
+        boards = [0]
+
+    # Initialize Arduino objects
+    arduinos = [Arduino(arduino_sketch, idx) for idx in boards]
+
+    # Each board gets its own thread since arduino-cli mostly waits on the
+    # boards' serial ports
+    with ThreadPoolExecutor(max_workers=len(arduinos),
+                            thread_name_prefix="sketch_upload") as pool:
+
+        # Compiling and uploading takes a while and resets the board, so skip
+        # boards already running this exact build
+        firmware_current = list(pool.map(Arduino.firmware_is_current, arduinos))
+
+        stale = [
+            arduino for arduino, current in zip(arduinos, firmware_current)
+            if not current
+            ]
+
+        for arduino, current in zip(arduinos, firmware_current):
+            if current:
+                print(f"{arduino.board_name} on {arduino.board_com} is already running this sketch, skipping upload")
+
+        if not stale:
+            return arduinos
+
+        print(f"{len(stale)} board(s) need this sketch, compiling and uploading")
+
+        # Boards of the same kind share one build, so only compile it once
+        builds = {}
+
+        for arduino in stale:
+            builds.setdefault(arduino.fqbn, arduino)
+
+        list(pool.map(Arduino.compile_sketch, builds.values()))
+
+        for arduino in stale:
+            arduino.build_dir = builds[arduino.fqbn].build_dir
+
+        list(pool.map(Arduino.upload_sketch, stale))
+
+    return arduinos
+
+
+def transfer_data(arduino_metadata: str, experiment_arrays: list,
+                  transfer_mode: str = "windowed",
+                  telemetry_path: Optional[Path] = None,
+                  port: Optional[str] = None,
+                  session: Optional[SerialSession] = None) -> Optional[TelemetryReader]:
+    """
+    Sends metadata and trial information to the Arduino.
+
+    Takes each array assembled for transmission to the Arduino and stuffs it
+    into packets to be sent via pySerialTransfer. Unites several functions used
+    for transmitting, receiving, and checking data during transfer.
+
+    Args:
+        arduino_metadata:
+            Metadata gathered from config_template that's relevant for Arduino
+            runtime. Formatted as a json string.
+        experiment_arrays:
+            List of arrays generated for a given microscopy session's behavior.
+            0th index is trialArray, 1st is ITIArray, 2nd is toneArray, and 3rd
+            is the LEDArray.
+        transfer_mode:
+            Either "windowed" (default) for pipelined chunk transfers,
+            "onepacket" for the original one array per packet transfer, or
+            "streaming" to stream trials during the session.
+        telemetry_path:
+            Path of the session's binary event log. If given, the link is kept
+            open and the Arduino's behavior events are recorded until the
+            returned reader is stopped.
+        port:
+            Port to talk to the board on instead of the registered link port,
+            like an arduino_emulator pty. Any port is accepted, even ones
+            pyserial doesn't list.
+        session:
+            SerialSession to borrow the link from instead of opening and
+            closing a new one for this transfer
+
+    Returns:
+        telemetry_reader
+            Running TelemetryReader if telemetry_path was given or trials are
+            streamed, else None. A TransferError is raised if the data can't
+            be sent intact.
+    """
+
+    # Errors aren't caught here. Failed transfers raise TransferError for the
+    # caller to retry, and anything else means the board or port is unusable.
+    session_upload = SessionUpload(
+        arduino_metadata,
+        experiment_arrays,
+        transfer_mode,
+        port=port,
+        session=session
+        )
+
+    return session_upload.transfer(telemetry_path)
+
+
+def transfer_data_boards(board_data: dict, transfer_mode: str = "windowed",
+                         telemetry_paths: Optional[dict] = None,
+                         sessions: Optional[dict] = None) -> dict:
+    """
+    Sends each board its own metadata and trial information at the same time.
+
+    Every board gets an independent transfer with its own link, retries and
+    packet log, run on a thread pool. A board that fails doesn't stop the
+    others, its error is kept on its SessionUpload instead.
+
+    Args:
+        board_data:
+            Dictionary of link port: (arduino_metadata, experiment_arrays)
+            for each board, with ports like those from board_link_port()
+        transfer_mode:
+            Either "windowed" (default), "onepacket" or "streaming"
+        telemetry_paths:
+            Dictionary of link port: path of that board's binary event log,
+            for the boards whose behavior events should be recorded
+        sessions:
+            Dictionary of link port: SerialSession to borrow each board's
+            link from. Boards without one get a one off session.
+
+    Returns:
+        board_transfers
+            Dictionary of link port: (session_upload, telemetry_reader). A
+            failed board's telemetry_reader is None and its session_upload's
+            error is set.
+    """
+
+    telemetry_paths = telemetry_paths or {}
+
+    sessions = sessions or {}
+
+    session_uploads = {
+        port: SessionUpload(
+            arduino_metadata,
+            experiment_arrays,
+            transfer_mode,
+            port=port,
+            session=sessions.get(port)
+            )
+        for port, (arduino_metadata, experiment_arrays) in board_data.items()
+        }
+
+    board_transfers = {}
+
+    with ThreadPoolExecutor(max_workers=len(session_uploads),
+                            thread_name_prefix="board_transfer") as pool:
+
+        futures = {
+            port: pool.submit(session_upload.transfer, telemetry_paths.get(port))
+            for port, session_upload in session_uploads.items()
+            }
+
+        for port, future in futures.items():
+
+            session_upload = session_uploads[port]
+
+            # Keep going with the other boards if this one failed
+            try:
+                telemetry_reader = future.result()
+
+            except Exception as error:
+
+                if session_upload.error is None:
+                    session_upload.error = error
+
+                telemetry_reader = None
+
+            board_transfers[port] = (session_upload, telemetry_reader)
+
+    for port, (session_upload, _) in board_transfers.items():
+
+        if session_upload.error is not None:
+            print(f"{port}: FAILED, {session_upload.error}")
+
+        else:
+            print(f"{port}: sent in {session_upload.upload_s:.2f} s")
+
+    return board_transfers
+
+
+def end_transfer(session: SerialSession, own_session: bool):
+    """
+    Closes a one off session's link or releases a persistent session's link.
+
+    Args:
+        session:
+            SerialSession the transfer borrowed its link from
+        own_session:
+            Whether the session was only opened for this transfer
+    """
+
+    if own_session:
+        session.close()
+
+    else:
+        session.release()
+
+
+def transfer_experiment_arrays(experiment_arrays: list,
+                               link: txfer.SerialTransfer,
+                               transfer_mode: str = "windowed"):
+    """
+    Transfers experimental arrays to Arduino via pySerialTransfer.
+
+    Determines what type of packet transfer is required for the generated
+    trials. Windowed transfers pipeline small chunks of every array regardless
+    of session length. One packet transfers send each array in a single
+    packet, so sessions longer than ONEPACKET_MAX_TRIALS are sent windowed
+    instead.
+
+    Args:
+        experiment_arrays:
+            List of arrays generated for a given microscopy session's behavior.
+            0th index is trialArray, 1st is ITIArray, 2nd is toneArray, 3rd is
+            the LEDArray.
+        link:
+            pySerialTransfer transmission object
+        transfer_mode:
+            Either "windowed" or "onepacket"
+    """
+
+    # Tell the Arduino how wide and long each array is before sending any
+    transfer_array_encodings(experiment_arrays, link)
+
+    if transfer_mode == "onepacket" and len(experiment_arrays[0]) > ONEPACKET_MAX_TRIALS:
+
+        print(
+            f"Sessions over {ONEPACKET_MAX_TRIALS} trials don't fit in one "
+            "packet per array, sending windowed instead"
+            )
+
+        transfer_mode = "windowed"
+
+    if transfer_mode == "windowed":
+
+        windowed_transfer(experiment_arrays, link)
+
+    else:
+
+        onepacket_transfer(experiment_arrays, link)
+
+
+###############################################################################
+# Serial Transfer to Arduino: Error Checking
+###############################################################################
+
+
+def array_error_check(transmitted_array: list, received_array: list):
+    """
+    Performs Python side error checking for array transmission.
+
+    While pySerialTransfer performs error checking for different errors, this
+    allows for something simple that is independent of the package for error
+    checking. Arrays are verified by comparing CRC32 digests rather than the
+    arrays themselves, but any two values can be compared.
+
+    Args:
+        transmitted_array:
+            Array (or digest of the array) that was sent to the Arduino
+        received_array:
+            Array (or digest of the array) that was received by the Arduino
+    """
+
+    # If the transmitted array and received array are equal
+    if transmitted_array == received_array:
+
+        pass
+
+    # If the transmission failed, let the caller decide whether to resend
+    else:
+
+        raise TransferError(
+            f"sent {transmitted_array}, Arduino received {received_array}"
+            )
+
+
+###############################################################################
+# Serial Transfer to Arduino: One Packet
+###############################################################################
+
+
+# -----------------------------------------------------------------------------
+# Transfer Digests
+# -----------------------------------------------------------------------------
+
+
+def array_encoding(array: list) -> tuple:
+    """
+    Finds the narrowest encoding that holds every value of an array.
+
+    Trial types fit in one byte and most durations fit in two, so most
+    arrays take a half or a quarter of the bytes int32 values would.
+
+    Args:
+        array:
+            Experimental array to be transferred
+
+    Returns:
+        (struct format character, numpy dtype) pair from ARRAY_ENCODINGS
+    """
+
+    # Empty arrays hold nothing, so any encoding works
+    if len(array) == 0:
+        return ARRAY_ENCODINGS[0]
+
+    array_min = min(array)
+    array_max = max(array)
+
+    for encoding in ARRAY_ENCODINGS:
+
+        dtype_info = np.iinfo(encoding[1])
+
+        if dtype_info.min <= array_min and array_max <= dtype_info.max:
+            return encoding
+
+    raise ValueError(
+        f"Array values from {array_min} to {array_max} don't fit in 32 bits"
+        )
+
+
+def array_bytes(array: list) -> bytes:
+    """
+    Packs an experiment array the same way it's laid out on the wire.
+
+    Arrays are sent little-endian in the narrowest encoding that holds them,
+    so their CRC32 digests are computed over exactly these bytes.
+
+    Args:
+        array:
+            Experimental array to be transferred
+
+    Returns:
+        Packed bytes of the array
+    """
+
+    return np.asarray(array, dtype=array_encoding(array)[1]).tobytes()
+
+
+def verify_session_digest(metadata_payload: bytes, experiment_arrays: list,
+                          link: txfer.SerialTransfer,
+                          block_payloads: Optional[List[bytes]] = None):
+    """
+    Checks the Arduino's CRC32 digests against locally computed ones.
+
+    Requests the Arduino's running CRC32 of each array and of the whole
+    session, meaning the metadata followed by every array and then every
+    streamed trial block in order. This costs 20 bytes instead of a second
+    copy of every array. A mismatch raises a TransferError naming the array
+    that didn't match.
+
+    Args:
+        metadata_payload:
+            Bytes of the metadata packet returned by transfer_metadata()
+        experiment_arrays:
+            List of arrays generated for a given microscopy session's behavior.
+            0th index is trialArray, 1st is ITIArray, 2nd is toneArray, 3rd is
+            the LEDArray.
+        link:
+            pySerialTransfer transmission object
+        block_payloads:
+            Payloads of the trial blocks sent before a streamed session
+    """
+
+    # Send a single byte so the request isn't an empty packet
+    request_reply(link, bytes(1), DIGEST_PACKET_ID)
+
+    # Start the session digest with the metadata, then fold in every array
+    session_digest = zlib.crc32(metadata_payload)
+
+    for array_idx, array in enumerate(experiment_arrays):
+
+        packed_array = array_bytes(array)
+
+        rxdigest = link.rx_obj(obj_type='I', start_pos=array_idx * 4)
+
+        try:
+            array_error_check(zlib.crc32(packed_array), rxdigest)
+
+        except TransferError as error:
+            raise TransferError(
+                f"Digest of experiment array {array_idx} doesn't match, {error.message}"
+                )
+
+        session_digest = zlib.crc32(packed_array, session_digest)
+
+    for block_payload in block_payloads or []:
+        session_digest = zlib.crc32(block_payload, session_digest)
+
+    rxsession_digest = link.rx_obj(
+        obj_type='I',
+        start_pos=len(experiment_arrays) * 4
+        )
+
+    try:
+        array_error_check(session_digest, rxsession_digest)
+
+    except TransferError as error:
+        raise TransferError(f"Session digest doesn't match, {error.message}")
+
+    print("Transfer digests verified!")
+
+
+# -----------------------------------------------------------------------------
+# Describe the Experiment Arrays
+# -----------------------------------------------------------------------------
+
+
+def experiment_array_bytes(experiment_arrays: list) -> int:
+    """
+    Counts how many bytes the experiment arrays take on the Arduino.
+
+    Args:
+        experiment_arrays:
+            List of arrays generated for a given microscopy session's behavior
+
+    Returns:
+        Bytes the arrays take in their narrowest encodings
+    """
+
+    return sum(
+        struct.calcsize(array_encoding(array)[0]) * len(array)
+        for array in experiment_arrays
+        )
+
+
+def transfer_array_encodings(experiment_arrays: list,
+                             link: txfer.SerialTransfer):
+    """
+    Tells the Arduino the width and length of every experiment array.
+
+    The Arduino lays the arrays out in one shared pool of bytes, so it needs
+    to know how big each one is before any of them arrive. The header is one
+    width byte (B) and one length (H) for each array. The Arduino replies
+    whether they all fit and how big its pool is.
+
+    Args:
+        experiment_arrays:
+            List of arrays generated for a given microscopy session's behavior.
+            0th index is trialArray, 1st is ITIArray, 2nd is toneArray, 3rd is
+            the LEDArray.
+        link:
+            pySerialTransfer transmission object
+    """
+
+    encoding_payload = b""
+    session_bytes = 0
+
+    for array in experiment_arrays:
+
+        width = struct.calcsize(array_encoding(array)[0])
+
+        encoding_payload += struct.pack("<BH", width, len(array))
+
+        session_bytes += width * len(array)
+
+    encoding_reply = request_reply(
+        link,
+        encoding_payload,
+        ARRAY_ENCODING_PACKET_ID
+        )
+
+    accepted, pool_bytes = struct.unpack("<BH", encoding_reply[:3])
+
+    print(f"Experiment arrays take {session_bytes} of {pool_bytes} bytes")
+
+    # Resending won't make the arrays fit on the board
+    if not accepted:
+
+        raise TransferError("Experiment arrays don't fit on the Arduino")
+
+
+# -----------------------------------------------------------------------------
+# Send an Individual Packet
+# -----------------------------------------------------------------------------
+
+
+def transfer_packet(array: list, packet_id: int, link: txfer.SerialTransfer):
+    """
+    Transfers an individual packet to the Arduino.
+
+    Each packet is given a unique ID the Arduino can identify and transmitted
+    through the pySerialTransfer link. While the link is unavailable, that is
+    there's an active transfer, the function passes. When finished
+    transmitting, the function receives the CRC32 of what the Arduino stored
+    and an error check is performed. If it passes, the program continues.  If
+    it fails, the packet is resent like any other. The Arduino replaces a
+    resent array in the session digest instead of folding it in twice. If
+    every attempt fails, a TransferError is raised.
+
+    Args:
+        array:
+            Experimental array to be transferred
+        packet_id:
+            Unique ID for encoding an array
+        link:
+            pySerialTransfer transmission object
+    """
+
+    # Pack the array in its narrowest encoding
+    packed_array = array_bytes(array)
+
+    # Send the array and check the digest of what the Arduino stored
+    request_reply(
+        link,
+        packed_array,
+        packet_id,
+        check=lambda reply: array_error_check(
+            zlib.crc32(packed_array),
+            struct.unpack("<I", reply[:4])[0]
+            )
+        )
+
+
+# -----------------------------------------------------------------------------
+# Configuration/Metadata File Transfer
+# -----------------------------------------------------------------------------
+
+
+def encode_metadata(arduino_metadata: dict) -> bytes:
+    """
+    Packs Arduino metadata into bytes according to METADATA_SCHEMA.
+
+    Args:
+        arduino_metadata:
+            Dictionary of relevant Arduino metadata for experiment
+
+    Returns:
+        metadata_payload
+            Bytes of the metadata packet as the Arduino's struct lays them out
+    """
+
+    return METADATA_STRUCT.pack(
+        *[arduino_metadata[name] for name, _, _ in METADATA_SCHEMA]
+        )
+
+
+def decode_metadata(metadata_payload: bytes) -> dict:
+    """
+    Unpacks a metadata packet according to METADATA_SCHEMA.
+
+    Args:
+        metadata_payload:
+            Bytes of a metadata packet, like the one the Arduino echoes back
+
+    Returns:
+        metadata
+            Dictionary of each field in the schema and its value
+    """
+
+    # A short or long echo means the board's struct doesn't match the schema
+    if len(metadata_payload) != METADATA_STRUCT.size:
+        raise TransferError(
+            f"Expected {METADATA_STRUCT.size} bytes of metadata, "
+            f"received {len(metadata_payload)}! Is the sketch's "
+            "metadata_struct out of date?"
+            )
+
+    return dict(
+        zip(
+            [name for name, _, _ in METADATA_SCHEMA],
+            METADATA_STRUCT.unpack(metadata_payload)
+            )
+        )
+
+
+def metadata_error_check(transmitted_metadata: dict, received_metadata: dict):
+    """
+    Performs Python side error checking for metadata transmission.
+
+    Every field in METADATA_SCHEMA is compared, and any that don't match are
+    reported in a TransferError.
+
+    Args:
+        transmitted_metadata:
+            Metadata that was sent to the Arduino
+        received_metadata:
+            Metadata that was received by the Arduino
+    """
+
+    mismatched_fields = [
+        name for name, _, _ in METADATA_SCHEMA
+        if transmitted_metadata[name] != received_metadata[name]
+        ]
+
+    # If every field matches, there's nothing to do
+    if not mismatched_fields:
+
+        pass
+
+    # If the transmission failed, report every field that didn't make it
+    else:
+
+        raise TransferError(
+            ", ".join(
+                f"{name} sent as {transmitted_metadata[name]}, "
+                f"received as {received_metadata[name]}"
+                for name in mismatched_fields
+                )
+            )
+
+
+def metadata_c_struct() -> str:
+    """
+    Generates the Arduino's metadata_struct from METADATA_SCHEMA.
+
+    Paste the output into a sketch whenever the schema changes so the board
+    unpacks the metadata the same way Python packs it.
+
+    Returns:
+        c_struct
+            C declaration of metadata_struct and its metadata instance
+    """
+
+    # Line up the comments the same way the sketches do
+    declarations = [
+        f"{C_TYPES[field_format]} {name};"
+        for name, field_format, _ in METADATA_SCHEMA
+        ]
+
+    comment_column = max(len(declaration) for declaration in declarations) + 1
+
+    lines = ["struct __attribute__((__packed__)) metadata_struct {"]
+
+    for declaration, (_, _, description) in zip(declarations, METADATA_SCHEMA):
+        lines.append(
+            f"  {declaration:<{comment_column}}// {description}"
+            )
+
+    lines.append("} metadata;")
+
+    return "\n".join(lines)
+
+
+def transfer_metadata(arduino_metadata: str, link: txfer.SerialTransfer):
+    """
+    Transfers arduino_metadata to the Arduino.
+
+    Arduino metadata collected from config_template is formatted into a json
+    string that the Arduino knows how to interpret.  Each variable is encoded
+    according to a specific byte size depending on the variable type. The
+    Arduino restarts its transfer whenever metadata arrives, so it's safe to
+    send again.
+
+    Args:
+        arduino_metadata:
+            Metadata gathered from config_template that's relevant for Arduino
+            runtime. Formatted as a json string.
+        link:
+            pySerialTransfer transmission object
+
+    Returns:
+        metadata_payload
+            Bytes of the metadata packet for the session digest
+    """
+
+    # Pack every field at once with the schema's precompiled struct
+    metadata_payload = encode_metadata(arduino_metadata)
+
+    # Send the metadata to the Arduino.  The metadata is transferred first
+    # and therefore receives the packet_id of 0. The Arduino's echo is decoded
+    # with the same schema and every field has to make it intact, otherwise
+    # the metadata is sent again.
+    request_reply(
+        link,
+        metadata_payload,
+        METADATA_PACKET_ID,
+        check=lambda reply: metadata_error_check(
+            arduino_metadata,
+            decode_metadata(reply)
+            )
+        )
+
+    return metadata_payload
+
+
+# -----------------------------------------------------------------------------
+# Trial Array Transfers: One Packet
+# -----------------------------------------------------------------------------
+
+
+def onepacket_transfer(experiment_arrays: list, link: txfer.SerialTransfer):
+    """
+    Function for completing experiment arrays one packet transfers to Arduino.
+
+    Iterates over transfer_packet() function for each experiment array and
+    invoked if the session length is at most ONEPACKET_MAX_TRIALS trials.
+
+    Args:
+        experiment_arrays:
+            List of arrays generated for a given microscopy session's behavior.
+            0th index is trialArray, 1st is ITIArray, 2nd is toneArray.
+        link:
+            pySerialTransfer transmission object
+    """
+
+    # Start out transmission with packet_id of 1.  The 0th packet is the
+    # arduino_metadata variable
+    packet_id = 1
+
+    # For each array in the list of arrays defining trial data
+    for array in experiment_arrays:
+
+        # Transfer the packet
+        transfer_packet(array, packet_id, link)
+
+        packet_id += 1
+
+
+###############################################################################
+# Serial Transfer to Arduino: Windowed
+###############################################################################
+
+
+# -----------------------------------------------------------------------------
+# Trial Array Splitting for Windowed Transfers
+# -----------------------------------------------------------------------------
+
+
+def split_array_chunks(experiment_arrays: list) -> List[tuple]:
+    """
+    Splits every experiment array into sequenced chunks for windowed transfer.
+
+    Chunks are numbered with one sequence shared across all arrays so the
+    window never has to drain between the end of one array and the start of
+    the next. Each chunk also carries which array it belongs to and the
+    element offset its values start at so the Arduino knows where to put them.
+    Values are packed in their array's narrowest encoding, so narrow arrays
+    need fewer chunks.
+
+    Args:
+        experiment_arrays:
+            List of arrays generated for a given microscopy session's behavior.
+            0th index is trialArray, 1st is ITIArray, 2nd is toneArray, 3rd is
+            the LEDArray.
+
+    Returns:
+        List of (sequence, array index, offset, packed values) tuples
+    """
+
+    chunks = []
+
+    for array_idx, array in enumerate(experiment_arrays):
+
+        packed_array = array_bytes(array)
+
+        # Each chunk holds as many whole values as fit in CHUNK_BYTES
+        width = struct.calcsize(array_encoding(array)[0])
+
+        chunk_length = CHUNK_BYTES // width
+
+        for offset in range(0, len(array), chunk_length):
+            chunks.append(
+                (
+                    len(chunks),
+                    array_idx,
+                    offset,
+                    packed_array[offset * width:(offset + chunk_length) * width]
+                )
+            )
+
+    # Sequence numbers are sent as a single byte
+    if len(chunks) > 0xFF:
+        raise ValueError(
+            f"Session requires {len(chunks)} chunks, but only 255 can be sequenced"
+            )
+
+    return chunks
+
+
+# -----------------------------------------------------------------------------
+# Send an Individual Chunk
+# -----------------------------------------------------------------------------
+
+
+def send_chunk(chunk: tuple, link: txfer.SerialTransfer):
+    """
+    Stuffs one chunk and its header into the TX buffer and sends it.
+
+    The header is the sequence number (B), array index (B), and element offset
+    (H) followed by the chunk's packed values. The Arduino does NOT echo the
+    chunk back, it only replies with a cumulative acknowledgement.
+
+    Args:
+        chunk:
+            (sequence, array index, offset, packed values) tuple from
+            split_array_chunks()
+        link:
+            pySerialTransfer transmission object
+    """
+
+    seq, array_idx, offset, values = chunk
+
+    chunk_size = 0
+    chunk_size = link.tx_obj(seq,       chunk_size, val_type_override='B')
+    chunk_size = link.tx_obj(array_idx, chunk_size, val_type_override='B')
+    chunk_size = link.tx_obj(offset,    chunk_size, val_type_override='H')
 
-        link.send(second_array_size, packet_id=packet_id)
+    # Values are already packed, so place them straight in the buffer
+    link.txBuff[chunk_size:chunk_size + len(values)] = values
+    chunk_size += len(values)
 
-        while not link.available():
-            pass
+    link.send(chunk_size, packet_id=CHUNK_PACKET_ID)
 
-        second_rxarray = link.rx_obj(obj_type=type(new_array[1]),
-                                     obj_byte_size=second_array_size,
-                                     list_format='i')
 
-        # print(second_rxarray)
-        # Close the communication link
-        link.close()
+# -----------------------------------------------------------------------------
+# Trial Array Transfers: Windowed
+# -----------------------------------------------------------------------------
 
-    except KeyboardInterrupt:
-        try:
-            link.close()
-        except:
-            pass
 
-    except:
-        import traceback
-        traceback.print_exc()
+def windowed_transfer(experiment_arrays: list, link: txfer.SerialTransfer,
+                      window_size: int = WINDOW_SIZE):
+    """
+    Transfers experiment arrays with several chunks in flight at once.
 
-        try:
-            link.close()
-        except:
-            pass
+    Instead of sending a whole array and waiting for the Arduino to echo all
+    of it back, up to window_size chunks are sent before Python waits. The
+    Arduino accepts chunks in order and replies to each one with the next
+    sequence number it expects, so one short acknowledgement covers every
+    chunk before it. If the oldest unacknowledged chunk times out, only the
+    unacknowledged chunks are sent again.
+
+    Args:
+        experiment_arrays:
+            List of arrays generated for a given microscopy session's behavior.
+            0th index is trialArray, 1st is ITIArray, 2nd is toneArray, 3rd is
+            the LEDArray.
+        link:
+            pySerialTransfer transmission object
+        window_size:
+            Number of chunks allowed in flight, 1 to wait on every chunk
+    """
+
+    chunks = split_array_chunks(experiment_arrays)
+
+    # Oldest chunk that hasn't been acknowledged yet
+    base = 0
+
+    # Next chunk to put on the wire
+    next_seq = 0
+
+    # Time the oldest unacknowledged chunk was sent
+    base_sent = time.perf_counter()
+
+    retransmissions = 0
+
+    while base < len(chunks):
+
+        # Fill the window
+        while next_seq < len(chunks) and next_seq < base + window_size:
+
+            send_chunk(chunks[next_seq], link)
+
+            if next_seq == base:
+                base_sent = time.perf_counter()
+
+            next_seq += 1
+
+        # Acknowledgements carry the next sequence the Arduino expects, so
+        # everything before it has been received.
+        if link.available() and link.idByte == CHUNK_ACK_PACKET_ID:
+
+            ack = link.rx_obj(obj_type='B')
+
+            if ack > base:
+                base = ack
+                base_sent = time.perf_counter()
+
+                # The budget is for each chunk, not the whole transfer
+                retransmissions = 0
+
+        # If the oldest chunk has timed out, go back and resend it along with
+        # everything after it that's also unacknowledged.
+        elif time.perf_counter() - base_sent > CHUNK_TIMEOUT:
+
+            retransmissions += 1
+
+            if retransmissions > MAX_RETRANSMISSIONS:
+
+                raise TransferError(
+                    f"Chunk {base} was not acknowledged after "
+                    f"{MAX_RETRANSMISSIONS} retransmissions"
+                    )
+
+            print(f"Retransmitting from chunk {base}")
+
+            next_seq = base
+
+
+###############################################################################
+# Serial Transfer to Arduino: Streaming
+###############################################################################
+
+
+def stream_trials(experiment_arrays: list) -> Iterator[tuple]:
+    """
+    Generates each trial's values in the order the Arduino plays them.
+
+    The LEDArray only lists stimulation delays for LED trials, which the
+    sketches step through one LED trial at a time. Streamed trials carry their
+    own LED delay instead, 0 for trials without LED stimulation.
+
+    Args:
+        experiment_arrays:
+            List of arrays generated for a given microscopy session's behavior.
+            0th index is trialArray, 1st is ITIArray, 2nd is toneArray, 3rd is
+            the LEDArray.
+
+    Returns:
+        Generator of (trial type, ITI, tone duration, LED delay) tuples
+    """
+
+    trial_array, iti_array, tone_array, led_array = experiment_arrays
+
+    led_delays = iter(led_array)
+
+    for trial_type, iti, tone_duration in zip(trial_array, iti_array, tone_array):
+
+        # Trial types above 3 are LED trials
+        led_delay = next(led_delays, 0) if trial_type > 3 else 0
+
+        yield trial_type, iti, tone_duration, led_delay
+
+
+###############################################################################
+# Serial Transfer to Arduino: Clock Sync
+###############################################################################
+
+
+def arduino_to_host(micros: np.ndarray, clock_model: dict) -> np.ndarray:
+    """
+    Places Arduino micros() timestamps on the host's perf_counter() timeline.
+
+    Timestamps have to be in the order they happened, like the events in a
+    telemetry log, so that micros() wrapping past 32 bits can be undone.
+
+    Args:
+        micros:
+            Arduino micros() timestamps, ie a telemetry log's micros column
+        clock_model:
+            Model from ClockSync.fit(), or the session config's clock_sync
+
+    Returns:
+        Host times in seconds
+    """
+
+    micros = np.asarray(micros, dtype=np.int64)
+
+    # Every step backwards from the first probe on is micros() wrapping
+    steps = np.diff(micros, prepend=clock_model["ref_micros"])
+
+    unwrapped = micros + np.cumsum(steps < 0) * 2**32
+
+    arduino_s = (unwrapped - clock_model["ref_micros"]) / 1e6
+
+    return clock_model["ref_host_s"] + arduino_s * (1 + clock_model["drift_ppm"] / 1e6)
 
 
 ###############################################################################
@@ -725,8 +3555,9 @@ def update_python_status(packet_id: int, link: txfer.SerialTransfer):
 
     Once the packets have all been transmitted to the Arduino, this final step
     is performed to ensure that all information has made it across the link.
-    Once this check is passed, the connection to the Arduino closes and the
-    experiment will start!
+    Once this check is passed, the experiment will start! The status is
+    resent if its confirmation doesn't arrive. An Arduino that has already
+    started its session confirms a resent status again without restarting.
 
     Args:
         packet_id:
@@ -735,43 +3566,488 @@ def update_python_status(packet_id: int, link: txfer.SerialTransfer):
             pySerialTransfer transmission object
     """
 
-    try:
+    status = 1
 
-        status = 1
+    print("Sending END OF TRANSMISSION Status")
 
-        # Stuff packet with size of trialArray
-        status_size = link.tx_obj(status)
+    # Send the status and check the Arduino's confirmation
+    request_reply(
+        link,
+        struct.pack("<i", status),
+        packet_id,
+        check=lambda reply: array_error_check(
+            status,
+            struct.unpack("<i", reply[:4])[0]
+            )
+        )
 
-        # Send array
-        link.send(status_size, packet_id=packet_id)
+    print("Received END OF TRANSMISSION Status")
 
-        print("Sent END OF TRANSMISSION Status")
 
-        while not link.available():
-            pass
+###############################################################################
+# Serial Link: Baud Rate Negotiation
+###############################################################################
 
-        # Receive trial array:
-        rxarray = link.rx_obj(obj_type=type(status),
-                              obj_byte_size=status_size,
-                              list_format='i')
 
-        print("Received END OF TRANSMISSION Status")
+def wait_for_packet(link: txfer.SerialTransfer, packet_id: int,
+                    timeout: float = REPLY_TIMEOUT) -> bool:
+    """
+    Waits for a packet with the given ID to arrive from the Arduino.
 
-        array_error_check(status, rxarray)
+    Packets with other IDs and packets that fail pySerialTransfer's CRC are
+    skipped.
 
-        link.close()
+    Args:
+        link:
+            pySerialTransfer transmission object
+        packet_id:
+            ID of the packet that's expected
+        timeout:
+            Seconds to wait before giving up
 
-    except KeyboardInterrupt:
-        try:
-            link.close()
-        except:
-            pass
+    Returns:
+        Whether the packet arrived in time
+    """
+
+    deadline = time.perf_counter() + timeout
+
+    while time.perf_counter() < deadline:
+        if link.available() and link.idByte == packet_id:
+            return True
+
+    return False
+
+
+def request_reply(link: txfer.SerialTransfer, payload: bytes, packet_id: int,
+                  check=None, attempts: int = MAX_PACKET_ATTEMPTS) -> bytes:
+    """
+    Sends a packet and waits for the Arduino's reply, resending if needed.
+
+    Only this packet is sent again if its reply doesn't arrive within
+    REPLY_TIMEOUT or the check rejects it. Resends wait RETRY_BACKOFF at
+    first and twice as long each time after that. If every attempt fails, a
+    TransferError is raised.
+
+    Args:
+        link:
+            pySerialTransfer transmission object
+        payload:
+            Bytes to send
+        packet_id:
+            ID to send the packet with
+        check:
+            Function given the reply's bytes that raises a TransferError if
+            the reply is wrong
+        attempts:
+            Number of times to send the packet before giving up
+
+    Returns:
+        Bytes of the reply
+    """
+
+    name = PACKET_NAMES.get(packet_id, str(packet_id))
+
+    reply_id = REPLY_PACKET_IDS.get(packet_id, packet_id)
+
+    backoff = RETRY_BACKOFF
+
+    for attempt in range(1, attempts + 1):
+
+        # Sending stuffs the TX buffer in place, so fill it every attempt
+        link.txBuff[:len(payload)] = payload
 
-    except:
-        import traceback
-        traceback.print_exc()
+        link.send(len(payload), packet_id=packet_id)
 
         try:
-            link.close()
-        except:
-            pass
+            if not wait_for_packet(link, reply_id):
+                raise TransferError(f"No reply to {name} packet")
+
+            reply = bytes(link.rxBuff[:link.bytesRead])
+
+            if check is not None:
+                check(reply)
+
+            return reply
+
+        except TransferError as error:
+
+            print(f"Transmission Error! {error.message} (attempt {attempt} of {attempts})")
+
+            if attempt == attempts:
+                raise TransferError(
+                    f"{name} packet failed after {attempts} attempts: {error.message}"
+                    )
+
+            time.sleep(backoff)
+
+            backoff *= 2
+
+
+def loopback_test(link: txfer.SerialTransfer,
+                  num_packets: int = LOOPBACK_PACKETS,
+                  payload_size: int = LOOPBACK_PAYLOAD) -> dict:
+    """
+    Measures throughput and error rate of the link at its current baud rate.
+
+    Sends packets of random bytes that the Arduino echoes back unchanged.
+    Any echo that's lost, fails its CRC, or doesn't match what was sent is
+    counted as an error.
+
+    Args:
+        link:
+            pySerialTransfer transmission object
+        num_packets:
+            Number of loopback packets to send
+        payload_size:
+            Number of random bytes in each packet
+
+    Returns:
+        Dictionary with the baud rate, bytes_per_s moved in both directions,
+        and the error_rate
+    """
+
+    rng = np.random.default_rng()
+
+    errors = 0
+
+    start = time.perf_counter()
+
+    for _ in range(num_packets):
+
+        payload = rng.integers(0, 256, payload_size).tolist()
+
+        # pySerialTransfer never stuffs a START_BYTE in the first position of
+        # a payload, which garbles the packet. Keep it out of there so only
+        # the link itself is being tested.
+        if payload[0] == txfer.START_BYTE:
+            payload[0] = 0
+
+        # Raw bytes don't need packing, so place them straight in the buffer
+        link.txBuff[:payload_size] = payload
+
+        link.send(payload_size, packet_id=LOOPBACK_PACKET_ID)
+
+        if not wait_for_packet(link, LOOPBACK_PACKET_ID):
+            errors += 1
+
+        elif link.rxBuff[:payload_size] != payload:
+            errors += 1
+
+    elapsed = time.perf_counter() - start
+
+    good_packets = num_packets - errors
+
+    return {
+        "baud": link.connection.baudrate,
+        "bytes_per_s": 2 * good_packets * payload_size / elapsed,
+        "error_rate": errors / num_packets
+    }
+
+
+def change_link_baud(link: txfer.SerialTransfer, baud: int) -> bool:
+    """
+    Moves both ends of the link to a new baud rate.
+
+    Asks the Arduino to switch rates at the current rate, switches Python's
+    side once the Arduino acknowledges, and confirms the link with a loopback
+    packet. If anything fails the Arduino falls back to BASE_BAUD by itself
+    after BAUD_FALLBACK seconds, so Python does the same.
+
+    Args:
+        link:
+            pySerialTransfer transmission object
+        baud:
+            Baud rate to switch to
+
+    Returns:
+        Whether the link is working at the new rate
+    """
+
+    if link.connection.baudrate == baud:
+        return True
+
+    baud_size = link.tx_obj(baud, val_type_override='I')
+
+    link.send(baud_size, packet_id=BAUD_PACKET_ID)
+
+    if wait_for_packet(link, BAUD_PACKET_ID):
+
+        link.connection.baudrate = baud
+
+        # Give the Arduino a moment to restart its serial port
+        time.sleep(0.05)
+
+        if loopback_test(link, num_packets=1)["error_rate"] == 0:
+            return True
+
+    print(f"Could not use {baud} baud, falling back to {BASE_BAUD}")
+
+    time.sleep(BAUD_FALLBACK)
+
+    link.connection.baudrate = BASE_BAUD
+
+    link.connection.reset_input_buffer()
+
+    return False
+
+
+def benchmark_baud_rates(link: txfer.SerialTransfer,
+                         bauds: List[int] = CANDIDATE_BAUDS) -> List[dict]:
+    """
+    Runs a loopback test at each candidate baud rate.
+
+    Always returns the link to BASE_BAUD when finished.
+
+    Args:
+        link:
+            pySerialTransfer transmission object opened at BASE_BAUD
+        bauds:
+            Baud rates to test
+
+    Returns:
+        List of loopback_test() results, one for each baud rate
+    """
+
+    results = []
+
+    for baud in bauds:
+
+        if change_link_baud(link, baud):
+            results.append(loopback_test(link))
+
+        else:
+            results.append({"baud": baud, "bytes_per_s": 0.0, "error_rate": 1.0})
+
+        change_link_baud(link, BASE_BAUD)
+
+    return results
+
+
+def baud_cache_key(port: str) -> str:
+    """
+    Finds the key a link's negotiated baud rate is cached under.
+
+    The link runs through a UART converter on the BRUKER rig, so the rate is
+    cached under the board that converter is registered to as a link. Links
+    without a registered board are keyed by their own USB device, and ports
+    without one, like an arduino_emulator pty, by the port itself.
+
+    Args:
+        port:
+            Port the link is open on, ie COM12
+
+    Returns:
+        Board's VID:PID:serial registry key, else the link's key or port
+    """
+
+    link_key = port_key(port)
+
+    if link_key is None:
+        return port
+
+    for board_key, board in read_board_registry().items():
+        if board.get("link") == link_key:
+            return board_key
+
+    return link_key
+
+
+def read_baud_cache() -> dict:
+    """
+    Reads the negotiated baud rates cached for each board.
+
+    Returns:
+        Dictionary of baud_cache_key(): baud rate pairs
+    """
+
+    if BAUD_CACHE.exists():
+        with open(BAUD_CACHE, 'r') as inFile:
+            return json.load(inFile)
+
+    return {}
+
+
+def write_baud_cache(baud_cache: dict):
+    """
+    Writes the negotiated baud rates for each board to disk.
+
+    Args:
+        baud_cache:
+            Dictionary of baud_cache_key(): baud rate pairs
+    """
+
+    CACHE_PATH.mkdir(parents=True, exist_ok=True)
+
+    with open(BAUD_CACHE, 'w') as outFile:
+        json.dump(baud_cache, outFile, indent=4)
+
+
+def negotiate_baud(link: txfer.SerialTransfer) -> int:
+    """
+    Finds the fastest baud rate the link can sustain without errors.
+
+    Steps up through the candidate rates, stopping at the first one that
+    makes errors twice in a row, and caches the fastest error free rate for
+    the board.
+
+    Args:
+        link:
+            pySerialTransfer transmission object opened at BASE_BAUD
+
+    Returns:
+        Fastest reliable baud rate
+    """
+
+    print("Negotiating baud rate...")
+
+    best_baud = BASE_BAUD
+
+    for baud in CANDIDATE_BAUDS:
+
+        # The chosen rate is cached for good, so one burst of noise gets a
+        # second try before the rate is given up on
+        for attempt in range(2):
+
+            result = benchmark_baud_rates(link, [baud])[0]
+
+            print(
+                f"{baud} baud: {result['bytes_per_s']:.0f} bytes/s, "
+                f"{result['error_rate']:.1%} errors"
+                )
+
+            if result["error_rate"] == 0:
+                break
+
+        if result["error_rate"] > 0:
+            break
+
+        best_baud = baud
+
+    with CACHE_LOCK:
+        baud_cache = read_baud_cache()
+        baud_cache[baud_cache_key(link.port_name)] = best_baud
+        write_baud_cache(baud_cache)
+
+    print(f"Using {best_baud} baud")
+
+    return best_baud
+
+
+def use_negotiated_baud(link: txfer.SerialTransfer, forget_failed: bool = True):
+    """
+    Switches the link to the board's cached baud rate, negotiating it first
+    if the board hasn't been seen before.
+
+    If the cached rate stops working, the link stays at BASE_BAUD and the
+    board's cache entry is dropped so it's negotiated again next time.
+
+    Args:
+        link:
+            pySerialTransfer transmission object opened at BASE_BAUD
+        forget_failed:
+            Whether to drop the board's cache entry if its rate doesn't work
+    """
+
+    cache_key = baud_cache_key(link.port_name)
+
+    baud_cache = read_baud_cache()
+
+    if cache_key in baud_cache:
+        baud = baud_cache[cache_key]
+
+    else:
+        baud = negotiate_baud(link)
+
+    if not change_link_baud(link, baud) and forget_failed:
+
+        with CACHE_LOCK:
+
+            baud_cache = read_baud_cache()
+
+            baud_cache.pop(cache_key, None)
+
+            write_baud_cache(baud_cache)
+
+
+###############################################################################
+# Main Function
+###############################################################################
+
+
+if __name__ == "__main__":
+
+    # Create argument parser for benchmarking the serial link
+    benchmark_parser = argparse.ArgumentParser(
+        description='Benchmark the Arduino serial link at each baud rate',
+        prog='Bruker Serial Benchmark'
+    )
+
+    # Add port argument
+    benchmark_parser.add_argument(
+        '--port',
+        type=str,
+        action='store',
+        dest='port',
+        help="Port the Arduino's link is on (default from the board registry)",
+        default=None,
+        required=False
+    )
+
+    # Add link port argument
+    benchmark_parser.add_argument(
+        '--register_link',
+        type=str,
+        action='store',
+        dest='register_link',
+        help="Register the UART converter on this port as the board's link",
+        default=None,
+        required=False
+    )
+
+    # Add negotiate flag
+    benchmark_parser.add_argument(
+        '--negotiate',
+        action='store_true',
+        dest='negotiate',
+        help='Also negotiate and cache the fastest reliable rate (bool flag)',
+        required=False
+    )
+
+    # Add metadata struct flag
+    benchmark_parser.add_argument(
+        '--metadata_struct',
+        action='store_true',
+        dest='metadata_struct',
+        help="Print the sketch's metadata_struct generated from the schema and exit (bool flag)",
+        required=False
+    )
+
+    benchmark_args = vars(benchmark_parser.parse_args())
+
+    if benchmark_args["metadata_struct"]:
+        print(metadata_c_struct())
+        sys.exit()
+
+    if benchmark_args["register_link"]:
+        register_link_port(benchmark_args["register_link"])
+
+    link = txfer.SerialTransfer(
+        benchmark_args["port"] or get_link_port(),
+        BASE_BAUD,
+        debug=False
+        )
+
+    link.open()
+
+    print(f"{'Baud':>10} {'Bytes/s':>12} {'Error Rate':>12}")
+
+    for result in benchmark_baud_rates(link):
+        print(
+            f"{result['baud']:>10} {result['bytes_per_s']:>12.0f} "
+            f"{result['error_rate']:>12.1%}"
+            )
+
+    if benchmark_args["negotiate"]:
+        negotiate_baud(link)
+
+    link.close()
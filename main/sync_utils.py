@@ -0,0 +1,499 @@
+# Bruker 2-Photon Sync Utils
+# Lines up each session's behavior events, video frames and 2P frames on one
+# timeline once the session's recordings are on disk.
+
+###############################################################################
+# Import Packages
+###############################################################################
+
+# Import serialtransfer_utils for the telemetry log format and clock model
+import serialtransfer_utils
+
+# Import config_utils for reading the session's configuration file
+import config_utils
+
+# Import video_utils for reading raw recordings that aren't transcoded yet
+import video_utils
+
+# Import numpy for aligning the streams
+import numpy as np
+
+# Import OpenCV2 for counting the frames written to the session's video
+import cv2
+
+# Import ElementTree for reading Prairie View's T-Series frame times
+import xml.etree.ElementTree as ElementTree
+
+# Import pathlib for building each stream's path
+from pathlib import Path
+
+# Import datetime for finding today's session files
+from datetime import datetime
+
+# Import Optional for appropriate typehinting of functions
+from typing import Optional
+
+# Sync indices are written beside the session's configuration file on the Raw
+# Data volume on the machine BRUKER which is mounted to E:
+DATA_PATH = Path("E:/")
+
+# Index given to an event that happened before the first frame of a stream
+BEFORE_FIRST_FRAME = -1
+
+# Telemetry event codes by name, looked up from serialtransfer_utils so they
+# always match the codes the sketches send
+EVENT_CODES = {
+    name: code for code, name in serialtransfer_utils.TELEMETRY_EVENTS.items()
+    }
+
+# Telemetry event that marks the start of the T-Series, ie 2P frame time 0
+TRIGGER_EVENT = EVENT_CODES["bruker_trigger"]
+
+# Telemetry event sent at the start of every trial
+TRIAL_START_EVENT = EVENT_CODES["trial_start"]
+
+###############################################################################
+# Exceptions
+###############################################################################
+
+
+class SyncError(Exception):
+    """
+    Exception for when a session's streams can't be found or aligned.
+    """
+    def __init__(self, *args):
+        if args:
+            self.message = args[0]
+        else:
+            self.message = None
+
+    def __str__(self):
+        if self.message:
+            return "SyncError: " + "{0}".format(self.message)
+        else:
+            return "SYNC ERROR"
+
+###############################################################################
+# Functions
+###############################################################################
+
+# -----------------------------------------------------------------------------
+# Session Paths
+# -----------------------------------------------------------------------------
+
+
+def session_paths(project: str, subject_id: str, current_plane: int,
+                  imaging_plane: str, session_date: Optional[str] = None) -> dict:
+    """
+    Builds the paths of everything recorded during a session.
+
+    Files are named the same way the rest of bruker_control names them, so a
+    past session can be synced again by giving its date.
+
+    Args:
+        project:
+            The team and project conducting the experiment (ie teamname_projectname)
+        subject_id:
+            The subject being recorded
+        current_plane:
+            Current plane being imaged as in 1st, 2nd, 3rd, etc
+        imaging_plane:
+            Plane 2P images were acquired at, the Z-axis value
+        session_date:
+            Session's date as YYYYMMDD, today if None
+
+    Returns:
+        Dictionary of config, telemetry, video, raw_video, microscopy and sync
+        paths
+    """
+
+    # Gather session date using datetime
+    if session_date is None:
+        session_date = datetime.today().strftime("%Y%m%d")
+
+    # Set session name by joining variables with underscores
+    session_name = "_".join(
+        [session_date, subject_id, "plane{}".format(current_plane), imaging_plane]
+        )
+
+    project_dir = DATA_PATH / project
+
+    return {
+        "config": project_dir / "config" / (session_name + "_config.json"),
+        "telemetry": (
+            serialtransfer_utils.TELEMETRY_PATH / project / "telemetry"
+            / (session_name + "_events.bin")
+            ),
+        "video": project_dir / "video" / (session_name + ".mp4"),
+        "raw_video": project_dir / "video" / (session_name + ".raw"),
+        "microscopy": project_dir / "microscopy" / (session_name + "_raw"),
+        "sync": project_dir / "config" / (session_name + "_sync.npz"),
+    }
+
+
+def find_tseries_xml(tseries_prefix: Path) -> Path:
+    """
+    Finds the Prairie View metadata file written for a T-Series.
+
+    Prairie View appends the file iteration to the T-Series name, ie
+    name-001/name-001.xml. If the plane was recorded more than once, the last
+    recording is used.
+
+    Args:
+        tseries_prefix:
+            Microscopy directory joined with the T-Series name
+
+    Returns:
+        Path of the T-Series' .xml file
+    """
+
+    xml_paths = sorted(
+        xml_path
+        for xml_path in tseries_prefix.parent.glob(tseries_prefix.name + "*/*.xml")
+        if xml_path.stem == xml_path.parent.name
+        )
+
+    if not xml_paths:
+        raise SyncError(f"No T-Series found for {tseries_prefix}")
+
+    return xml_paths[-1]
+
+# -----------------------------------------------------------------------------
+# Stream Readers
+# -----------------------------------------------------------------------------
+
+
+def read_tseries_frame_times(xml_path: Path) -> np.ndarray:
+    """
+    Reads each 2P frame's time from Prairie View's T-Series metadata.
+
+    Frame times are relative to the T-Series' input trigger. The file is read
+    incrementally since long sessions have hundreds of thousands of frames.
+
+    Args:
+        xml_path:
+            Path of the T-Series' .xml file
+
+    Returns:
+        Seconds since the trigger of every 2P frame
+    """
+
+    frame_times = []
+
+    for _, element in ElementTree.iterparse(str(xml_path)):
+
+        if element.tag == "Frame":
+            frame_times.append(float(element.get("relativeTime")))
+
+            # Frames hold per frame settings that aren't needed here
+            element.clear()
+
+    return np.asarray(frame_times, dtype=np.float64)
+
+
+def count_video_frames(video_path: Path, raw_path: Optional[Path] = None) -> int:
+    """
+    Counts the frames written to a session's video.
+
+    Raw recordings are synced before they're transcoded, so their frames are
+    counted from the raw file's header while it's still there.
+
+    Args:
+        video_path:
+            Path of the session's .mp4
+        raw_path:
+            Path of the session's raw recording, if it may have one
+
+    Returns:
+        Number of frames in the video
+    """
+
+    if raw_path is not None:
+
+        # The transcode removes the raw file once the .mp4 is finished
+        try:
+            raw_video = video_utils.RawVideo(raw_path, create=False)
+
+            num_frames = len(raw_video)
+
+            raw_video.close()
+
+            return num_frames
+
+        except FileNotFoundError:
+            pass
+
+    video = cv2.VideoCapture(str(video_path))
+
+    if not video.isOpened():
+        raise SyncError(f"Couldn't open {video_path}")
+
+    num_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    video.release()
+
+    return num_frames
+
+
+def read_telemetry_log(telemetry_path: Path) -> np.ndarray:
+    """
+    Reads a session's binary behavior event log.
+
+    Args:
+        telemetry_path:
+            Path written by serialtransfer_utils.TelemetryReader
+
+    Returns:
+        Array of serialtransfer_utils.TELEMETRY_DTYPE events, in order
+    """
+
+    if not telemetry_path.exists():
+        raise SyncError(f"No behavior events recorded at {telemetry_path}")
+
+    return np.fromfile(str(telemetry_path), dtype=serialtransfer_utils.TELEMETRY_DTYPE)
+
+# -----------------------------------------------------------------------------
+# Alignment
+# -----------------------------------------------------------------------------
+
+
+def camera_frame_triggers(num_video_frames: int, dropped_frames: list) -> np.ndarray:
+    """
+    Finds the 2P frame that triggered each frame written to the video.
+
+    The camera is triggered by every 2P frame, and capture_recording() notes
+    the trigger of every frame it fails to fetch. The frames written to the
+    video are the triggers that weren't dropped, in order.
+
+    Args:
+        num_video_frames:
+            Number of frames in the session's video
+        dropped_frames:
+            Dropped frames from video_utils.capture_recording()
+
+    Returns:
+        2P frame index of every video frame
+    """
+
+    num_triggers = num_video_frames + len(dropped_frames)
+
+    triggers = np.delete(
+        np.arange(num_triggers, dtype=np.int64),
+        np.asarray(dropped_frames, dtype=np.int64)
+        )
+
+    return triggers[:num_video_frames]
+
+
+def events_to_tseries(events: np.ndarray, clock_model: Optional[dict] = None) -> np.ndarray:
+    """
+    Places behavior events on the T-Series' timeline.
+
+    Arduino timestamps are corrected for the board's drift with the session's
+    clock model, then made relative to the Bruker trigger event. Sessions
+    recorded before the trigger was logged are lined up on their first
+    trial instead, which starts within a loop of the trigger.
+
+    Args:
+        events:
+            Array of serialtransfer_utils.TELEMETRY_DTYPE events, in order
+        clock_model:
+            Session's clock_sync from its configuration file, the Arduino's
+            clock is taken as is if None
+
+    Returns:
+        Seconds since the trigger of every event
+    """
+
+    triggers = np.flatnonzero(events["event"] == TRIGGER_EVENT)
+
+    if triggers.size == 0:
+
+        triggers = np.flatnonzero(events["event"] == TRIAL_START_EVENT)
+
+        if triggers.size == 0:
+            raise SyncError("No trigger or trial start events to line the session up on")
+
+        print("No Bruker trigger event recorded, lining up on the first trial")
+
+    if clock_model is None:
+        clock_model = {
+            "ref_micros": int(events["micros"][0]),
+            "ref_host_s": 0.0,
+            "drift_ppm": 0.0,
+        }
+
+    host_s = serialtransfer_utils.arduino_to_host(events["micros"], clock_model)
+
+    return host_s - host_s[triggers[0]]
+
+
+def frame_at(frame_times: np.ndarray, times: np.ndarray) -> np.ndarray:
+    """
+    Finds the frame being acquired at each time.
+
+    Args:
+        frame_times:
+            Sorted start time of every frame
+        times:
+            Times to look up, on the same timeline
+
+    Returns:
+        Index of the latest frame started at or before each time, or
+        BEFORE_FIRST_FRAME
+    """
+
+    frames = np.searchsorted(frame_times, times, side="right") - 1
+
+    # NaN times, like trials that never started, sort past the last frame
+    frames[np.isnan(times)] = BEFORE_FIRST_FRAME
+
+    return frames
+
+
+def build_sync_index(events: np.ndarray, tseries_times: np.ndarray,
+                     num_video_frames: int, dropped_frames: list,
+                     experiment_arrays: list,
+                     clock_model: Optional[dict] = None) -> dict:
+    """
+    Maps behavior events, camera frames and 2P frames onto one timeline.
+
+    The timeline is seconds since the T-Series' trigger. Every event and trial
+    is also given the 2P frame and video frame it happened during, so that
+    analysis can index straight into the recordings. The experiment arrays
+    are stored under their configuration names alongside.
+
+    Args:
+        events:
+            Array of serialtransfer_utils.TELEMETRY_DTYPE events, in order
+        tseries_times:
+            Seconds since the trigger of every 2P frame
+        num_video_frames:
+            Number of frames in the session's video
+        dropped_frames:
+            Dropped frames from video_utils.capture_recording()
+        experiment_arrays:
+            trialArray, ITIArray, toneArray and LEDArray from the session's
+            configuration
+        clock_model:
+            Session's clock_sync from its configuration file
+
+    Returns:
+        Dictionary of numpy arrays, ready for np.savez
+    """
+
+    # Camera frames share their trigger's time. Frames triggered after the
+    # last 2P frame was recorded have no time.
+    camera_tseries_frame = camera_frame_triggers(num_video_frames, dropped_frames)
+
+    camera_times = np.full(num_video_frames, np.nan)
+
+    recorded = camera_tseries_frame < len(tseries_times)
+
+    camera_times[recorded] = tseries_times[camera_tseries_frame[recorded]]
+
+    event_times = events_to_tseries(events, clock_model)
+
+    # Trials are numbered by their trial start event
+    num_trials = len(experiment_arrays[0])
+
+    trial_times = np.full(num_trials, np.nan)
+
+    starts = events[events["event"] == TRIAL_START_EVENT]["trial"].astype(np.int64)
+
+    in_session = starts < num_trials
+
+    trial_times[starts[in_session]] = event_times[events["event"] == TRIAL_START_EVENT][in_session]
+
+    event_codes = np.array(sorted(serialtransfer_utils.TELEMETRY_EVENTS), dtype=np.uint8)
+
+    return {
+        "tseries_frame_s": tseries_times,
+        "camera_frame_s": camera_times,
+        "camera_tseries_frame": camera_tseries_frame,
+        "event": events["event"],
+        "event_trial": events["trial"],
+        "event_value": events["value"],
+        "event_s": event_times,
+        "event_tseries_frame": frame_at(tseries_times, event_times),
+        "event_camera_frame": frame_at(camera_times[recorded], event_times),
+        "trialArray": np.asarray(experiment_arrays[0], dtype=np.int64),
+        "ITIArray": np.asarray(experiment_arrays[1], dtype=np.int64),
+        "toneArray": np.asarray(experiment_arrays[2], dtype=np.int64),
+        "LEDArray": np.asarray(experiment_arrays[3], dtype=np.int64),
+        "trial_start_s": trial_times,
+        "trial_tseries_frame": frame_at(tseries_times, trial_times),
+        "trial_camera_frame": frame_at(camera_times[recorded], trial_times),
+        "event_codes": event_codes,
+        "event_names": np.array(
+            [serialtransfer_utils.TELEMETRY_EVENTS[code] for code in event_codes]
+            ),
+    }
+
+
+def write_sync_index(sync_index: dict, sync_path: Path):
+    """
+    Writes a sync index to disk.
+
+    Load it back with np.load(sync_path), no pickling needed.
+
+    Args:
+        sync_index:
+            Dictionary of numpy arrays from build_sync_index()
+        sync_path:
+            Path of the .npz to write
+    """
+
+    with open(sync_path, "wb") as sync_file:
+        np.savez_compressed(sync_file, **sync_index)
+
+
+def sync_session(project: str, subject_id: str, current_plane: int,
+                 imaging_plane: str, session_date: Optional[str] = None) -> Path:
+    """
+    Builds and writes the sync index of a finished session.
+
+    Runs after the session's configuration file is written, which holds the
+    trial arrays, dropped frames and clock model.
+
+    Args:
+        project:
+            The team and project conducting the experiment (ie teamname_projectname)
+        subject_id:
+            The subject being recorded
+        current_plane:
+            Current plane being imaged as in 1st, 2nd, 3rd, etc
+        imaging_plane:
+            Plane 2P images were acquired at, the Z-axis value
+        session_date:
+            Session's date as YYYYMMDD, today if None
+
+    Returns:
+        Path the sync index was written to
+    """
+
+    paths = session_paths(project, subject_id, current_plane, imaging_plane, session_date)
+
+    beh_metadata = config_utils.read_config(paths["config"])["beh_metadata"]
+
+    experiment_arrays = [
+        beh_metadata["trialArray"],
+        beh_metadata["ITIArray"],
+        beh_metadata["toneArray"],
+        beh_metadata["LEDArray"],
+    ]
+
+    sync_index = build_sync_index(
+        read_telemetry_log(paths["telemetry"]),
+        read_tseries_frame_times(find_tseries_xml(paths["microscopy"])),
+        count_video_frames(paths["video"], paths["raw_video"]),
+        beh_metadata["dropped_frames"],
+        experiment_arrays,
+        beh_metadata.get("clock_sync")
+        )
+
+    write_sync_index(sync_index, paths["sync"])
+
+    print("Sync index written to", paths["sync"])
+
+    return paths["sync"]
@@ -17,7 +17,7 @@ import cv2
 from datetime import datetime
 
 # Import Tuple for appropriate typehinting of functions
-from typing import Tuple
+from typing import Tuple, Optional
 
 # Import tqdm for progress bar
 from tqdm import tqdm
@@ -25,12 +25,32 @@ from tqdm import tqdm
 # Import pathlib Path for directory management
 from pathlib import Path
 
-# Import sys for exiting safely
+# Import os and sys for lowering transcodes' priority and exiting safely
+import os
 import sys
 
 # Import numpy for drawing lines on preview image
 import numpy as np
 
+# Import threading, queue and itertools for fetching frames apart from the
+# display
+import threading
+import queue
+import itertools
+
+# Import multiprocessing for encoding video in its own process
+import multiprocessing
+
+# Import time for measuring how far behind each recording stage runs
+import time
+
+# Import ctypes for the shared memory frame ring's element types
+import ctypes
+
+# Import struct and shutil for raw video files' headers and disk space
+import struct
+import shutil
+
 # Import warnings to ignore deprecation warning from skvideo
 import warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -58,17 +78,822 @@ SCALING_FACTOR = 50
 IMSHOW_X_POS = 1920
 IMSHOW_Y_POS = 450
 
+# Frames are held in a shared memory ring this many slots long until they're
+# encoded. The fetch thread never waits on it: a frame that doesn't fit is
+# dropped like a failed fetch, so the video stays lined up with dropped_frames.
+RING_FRAMES = 128
+
+# Frames shown per second by the live display. The display always shows the
+# newest frame, so this is only how smooth it looks.
+DISPLAY_RATE = 15
+
+# Seconds the display sleeps at most before checking the fetch thread
+DISPLAY_TIMEOUT = 0.1
+
+# Frames held for the preview, which only ever shows the newest
+PREVIEW_RING_FRAMES = 4
+
+# The preview's grid splits the image into this many rows and columns
+PREVIEW_GRID_ROWS = 8
+PREVIEW_GRID_COLS = 8
+
+# Recordings are either encoded to .mp4 as they're captured, or written raw
+# to a memory mapped file and transcoded to .mp4 in the background afterwards
+RECORDING_MODES = ["encoded", "raw"]
+
+# Raw video files start with a header of the frame size, number of frames the
+# file holds, the framerate, and the number of frames actually written. The
+# header is padded so frames start on a page boundary.
+RAW_MAGIC = b"BRKRAW01"
+RAW_HEADER_STRUCT = struct.Struct("<8sIIIdQ")
+RAW_HEADER_SIZE = 4096
+
+# Raw recordings need this much more free space than their file's size, or
+# they're encoded as they're captured instead
+RAW_FREE_SPACE_MARGIN = 1.1
+
+# Transcodes run below the recording's CPU priority: BELOW_NORMAL_PRIORITY_CLASS
+# on Windows and this much niceness elsewhere
+BELOW_NORMAL_PRIORITY_CLASS = 0x4000
+TRANSCODE_NICENESS = 10
+
+# Raw recordings waiting to be or being transcoded, oldest first, see
+# start_transcode()
+_transcode_queue = []
+
+# Guards the queue and the thread working through it
+_transcode_lock = threading.Lock()
+
+# Thread transcoding the queue one recording at a time, None when it's empty
+_transcoder = None
+
 ###############################################################################
 # Classes
 ###############################################################################
 
 # class Camera GENI Cam Compliant machines etc
 
+
+class StageMetrics:
+    """
+    Queue depth and lag of one stage of the recording pipeline.
+
+    Depth is sampled each time a frame is handed to the stage and lag is
+    measured from the frame's fetch to when the stage finishes with it.
+    """
+
+    def __init__(self, name: str):
+        """
+        Args:
+            name:
+                Stage name printed in the summary
+        """
+
+        self.name = name
+
+        self.frames = 0
+        self.skipped = 0
+        self.overruns = 0
+
+        self.depth_total = 0
+        self.max_depth = 0
+
+        self.lag_total_s = 0.0
+        self.max_lag_s = 0.0
+
+    def queued(self, depth: int):
+        """
+        Records the stage's queue depth as a frame is handed to it.
+
+        Args:
+            depth:
+                Frames waiting in the stage's queue
+        """
+
+        self.depth_total += depth
+        self.max_depth = max(self.max_depth, depth)
+
+    def finished(self, fetch_s: float):
+        """
+        Records the lag of a frame the stage is finished with.
+
+        Args:
+            fetch_s:
+                perf_counter() when the frame was fetched
+        """
+
+        lag_s = time.perf_counter() - fetch_s
+
+        self.frames += 1
+        self.lag_total_s += lag_s
+        self.max_lag_s = max(self.max_lag_s, lag_s)
+
+    def merge(self, metrics: "StageMetrics"):
+        """
+        Takes on the lag recorded by another copy of the stage, ie the one
+        returned by the encoder process.
+
+        Args:
+            metrics:
+                StageMetrics recorded by the stage itself
+        """
+
+        self.frames = metrics.frames
+        self.overruns = metrics.overruns
+        self.lag_total_s = metrics.lag_total_s
+        self.max_lag_s = metrics.max_lag_s
+
+    def print_summary(self):
+        """
+        Prints the stage's frame counts, queue depth, and lag.
+        """
+
+        handed = max(self.frames + self.skipped, 1)
+
+        print(
+            f"  {self.name}: {self.frames} frames, {self.skipped} skipped, "
+            f"{self.overruns} overrun, "
+            f"depth {self.depth_total / handed:.1f} mean {self.max_depth} max, "
+            f"lag {1000 * self.lag_total_s / max(self.frames, 1):.1f} ms mean "
+            f"{1000 * self.max_lag_s:.1f} ms max"
+            )
+
+
+class FrameRing:
+    """
+    Ring of frame slots in shared memory, handed between processes by index.
+
+    Frames are written straight from the camera's buffer into a slot and read
+    in place by the encoder, display, or any analysis process, so they never
+    have to be pickled. Each slot holds the sequence number of the frame in it,
+    which readers check before and after using a frame to catch it being
+    overwritten underneath them.
+
+    Only the encoder holds slots: a slot isn't reused until the encoder
+    releases it. Other readers fall behind at their own risk. A ring that
+    isn't held, like the preview's, just overwrites its oldest slot.
+
+    Attributes:
+        num_slots:
+            Number of frames the ring holds
+        height:
+            Frame height (pixels)
+        width:
+            Frame width (pixels)
+    """
+
+    # Sequence number of a slot that's empty or being written
+    EMPTY = -1
+
+    def __init__(self, num_slots: int, height: int, width: int, held: bool = True):
+        """
+        Args:
+            num_slots:
+                Number of frames the ring holds
+            height:
+                Frame height (pixels), from the camera's Height node
+            width:
+                Frame width (pixels), from the camera's Width node
+            held:
+                Whether slots wait for the encoder to release them
+        """
+
+        self.num_slots = num_slots
+        self.height = height
+        self.width = width
+        self.held = held
+
+        # Python 3.7 has no multiprocessing.shared_memory. RawArrays are
+        # shared with child processes the same way, without any locking.
+        self._frames = multiprocessing.RawArray(ctypes.c_uint8, num_slots * height * width)
+        self._sequences = multiprocessing.RawArray(ctypes.c_int64, [self.EMPTY] * num_slots)
+        self._frame_numbers = multiprocessing.RawArray(ctypes.c_int64, num_slots)
+        self._fetch_s = multiprocessing.RawArray(ctypes.c_double, num_slots)
+
+        # Frames written to the ring and released by the encoder so far
+        self._written = multiprocessing.RawValue(ctypes.c_int64, 0)
+        self._released = multiprocessing.RawValue(ctypes.c_int64, 0)
+
+        self._make_views()
+
+    def _make_views(self):
+        """
+        Views the shared arrays as numpy arrays without copying them.
+        """
+
+        self.frames = np.frombuffer(self._frames, dtype=np.uint8).reshape(
+            self.num_slots,
+            self.height,
+            self.width
+            )
+
+        self.sequences = np.frombuffer(self._sequences, dtype=np.int64)
+
+    def __getstate__(self) -> dict:
+        """
+        Sends only the shared arrays to a child process, not the views.
+        """
+
+        state = self.__dict__.copy()
+
+        del state["frames"]
+        del state["sequences"]
+
+        return state
+
+    def __setstate__(self, state: dict):
+        """
+        Views the shared arrays again in the child process.
+        """
+
+        self.__dict__.update(state)
+
+        self._make_views()
+
+    def pending(self) -> int:
+        """
+        Number of frames written that the encoder hasn't released.
+
+        Returns:
+            Frames the encoder is behind
+        """
+
+        return self._written.value - self._released.value
+
+    def full(self) -> bool:
+        """
+        Whether every slot is waiting on the encoder.
+
+        Returns:
+            True if a frame written now would overwrite one not yet encoded
+        """
+
+        return self.held and self.pending() >= self.num_slots
+
+    def write(self, frame_number: int, data: np.ndarray) -> int:
+        """
+        Copies a frame straight from the camera's buffer into the next slot.
+
+        Args:
+            frame_number:
+                Frame's place in the recording
+            data:
+                Harvester buffer's 1D payload
+
+        Returns:
+            Sequence number to read the frame back with
+        """
+
+        sequence = self._written.value
+
+        slot = sequence % self.num_slots
+
+        # Readers see the slot change before its frame does
+        self.sequences[slot] = self.EMPTY
+
+        np.copyto(self.frames[slot].reshape(-1), data)
+
+        self._frame_numbers[slot] = frame_number
+        self._fetch_s[slot] = time.perf_counter()
+
+        self.sequences[slot] = sequence
+
+        self._written.value = sequence + 1
+
+        return sequence
+
+    def latest(self) -> int:
+        """
+        Sequence number of the newest frame, or EMPTY if none are written.
+
+        Returns:
+            Newest sequence number
+        """
+
+        return self._written.value - 1
+
+    def read(self, sequence: int) -> Optional[Tuple[int, float, np.ndarray]]:
+        """
+        Gets a frame in place by its sequence number.
+
+        The frame isn't copied, so check valid() once finished with it.
+
+        Args:
+            sequence:
+                Sequence number from write()
+
+        Returns:
+            frame_number, fetch_s, frame
+                Or None if the frame was already overwritten
+        """
+
+        slot = sequence % self.num_slots
+
+        if self.sequences[slot] != sequence:
+            return None
+
+        return self._frame_numbers[slot], self._fetch_s[slot], self.frames[slot]
+
+    def valid(self, sequence: int) -> bool:
+        """
+        Whether a frame is still in its slot, ie wasn't overwritten while read.
+
+        Args:
+            sequence:
+                Sequence number from write()
+
+        Returns:
+            True if the frame hasn't been overwritten
+        """
+
+        return self.sequences[sequence % self.num_slots] == sequence
+
+    def release(self, sequence: int):
+        """
+        Lets the slot of an encoded frame, and every slot before it, be reused.
+
+        Args:
+            sequence:
+                Sequence number of the frame the encoder is finished with
+        """
+
+        self._released.value = sequence + 1
+
+
+class RawVideo:
+    """
+    Recording's frames written uncompressed to a memory mapped file.
+
+    The file is a RAW_HEADER_SIZE byte header followed by fixed size Mono8
+    frames, preallocated for the whole session. Writing a frame is one copy
+    from the camera's buffer, so recording never waits on an encoder. The file
+    is transcoded to .mp4 once the session's over with transcode_raw_video().
+
+    Frames are kept in the order they were written, so as in the .mp4, frames
+    in dropped_frames are left out. Frames are never overwritten, so a
+    RawVideo can be read by a LiveDisplay like a FrameRing.
+
+    Attributes:
+        height:
+            Frame height (pixels)
+        width:
+            Frame width (pixels)
+        num_slots:
+            Number of frames the file holds
+        framerate:
+            Microscope's framerate, used when transcoding
+    """
+
+    def __init__(self, raw_path: Path, height: int = 0, width: int = 0,
+                 num_slots: int = 0, framerate: float = 0.0, create: bool = True):
+        """
+        Args:
+            raw_path:
+                Path of the raw video file
+            height:
+                Frame height (pixels), from the camera's Height node
+            width:
+                Frame width (pixels), from the camera's Width node
+            num_slots:
+                Number of frames to make room for, ie from calculate_frames()
+            framerate:
+                Microscope's framerate from prairieview_utils
+            create:
+                Whether to create the file, or open a finished one to read
+        """
+
+        self.raw_path = Path(raw_path)
+
+        if create:
+
+            self.height = height
+            self.width = width
+            self.num_slots = num_slots
+            self.framerate = framerate
+
+            self._written = 0
+
+            # Setting the file's size reserves its space without writing it
+            # out, then the header's written at the start
+            with open(self.raw_path, "wb") as raw_file:
+                raw_file.truncate(raw_video_bytes(num_slots, height, width))
+                raw_file.write(self._header())
+
+            mode = "r+"
+
+        else:
+
+            with open(self.raw_path, "rb") as raw_file:
+                header = RAW_HEADER_STRUCT.unpack(raw_file.read(RAW_HEADER_STRUCT.size))
+
+            magic, self.height, self.width, self.num_slots, self.framerate, self._written = header
+
+            if magic != RAW_MAGIC:
+                raise RawVideoError(f"{self.raw_path} isn't a raw video")
+
+            mode = "r"
+
+        self.frames = np.memmap(
+            str(self.raw_path),
+            dtype=np.uint8,
+            mode=mode,
+            offset=RAW_HEADER_SIZE,
+            shape=(self.num_slots, self.height, self.width)
+            )
+
+        self._frame_numbers = np.zeros(self.num_slots, dtype=np.int64)
+        self._fetch_s = np.zeros(self.num_slots, dtype=np.float64)
+
+    def _header(self) -> bytes:
+        """
+        Packs the file's header with the number of frames written so far.
+
+        Returns:
+            Header bytes
+        """
+
+        return RAW_HEADER_STRUCT.pack(
+            RAW_MAGIC,
+            self.height,
+            self.width,
+            self.num_slots,
+            self.framerate,
+            self._written
+            )
+
+    def pending(self) -> int:
+        """
+        Frames waiting on an encoder, always 0 since there isn't one.
+
+        Returns:
+            0
+        """
+
+        return 0
+
+    def full(self) -> bool:
+        """
+        Whether every frame the file was made for has been written.
+
+        Returns:
+            True if there's no room for another frame
+        """
+
+        return self._written >= self.num_slots
+
+    def write(self, frame_number: int, data: np.ndarray) -> int:
+        """
+        Copies a frame straight from the camera's buffer into the file.
+
+        Args:
+            frame_number:
+                Frame's place in the recording
+            data:
+                Harvester buffer's 1D payload
+
+        Returns:
+            Sequence number to read the frame back with
+        """
+
+        sequence = self._written
+
+        np.copyto(self.frames[sequence].reshape(-1), data)
+
+        self._frame_numbers[sequence] = frame_number
+        self._fetch_s[sequence] = time.perf_counter()
+
+        self._written = sequence + 1
+
+        return sequence
+
+    def __len__(self) -> int:
+        """
+        Number of frames written.
+        """
+
+        return self._written
+
+    def latest(self) -> int:
+        """
+        Sequence number of the newest frame, or FrameRing.EMPTY if none are
+        written.
+
+        Returns:
+            Newest sequence number
+        """
+
+        return self._written - 1
+
+    def read(self, sequence: int) -> Optional[Tuple[int, float, np.ndarray]]:
+        """
+        Gets a frame in place by its sequence number.
+
+        Args:
+            sequence:
+                Sequence number from write()
+
+        Returns:
+            frame_number, fetch_s, frame
+                Or None if the frame hasn't been written
+        """
+
+        if not 0 <= sequence < self._written:
+            return None
+
+        return self._frame_numbers[sequence], self._fetch_s[sequence], self.frames[sequence]
+
+    def valid(self, sequence: int) -> bool:
+        """
+        Whether a frame has been written. Frames are never overwritten.
+
+        Args:
+            sequence:
+                Sequence number from write()
+
+        Returns:
+            True if the frame is in the file
+        """
+
+        return 0 <= sequence < self._written
+
+    def close(self):
+        """
+        Records how many frames were written in the header and closes the
+        file.
+        """
+
+        if self.frames.mode != "r":
+
+            self.frames.flush()
+
+            with open(self.raw_path, "r+b") as raw_file:
+                raw_file.write(self._header())
+
+        # Dropping the memmap unmaps the file
+        del self.frames
+
+
+class FrameFetcher(threading.Thread):
+    """
+    Fetches frames into a FrameRing, or a RawVideo, and hands their sequence
+    numbers to the encoder.
+
+    Fetching is the only work done here so that a slow encode or display
+    never delays the camera's buffers. Frames are never waited on: if the
+    ring is full of frames the encoder hasn't finished, the frame is dropped
+    and noted like a failed fetch. Without an encoder, as in the preview, the
+    oldest frames are simply overwritten.
+
+    Attributes:
+        dropped_frames:
+            Frame numbers that weren't written to the video
+        fetched:
+            Number of frames fetched so far
+    """
+
+    def __init__(self, camera: Harvester, num_frames: Optional[int], ring: FrameRing,
+                 encode_queue: Optional[multiprocessing.Queue] = None):
+        """
+        Args:
+            camera:
+                Started Harvester camera object
+            num_frames:
+                Number of frames to fetch, or None to fetch until stop()
+            ring:
+                FrameRing sized to the camera's frames, or the RawVideo being
+                recorded
+            encode_queue:
+                Queue read by encode_frames() in the encoder process, or None
+                if the frames aren't recorded
+        """
+
+        super().__init__(name="frame_fetcher", daemon=True)
+
+        self.camera = camera
+        self.num_frames = num_frames
+        self.ring = ring
+
+        self.encode_queue = encode_queue
+
+        self.encode_metrics = StageMetrics("encode")
+
+        self.dropped_frames = []
+        self.fetched = 0
+
+        self._stop_fetching = threading.Event()
+
+    def run(self):
+        """
+        Fetches every frame of the recording, or until stop() is called.
+        """
+
+        if self.num_frames is None:
+            frame_numbers = itertools.count()
+        else:
+            frame_numbers = range(self.num_frames)
+
+        for frame_number in frame_numbers:
+
+            if self._stop_fetching.is_set():
+                break
+
+            self.fetched += 1
+
+            # Introduce try/except block in case of dropped frames
+            try:
+
+                # Payload is 1D numpy array, copied into the ring since the
+                # buffer goes back to the camera
+                with self.camera.fetch() as buffer:
+
+                    if self.ring.full():
+                        sequence = None
+
+                    else:
+                        sequence = self.ring.write(
+                            frame_number,
+                            buffer.payload.components[0].data
+                            )
+
+            # TODO Raise warning for frame drops? What is this error...
+            except Exception:
+                self.dropped_frames.append(frame_number)
+                continue
+
+            self.encode_metrics.queued(self.ring.pending())
+
+            if sequence is None:
+                self.dropped_frames.append(frame_number)
+                self.encode_metrics.skipped += 1
+                continue
+
+            if self.encode_queue is not None:
+                self.encode_queue.put_nowait(sequence)
+
+    def stop(self):
+        """
+        Stops fetching after the current frame.
+        """
+
+        self._stop_fetching.set()
+
+
+class LiveDisplay:
+    """
+    Shows the newest frame in a FrameRing at a fixed rate.
+
+    The display never sees every frame: each time it's due, it takes only the
+    newest one, so acquisition runs at its own pace however slow drawing is.
+    Display dimensions and the downsized image's buffers are set up once.
+
+    Attributes:
+        metrics:
+            StageMetrics of the frames shown, the frames skipped between
+            them, and overruns
+        frame:
+            Preallocated downsized frame last shown, without the overlay
+        image:
+            Preallocated image last shown, the frame with the overlay
+        overlay_mask:
+            Display sized mask from grid_mask() that's 255 wherever the
+            overlay is drawn, or None
+    """
+
+    def __init__(self, window_name: str, ring: FrameRing,
+                 display_rate: float = DISPLAY_RATE):
+        """
+        Args:
+            window_name:
+                Name of the OpenCV window to show frames in
+            ring:
+                FrameRing the frames are fetched into
+            display_rate:
+                Frames shown per second at most
+        """
+
+        self.window_name = window_name
+        self.ring = ring
+        self.period_s = 1 / display_rate
+
+        # Resize image so it's not taking up the whole screen
+        # Define dimensions, width and height
+        imshow_width = int(ring.width * SCALING_FACTOR / 100)
+        imshow_height = int(ring.height * SCALING_FACTOR / 100)
+
+        self.imshow_dims = (imshow_width, imshow_height)
+
+        self.frame = np.zeros((imshow_height, imshow_width), dtype=np.uint8)
+        self.image = np.zeros((imshow_height, imshow_width), dtype=np.uint8)
+
+        self.metrics = StageMetrics("display")
+
+        self.overlay_mask = None
+
+        self._last_sequence = FrameRing.EMPTY
+        self._next_s = time.perf_counter()
+
+        cv2.namedWindow(window_name)
+        cv2.moveWindow(window_name, IMSHOW_X_POS, IMSHOW_Y_POS)
+
+    def wait(self, timeout: float = DISPLAY_TIMEOUT):
+        """
+        Sleeps until the next frame is due, for at most timeout seconds.
+
+        Args:
+            timeout:
+                Longest time to sleep, so callers can check on other things
+        """
+
+        time.sleep(min(max(self._next_s - time.perf_counter(), 0), timeout))
+
+    def update(self) -> Optional[int]:
+        """
+        Shows the ring's newest frame if one is due and hasn't been shown.
+
+        Returns:
+            Key pressed in the window, or None if nothing was shown
+        """
+
+        now = time.perf_counter()
+
+        if now < self._next_s:
+            return None
+
+        sequence = self.ring.latest()
+
+        if sequence == self._last_sequence:
+            return None
+
+        self._next_s = now + self.period_s
+
+        self.metrics.queued(sequence - self._last_sequence)
+
+        if self._last_sequence != FrameRing.EMPTY:
+            self.metrics.skipped += sequence - self._last_sequence - 1
+
+        self._last_sequence = sequence
+
+        frame = self.ring.read(sequence)
+
+        if frame is None:
+            self.metrics.overruns += 1
+            return None
+
+        _, fetch_s, content = frame
+
+        # Resize the image into the display buffer, interpolate to avoid
+        # distortion
+        cv2.resize(content, self.imshow_dims, dst=self.frame, interpolation=cv2.INTER_AREA)
+
+        # The display doesn't hold its slot, so make sure the frame wasn't
+        # replaced while it was resized
+        if not self.ring.valid(sequence):
+            self.metrics.overruns += 1
+            return None
+
+        # The overlay is burnt into a copy, leaving the frame itself clean
+        if self.overlay_mask is not None:
+            np.bitwise_or(self.frame, self.overlay_mask, out=self.image)
+            image = self.image
+
+        else:
+            image = self.frame
+
+        cv2.imshow(self.window_name, image)
+
+        self.metrics.finished(fetch_s)
+
+        return cv2.waitKey(1) % 0x100
+
+    def close(self):
+        """
+        Closes the display's window.
+        """
+
+        cv2.destroyWindow(self.window_name)
+
 ###############################################################################
 # Exceptions
 ###############################################################################
 
 
+class RawVideoError(Exception):
+    """
+    Exception for when a raw video file can't be read.
+    """
+    def __init__(self, *args):
+        if args:
+            self.message = args[0]
+        else:
+            self.message = None
+
+    def __str__(self):
+        if self.message:
+            return "RawVideoError: " + "{0}".format(self.message)
+        else:
+            return "RAW VIDEO ERROR"
+
+
 class CameraNotFound(Exception):
     """
     Exception class for if Python cannot find a connected GENTL camera.
@@ -91,6 +916,46 @@ class CameraNotFound(Exception):
 ###############################################################################
 
 
+def grid_mask(height: int, width: int, rows: int = PREVIEW_GRID_ROWS,
+              cols: int = PREVIEW_GRID_COLS) -> np.ndarray:
+    """
+    Builds a mask of evenly spaced grid lines for the preview.
+
+    Lines are placed as with np.linspace, one row or column apart and none on
+    the image's edges. Or the mask with an image to draw the grid on it.
+
+    Args:
+        height:
+            Height of the image the grid is drawn on (pixels)
+        width:
+            Width of the image the grid is drawn on (pixels)
+        rows:
+            Number of rows the grid splits the image into
+        cols:
+            Number of columns the grid splits the image into
+
+    Returns:
+        Mask that's 255 on the grid's lines and 0 elsewhere
+    """
+
+    # Define the distance between each row and column, dx, dy
+    dy, dx = height / rows, width / cols
+
+    # Start is dx away from 0, stop one dx before the end of the distance
+    # num is number of lines to draw
+    # From user mathandy at:
+    # https://stackoverflow.com/questions/44816682/drawing-grid-lines-across-the-image-using-opencv-python
+    x_positions = np.round(np.linspace(start=dx, stop=width - dx, num=cols - 1)).astype(int)
+    y_positions = np.round(np.linspace(start=dy, stop=height - dy, num=rows - 1)).astype(int)
+
+    mask = np.zeros((height, width), dtype=np.uint8)
+
+    mask[:, x_positions] = 255
+    mask[y_positions, :] = 255
+
+    return mask
+
+
 def init_camera_preview() -> Tuple[Harvester, Harvester, int, int]:
     """
     Creates, configures, describes, and starts harvesters camera object in
@@ -169,11 +1034,11 @@ def capture_preview(project, subject_id):
     Capture frames generated by camera object and display them in preview mode.
 
     Takes values from init_camera_preview() to capture images delivered by
-    camera buffer, reshapes the image to appropriate height and width, draws
-    a grid upon the preview
+    camera buffer in a FrameFetcher thread. The newest frame is downsized and
+    shown at DISPLAY_RATE with a precomputed grid laid over the preview.
     
     When user hits the 'Esc' key, the window closes and the camera object is destroyed.
-    Finally, the preview content is saved as an image that is timestamped with the day's
+    Finally, the preview content is saved without the grid as an image that is timestamped with the day's
     date and placed into the subject's metadata directory.
 
     Args:
@@ -185,54 +1050,40 @@ def capture_preview(project, subject_id):
     """
 
     h, camera, width, height = init_camera_preview()
-    preview_status = True
-    
-    # Define number of rows and columns to have in the preview grid
-    rows, cols = (8, 8)
 
-    # Define the distance between each row and column, dx, dy
-    dy, dx = height / rows, width / cols
+    # Frames are fetched in the background and only the newest is shown
+    ring = FrameRing(PREVIEW_RING_FRAMES, height, width, held=False)
+
+    fetcher = FrameFetcher(camera, None, ring)
+
+    live_display = LiveDisplay("Preview", ring)
+
+    # Draw a grid on the preview to help center the subject. It's drawn once
+    # at the display's size and laid over every downsized frame.
+    imshow_width, imshow_height = live_display.imshow_dims
 
-    # Define preview image show dimensions
-    imshow_width = int(width * SCALING_FACTOR / 100)
-    imshow_height = int(height * SCALING_FACTOR / 100)
-    imshow_dims = (imshow_width, imshow_height)
+    live_display.overlay_mask = grid_mask(imshow_height, imshow_width)
 
     print("To stop preview, hit 'Esc' key")
 
-    cv2.namedWindow("Preview")
-    cv2.moveWindow("Preview", IMSHOW_X_POS, IMSHOW_Y_POS)
-    while preview_status is True:
-        try:
-            with camera.fetch() as buffer:
-                # Define frame content with buffer.payload
-                content = buffer.payload.components[0].data.reshape(height,
-                                                                    width)
-                
-                # Draw lines along the rows
-                # Start is dx away from 0, stop one dx before the end of the distance
-                # num is number of lines to draw
-                # From user mathandy at:
-                # https://stackoverflow.com/questions/44816682/drawing-grid-lines-across-the-image-using-opencv-python
-                for x_position in np.linspace(start=dx, stop = width - dx, num = cols - 1):
-                    x = int(round(x_position))
-                    cv2.line(content, (x, 0), (x, height), color=(255,0,0), thickness = 2)
-
-                # Draw lines along the columns, same as x_position
-                for y_position in np.linspace(start=dy, stop = height - dy, num = rows -1):
-                    y = int(round(y_position))
-                    cv2.line(content, (0, y), (width, y), color=(255,0,0), thickness = 2)
-  
-                # resize image
-                resized = cv2.resize(content, imshow_dims, interpolation = cv2.INTER_AREA)
-                cv2.imshow("Preview", resized)
-                c = cv2.waitKey(1) % 0x100
-                if c == 27:
-                    preview_status = False
-
-        except:
-            pass
-    
+    fetcher.start()
+
+    while True:
+
+        live_display.wait()
+
+        if live_display.update() == 27:
+            break
+
+    # Preview frames keep coming, so the fetcher finishes within a frame
+    fetcher.stop()
+    fetcher.join()
+
+    live_display.close()
+
+    # Save the last frame shown without the grid
+    preview_image = live_display.frame.copy()
+
     # Get today's date
     session_date = datetime.today().strftime("%Y%m%d")
 
@@ -256,11 +1107,9 @@ def capture_preview(project, subject_id):
     # Write the image to subject directory
     cv2.imwrite(
         preview_fullpath,
-        resized
+        preview_image
         )
 
-    cv2.destroyAllWindows()
-
     # Shutdown the camera
     shutdown_camera(camera, h)
 
@@ -341,18 +1190,271 @@ def init_camera_recording() -> Tuple[Harvester, Harvester, int, int]:
     return h, camera, width, height
 
 
+def encode_frames(ring: FrameRing, encode_queue: multiprocessing.Queue,
+                  video_fullpath: str, framerate: float, width: int, height: int,
+                  metrics_connection):
+    """
+    Writes frames from the fetch thread to an .mp4 until told to stop.
+
+    Runs in its own process so H.264 encoding never competes with fetching
+    or the display for the interpreter. Frames are encoded straight out of
+    the shared ring and their slots released once written.
+
+    Args:
+        ring:
+            FrameRing the fetch thread writes to
+        encode_queue:
+            Queue of ring sequence numbers filled by a FrameFetcher, ending
+            with None
+        video_fullpath:
+            Path of the .mp4 to write
+        framerate:
+            Microscope's framerate from prairieview_utils used in the video codec
+        width:
+            Camera's width (pixels)
+        height:
+            Camera's height (pixels)
+        metrics_connection:
+            multiprocessing Pipe end the encoder's StageMetrics are sent on
+    """
+
+    metrics = StageMetrics("encode")
+
+    out = cv2.VideoWriter(
+        video_fullpath,
+        cv2.VideoWriter_fourcc(*"avc1"),
+        framerate,
+        (width, height),
+        isColor = False
+        )
+
+    while True:
+
+        sequence = encode_queue.get()
+
+        if sequence is None:
+            break
+
+        # Slots aren't reused until they're released, so this frame can't be
+        # overwritten unless the ring is misused
+        frame = ring.read(sequence)
+
+        if frame is None:
+            metrics.overruns += 1
+            continue
+
+        _, fetch_s, content = frame
+
+        # Write frame to disk
+        out.write(content)
+
+        ring.release(sequence)
+
+        metrics.finished(fetch_s)
+
+    # Release VideoWriter object
+    out.release()
+
+    metrics_connection.send(metrics)
+
+    metrics_connection.close()
+
+
+def raw_video_bytes(num_frames: int, height: int, width: int) -> int:
+    """
+    Calculates the size of a raw video file.
+
+    Args:
+        num_frames:
+            Number of frames the file holds
+        height:
+            Frame height (pixels)
+        width:
+            Frame width (pixels)
+
+    Returns:
+        File size in bytes
+    """
+
+    return RAW_HEADER_SIZE + num_frames * height * width
+
+
+def transcode_raw_video(raw_path: Path, video_path: Path, remove_raw: bool = True):
+    """
+    Encodes a raw video file to .mp4.
+
+    The .mp4 is written under a temporary name and only renamed once it's
+    finished, so a video at video_path is always complete. The raw file is
+    then removed unless asked not to.
+
+    Args:
+        raw_path:
+            Path of the raw video file
+        video_path:
+            Path of the .mp4 to write
+        remove_raw:
+            Whether to delete the raw file once it's transcoded
+    """
+
+    raw_video = RawVideo(raw_path, create=False)
+
+    partial_path = Path(video_path).with_suffix(".partial.mp4")
+
+    out = cv2.VideoWriter(
+        str(partial_path),
+        cv2.VideoWriter_fourcc(*"avc1"),
+        raw_video.framerate,
+        (raw_video.width, raw_video.height),
+        isColor = False
+        )
+
+    for sequence in range(len(raw_video)):
+        out.write(raw_video.frames[sequence])
+
+    # Release VideoWriter object
+    out.release()
+
+    num_frames = len(raw_video)
+
+    raw_video.close()
+
+    partial_path.replace(video_path)
+
+    if remove_raw:
+        Path(raw_path).unlink()
+
+    print(f"Transcoded {num_frames} frames to {video_path}")
+
+
+def lower_process_priority():
+    """
+    Lowers the calling process's CPU priority below the recording's, so it
+    only gets the time recording leaves free.
+    """
+
+    if sys.platform == "win32":
+        kernel32 = ctypes.windll.kernel32
+        kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), BELOW_NORMAL_PRIORITY_CLASS)
+
+    else:
+        os.nice(TRANSCODE_NICENESS)
+
+
+def _low_priority_transcode(raw_path: Path, video_path: Path):
+    """
+    Runs transcode_raw_video() at a lowered priority, in a transcode process.
+
+    Args:
+        raw_path:
+            Path of the raw video file
+        video_path:
+            Path of the .mp4 to write
+    """
+
+    lower_process_priority()
+
+    transcode_raw_video(raw_path, video_path)
+
+
+def _run_transcodes():
+    """
+    Transcodes queued raw recordings one at a time until the queue is empty.
+    """
+
+    global _transcoder
+
+    while True:
+
+        # Recordings stay queued until they're transcoded
+        with _transcode_lock:
+
+            if not _transcode_queue:
+                _transcoder = None
+                return
+
+            raw_path, video_path = _transcode_queue[0]
+
+        transcode = multiprocessing.Process(
+            target=_low_priority_transcode,
+            args=(raw_path, video_path),
+            name="transcode_" + Path(video_path).stem
+            )
+
+        transcode.start()
+
+        transcode.join()
+
+        if transcode.exitcode != 0:
+            print(f"{transcode.name} failed with exit code {transcode.exitcode}")
+
+        with _transcode_lock:
+            _transcode_queue.pop(0)
+
+
+def start_transcode(raw_path: Path, video_path: Path):
+    """
+    Queues a raw video to be transcoded to .mp4 in the background.
+
+    Only one recording is transcoded at a time, in its own process at a
+    lowered priority, so an H.264 encode that runs into the next plane's
+    recording doesn't compete with it for the CPU. The thread working
+    through the queue isn't a daemon, so every queued recording is
+    transcoded even if bruker_control exits first. Call wait_for_transcodes()
+    to wait on them.
+
+    Args:
+        raw_path:
+            Path of the raw video file
+        video_path:
+            Path of the .mp4 to write
+    """
+
+    global _transcoder
+
+    with _transcode_lock:
+
+        _transcode_queue.append((raw_path, video_path))
+
+        if _transcoder is None:
+
+            _transcoder = threading.Thread(target=_run_transcodes, name="transcoder")
+
+            _transcoder.start()
+
+
+def wait_for_transcodes():
+    """
+    Waits for every queued transcode to finish.
+    """
+
+    with _transcode_lock:
+
+        transcoder = _transcoder
+
+        num_waiting = len(_transcode_queue)
+
+    if transcoder is not None:
+
+        print(f"Waiting for {num_waiting} videos to finish transcoding...")
+
+        transcoder.join()
+
+
 def capture_recording(framerate: float, num_frames: int, current_plane: int, imaging_plane: str,
-                      project: str, subject_id: str) -> list:
+                      project: str, subject_id: str, display: bool = True,
+                      recording_mode: str = "encoded") -> list:
     """
     Capture frames generated by camera object, display them in recording mode,
     and write frames to .mp4 file.
 
     Takes values from init_camera_recording() to capture images delivered by
-    camera buffer, reshapes the image to appropriate height and width, displays
-    the image to an opencv window, and writes the image to a .mp4 file.
-    When the camera acquires the specified number of frames for an experiment,
-    the window closes, the camera object is destroyed, and the video is written
-    to disk.
+    camera buffer. A FrameFetcher thread only copies frames into a shared
+    memory FrameRing, an encoder process writes them to a .mp4 file, and this
+    thread shows the newest of them at DISPLAY_RATE. In raw mode, frames are
+    instead copied into a memory mapped RawVideo and transcoded to .mp4 after
+    the session, so nothing is lost to encoder hiccups. When the camera acquires the specified
+    number of frames for an experiment, the window closes, the camera object
+    is destroyed, and each stage's queue depth and lag are printed.
 
     Args:
         framerate:
@@ -368,6 +1470,11 @@ def capture_recording(framerate: float, num_frames: int, current_plane: int, ima
             The team and project conducting the experiment (ie teamname_projectname)
         subject_id:
             The subject being recorded
+        display:
+            Whether to show the recording while it's captured
+        recording_mode:
+            One of RECORDING_MODES. Raw recordings are transcoded in the
+            background, see wait_for_transcodes().
 
     Returns:
         dropped_frames
@@ -394,77 +1501,130 @@ def capture_recording(framerate: float, num_frames: int, current_plane: int, ima
     # Start the Camera
     h, camera, width, height = init_camera_recording()
 
-    # Use cv2 for writing frames to disc
-    
-    # Start the Camera
-    h, camera, width, height = init_camera_recording()
+    # Raw recordings need room for every frame up front
+    if recording_mode == "raw":
 
-    out = cv2.VideoWriter(
-        video_fullpath,
-        cv2.VideoWriter_fourcc(*"avc1"),
-        framerate,
-        (width, height),
-        isColor = False
-        )
+        raw_bytes = raw_video_bytes(num_frames, height, width)
 
-    dropped_frames = []
+        free_bytes = shutil.disk_usage(str(video_dir)).free
 
-    frame_number = 1
+        if free_bytes < raw_bytes * RAW_FREE_SPACE_MARGIN:
 
-    cv2.namedWindow("Live!")
-    cv2.moveWindow("Live!", IMSHOW_X_POS, IMSHOW_Y_POS)
+            print(
+                f"Raw recording needs {raw_bytes / 1e9:.1f} GB but only "
+                f"{free_bytes / 1e9:.1f} GB are free, encoding as it's captured instead"
+                )
 
-    # Experimental progress bar in term
-    for frame_number in tqdm(range(num_frames), desc="Experiment Progress", ascii=True):
+            recording_mode = "encoded"
 
-        # Introduce try/except block in case of dropped frames
-        try:
+    if recording_mode == "raw":
 
-            # Use with statement to acquire buffer, payload, an data
-            # Payload is 1D numpy array, RESHAPE WITH HEIGHT THEN WIDTH
-            # Numpy is backwards, reshaping as heightxwidth writes correctly
-            with camera.fetch() as buffer:
+        # Frames go straight into a file sized from calculate_frames(). It's
+        # transcoded to .mp4 once the session's over.
+        raw_path = video_dir / (session_name + ".raw")
 
-                # Define frame content with buffer.payload
-                content = buffer.payload.components[0].data.reshape(
-                    height,
-                    width
-                    )
+        frames = RawVideo(raw_path, height, width, num_frames, framerate)
 
-                # Resize image so it's not taking up the whole screen
-                # Define dimensions, width and height
-                imshow_width = int(width * SCALING_FACTOR / 100)
-                imshow_height = int(height * SCALING_FACTOR / 100)
+        encode_queue = None
 
-                imshow_dims = (imshow_width, imshow_height)
+    else:
 
-                # Write frame to disk
-                out.write(content)
+        # Frames are shared with the encoder through a ring sized to the camera.
+        # Only sequence numbers are queued, with room for the closing None.
+        frames = FrameRing(RING_FRAMES, height, width)
 
-                # Resize the image, interpolate to avoid distortion
-                resized = cv2.resize(content, imshow_dims, interpolation = cv2.INTER_AREA)
-    
-                cv2.imshow("Live!", resized)
-                c = cv2.waitKey(1)
+        # Start encoding before any frames arrive
+        encode_queue = multiprocessing.Queue(maxsize=RING_FRAMES + 1)
 
-                frame_number += 1
+        metrics_connection, encoder_connection = multiprocessing.Pipe(duplex=False)
 
-        # TODO Raise warning for frame drops? What is this error...
-        except Exception:
-            dropped_frames.append(frame_number)
-            frame_number += 1
+        encoder = multiprocessing.Process(
+            target=encode_frames,
+            args=(frames, encode_queue, video_fullpath, framerate, width, height, encoder_connection),
+            name="frame_encoder",
+            daemon=True
+            )
 
-            pass
+        encoder.start()
 
-    # Release VideoWriter object
-    out.release()
+    fetcher = FrameFetcher(camera, num_frames, frames, encode_queue)
+
+    if display:
+        live_display = LiveDisplay("Live!", frames)
+
+    fetcher.start()
+
+    # Experimental progress bar in term
+    with tqdm(total=num_frames, desc="Experiment Progress", ascii=True) as progress:
+
+        while fetcher.is_alive():
+
+            progress.update(fetcher.fetched - progress.n)
+
+            if not display:
+                fetcher.join(DISPLAY_TIMEOUT)
+                continue
+
+            live_display.wait()
+
+            live_display.update()
+
+        progress.update(fetcher.fetched - progress.n)
 
     # Destroy camera window
-    cv2.destroyAllWindows()
+    if display:
+        live_display.close()
 
     # Shutdown the camera
     shutdown_camera(camera, h)
 
+    if recording_mode == "raw":
+
+        num_recorded = len(frames)
+
+        frames.close()
+
+        # Queue a background transcode while the next plane or subject is set up
+        start_transcode(raw_path, Path(video_fullpath))
+
+    else:
+
+        # Tell the encoder there's nothing left to write, unless it's stopped
+        while encoder.is_alive():
+
+            try:
+                encode_queue.put(None, timeout=DISPLAY_TIMEOUT)
+                break
+
+            except queue.Full:
+                continue
+
+        # Wait for the rest of the video to be written
+        print("Writing remaining frames to disk...")
+
+        encoder.join()
+
+        if metrics_connection.poll():
+            fetcher.encode_metrics.merge(metrics_connection.recv())
+
+        else:
+            print(f"Video encoder stopped early with exit code {encoder.exitcode}")
+
+            # Frames left in the queue will never be read
+            encode_queue.cancel_join_thread()
+
+        num_recorded = fetcher.encode_metrics.frames
+
+    dropped_frames = fetcher.dropped_frames
+
+    print(f"Recorded {num_recorded} frames, {len(dropped_frames)} dropped")
+
+    if recording_mode == "encoded":
+        fetcher.encode_metrics.print_summary()
+
+    if display:
+        live_display.metrics.print_summary()
+
     return dropped_frames
 
 
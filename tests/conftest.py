@@ -0,0 +1,59 @@
+# Bruker Control Test Configuration
+# Lets the tests import the modules in main/ the same way bruker_control.py
+# does, and keeps them from touching the machine's caches.
+
+###############################################################################
+# Import Packages
+###############################################################################
+
+# Import os and sys for finding main/ and checking who's logged in
+import os
+import sys
+
+# Import pathlib for building paths to main/
+from pathlib import Path
+
+# Import pytest for fixtures
+import pytest
+
+###############################################################################
+# Setup
+###############################################################################
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "main"))
+
+# serialtransfer_utils asks the OS who's logged in when it's imported, which
+# fails without a terminal (like in CI). Stand in the way the docs build does.
+try:
+    os.getlogin()
+
+except OSError:
+    os.environ["READTHEDOCS"] = "True"
+
+
+###############################################################################
+# Fixtures
+###############################################################################
+
+
+@pytest.fixture(autouse=True)
+def baud_cache(tmp_path, monkeypatch):
+    """
+    Gives every test its own empty baud cache and board registry.
+
+    pty ports have no USB device, so the emulated board's rate is cached
+    under its port.
+
+    Returns:
+        Path of the test's baud cache
+    """
+
+    import serialtransfer_utils
+
+    monkeypatch.setattr(serialtransfer_utils, "CACHE_PATH", tmp_path)
+
+    monkeypatch.setattr(serialtransfer_utils, "BAUD_CACHE", tmp_path / "baud_rates.json")
+
+    monkeypatch.setattr(serialtransfer_utils, "BOARD_REGISTRY", tmp_path / "boards.json")
+
+    return serialtransfer_utils.BAUD_CACHE
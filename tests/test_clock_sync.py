@@ -0,0 +1,230 @@
+# Clock Sync Tests
+# Checks that ClockSync recovers the Arduino clock's offset and drift from its
+# probes and that arduino_to_host() places timestamps with them, across
+# micros() wrapping past 32 bits.
+
+###############################################################################
+# Import Packages
+###############################################################################
+
+# Import struct for packing probe answers
+import struct
+
+# Import time for spacing probes apart
+import time
+
+# Import numpy for building the probes
+import numpy as np
+
+# Import the clock model under test
+import serialtransfer_utils
+
+###############################################################################
+# Setup
+###############################################################################
+
+# Host time of the first probe
+HOST_START_S = 1000.0
+
+# How much slower than the host the synthetic Arduino's clock runs
+DRIFT_PPM = 50.0
+
+
+###############################################################################
+# Classes
+###############################################################################
+
+
+class ProbeLink:
+    """
+    Stands in for the link, answering probes with chosen micros() values.
+
+    Attributes:
+        rxBuff:
+            Receive buffer holding the answer to the last probe
+        seq:
+            Sequence number of the last probe sent
+    """
+
+    def __init__(self):
+        """
+        Creates the link with nothing received.
+        """
+
+        self.rxBuff = []
+
+        self.seq = None
+
+    def send_payload(self, payload: bytes, packet_id: int = 0):
+        """
+        Takes a probe's sequence number instead of sending it.
+
+        Args:
+            payload:
+                Probe payload
+            packet_id:
+                ID of the packet
+        """
+
+        self.seq = struct.unpack("<H", payload)[0]
+
+    def answer(self, micros: int):
+        """
+        Puts the Arduino's answer to the last probe in the receive buffer.
+
+        Args:
+            micros:
+                Arduino's micros(), wrapped to 32 bits like the board does
+        """
+
+        self.rxBuff = list(
+            serialtransfer_utils.CLOCK_SYNC_STRUCT.pack(self.seq, micros % 2**32)
+            )
+
+
+###############################################################################
+# Functions
+###############################################################################
+
+
+def synthetic_clock_sync(ref_micros: int, span_s: float,
+                         num_probes: int = 50, seed: int = 0) -> serialtransfer_utils.ClockSync:
+    """
+    Builds a ClockSync from probes of an Arduino drifting by DRIFT_PPM.
+
+    Args:
+        ref_micros:
+            Arduino's micros() at the first probe, unwrapped
+        span_s:
+            Seconds between the first and last probe
+        num_probes:
+            Number of probes
+        seed:
+            Seed for the probes' jitter
+
+    Returns:
+        ClockSync holding the probes
+    """
+
+    rng = np.random.default_rng(seed)
+
+    host_s = HOST_START_S + np.linspace(0, span_s, num_probes)
+
+    arduino_s = (host_s - HOST_START_S) / (1 + DRIFT_PPM / 1e6)
+
+    clock_sync = serialtransfer_utils.ClockSync()
+
+    clock_sync.host_s = list(host_s + rng.normal(0, 20e-6, num_probes))
+
+    clock_sync.arduino_micros = [int(ref_micros + round(value * 1e6)) for value in arduino_s]
+
+    clock_sync.rtt_s = list(rng.uniform(1e-3, 2e-3, num_probes))
+
+    return clock_sync
+
+
+###############################################################################
+# Tests
+###############################################################################
+
+
+def test_fit_recovers_offset_and_drift():
+
+    clock_model = synthetic_clock_sync(ref_micros=123456789, span_s=60).fit()
+
+    assert clock_model["ref_micros"] == 123456789
+
+    assert abs(clock_model["ref_host_s"] - HOST_START_S) < 50e-6
+
+    assert abs(clock_model["drift_ppm"] - DRIFT_PPM) < 2
+
+
+def test_fit_downweights_slow_outliers():
+
+    clock_sync = synthetic_clock_sync(ref_micros=0, span_s=60)
+
+    # A probe answered late lands its midpoint far from the truth
+    clock_sync.host_s[10] += 0.01
+
+    clock_sync.rtt_s[10] = 0.02
+
+    clock_model = clock_sync.fit()
+
+    assert abs(clock_model["ref_host_s"] - HOST_START_S) < 50e-6
+
+    assert abs(clock_model["drift_ppm"] - DRIFT_PPM) < 2
+
+
+def test_fit_only_fits_offset_over_short_spans():
+
+    span_s = serialtransfer_utils.CLOCK_SYNC_MIN_SPAN / 2
+
+    clock_model = synthetic_clock_sync(ref_micros=0, span_s=span_s).fit()
+
+    assert clock_model["drift_ppm"] == 0.0
+
+    assert serialtransfer_utils.ClockSync().fit() is None
+
+
+def test_arduino_to_host_across_micros_wrap():
+
+    # The board's clock wraps 5 s after the first probe
+    ref_micros = 2**32 - 5000000
+
+    clock_model = synthetic_clock_sync(ref_micros=ref_micros, span_s=60).fit()
+
+    arduino_s = np.arange(1, 40, dtype=float)
+
+    micros = (ref_micros + np.round(arduino_s * 1e6).astype(np.int64)) % 2**32
+
+    host_s = serialtransfer_utils.arduino_to_host(micros.astype(np.uint32), clock_model)
+
+    expected_s = HOST_START_S + arduino_s * (1 + DRIFT_PPM / 1e6)
+
+    assert np.max(np.abs(host_s - expected_s)) < 100e-6
+
+
+def test_reply_unwraps_micros_across_wrap():
+
+    link = ProbeLink()
+
+    clock_sync = serialtransfer_utils.ClockSync()
+
+    clock_sync.probe(link)
+
+    link.answer(2**32 - 1000)
+
+    assert clock_sync.reply(link)
+
+    time.sleep(0.01)
+
+    clock_sync.probe(link)
+
+    link.answer(2**32 - 1000 + 10000)
+
+    assert clock_sync.reply(link)
+
+    assert clock_sync.arduino_micros[-1] > 2**32
+
+
+def test_reply_drops_answers_after_reset():
+
+    link = ProbeLink()
+
+    clock_sync = serialtransfer_utils.ClockSync()
+
+    # Ten minutes into the session
+    clock_sync.probe(link)
+
+    link.answer(600000000)
+
+    assert clock_sync.reply(link)
+
+    # An answer from a board that reset and started its clock over
+    clock_sync.probe(link)
+
+    link.answer(1234)
+
+    assert not clock_sync.reply(link)
+
+    assert len(clock_sync.host_s) == 1
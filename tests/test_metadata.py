@@ -0,0 +1,93 @@
+# Metadata Packet Tests
+# Checks that METADATA_SCHEMA packs and unpacks the metadata packet losslessly
+# and still matches the metadata_struct the sketches were built with.
+
+###############################################################################
+# Import Packages
+###############################################################################
+
+# Import pathlib for finding the sketches
+from pathlib import Path
+
+# Import pytest for marks and checking errors
+import pytest
+
+# Import the metadata packet functions under test
+import serialtransfer_utils
+
+###############################################################################
+# Setup
+###############################################################################
+
+SKETCH_PATHS = [
+    Path(__file__).parent.parent / "bruker_disc_specialk" / "bruker_disc_specialk.ino",
+    Path(__file__).parent.parent / "bruker_disc_deryn" / "bruker_disc_deryn.ino",
+]
+
+
+###############################################################################
+# Functions
+###############################################################################
+
+
+def example_metadata() -> dict:
+    """
+    Builds metadata with a different value in every field of the schema.
+
+    Returns:
+        arduino_metadata
+    """
+
+    arduino_metadata = {
+        name: 1000 + idx for idx, (name, _, _) in enumerate(serialtransfer_utils.METADATA_SCHEMA)
+        }
+
+    # Past 255 to catch a field packed narrower than the sketches read it
+    arduino_metadata["totalNumberOfTrials"] = 600
+
+    arduino_metadata["lickContingency"] = True
+
+    return arduino_metadata
+
+
+###############################################################################
+# Tests
+###############################################################################
+
+
+def test_metadata_round_trip():
+
+    arduino_metadata = example_metadata()
+
+    metadata_payload = serialtransfer_utils.encode_metadata(arduino_metadata)
+
+    assert len(metadata_payload) == serialtransfer_utils.METADATA_STRUCT.size
+
+    assert serialtransfer_utils.decode_metadata(metadata_payload) == arduino_metadata
+
+
+def test_decode_rejects_wrong_size_metadata():
+
+    metadata_payload = serialtransfer_utils.encode_metadata(example_metadata())
+
+    with pytest.raises(serialtransfer_utils.TransferError):
+        serialtransfer_utils.decode_metadata(metadata_payload[:-1])
+
+
+def test_metadata_error_check_names_mismatched_fields():
+
+    arduino_metadata = example_metadata()
+
+    received_metadata = dict(arduino_metadata, rewardTone=0)
+
+    serialtransfer_utils.metadata_error_check(arduino_metadata, arduino_metadata)
+
+    with pytest.raises(serialtransfer_utils.TransferError, match="rewardTone"):
+        serialtransfer_utils.metadata_error_check(arduino_metadata, received_metadata)
+
+
+@pytest.mark.parametrize("sketch_path", SKETCH_PATHS, ids=lambda path: path.stem)
+def test_sketch_metadata_struct_matches_schema(sketch_path):
+
+    # The struct is pasted from metadata_c_struct(), so it should be there as is
+    assert serialtransfer_utils.metadata_c_struct() in sketch_path.read_text()
@@ -0,0 +1,664 @@
+# Serial Transfer Tests
+# Sends sessions to an emulated board over a pty, the same way transfer_data
+# talks to the real ones, and checks the board ends up with what was sent.
+
+###############################################################################
+# Import Packages
+###############################################################################
+
+# Import sys for checking the platform has ptys
+import sys
+
+# Import time for waiting on the emulated board
+import time
+
+# Import Counter for counting packets on the wire
+from collections import Counter
+
+# Import Optional for type hinting
+from typing import Optional
+
+# Import numpy for building the session's arrays
+import numpy as np
+
+# Import pytest for fixtures and marks
+import pytest
+
+# Import the emulated board and the transfer functions under test
+import arduino_emulator
+import serialtransfer_utils
+
+###############################################################################
+# Setup
+###############################################################################
+
+# The emulated board lives on one end of a pty pair
+pytestmark = pytest.mark.skipif(
+    not sys.platform.startswith("linux"),
+    reason="the emulated board needs a pty"
+    )
+
+# Rate cached for the emulated board unless a test says otherwise
+FASTEST_BAUD = serialtransfer_utils.CANDIDATE_BAUDS[-1]
+
+
+###############################################################################
+# Fixtures
+###############################################################################
+
+
+@pytest.fixture
+def make_emulator():
+    """
+    Starts emulated boards and stops them once the test is over.
+
+    Returns:
+        Function taking the baud rate to cache for the board, None to leave
+        it uncached, and ArduinoEmulator settings, and returning a running
+        emulator
+    """
+
+    emulators = []
+
+    def start_emulator(cached_baud: Optional[int] = FASTEST_BAUD, **emulator_kwargs):
+
+        emulator = arduino_emulator.ArduinoEmulator(**emulator_kwargs)
+
+        emulator.start()
+
+        emulators.append(emulator)
+
+        # Sessions skip negotiating a rate that's already cached
+        if cached_baud is not None:
+            serialtransfer_utils.write_baud_cache({emulator.port: cached_baud})
+
+        return emulator
+
+    yield start_emulator
+
+    for emulator in emulators:
+        emulator.stop()
+
+
+###############################################################################
+# Functions
+###############################################################################
+
+
+def session_data(num_trials: int, seed: int = 0) -> tuple:
+    """
+    Builds metadata and arrays for a session like trial_utils does.
+
+    Args:
+        num_trials:
+            Number of trials in the session
+        seed:
+            Seed for the trial values
+
+    Returns:
+        arduino_metadata, experiment_arrays
+    """
+
+    rng = np.random.default_rng(seed)
+
+    arduino_metadata = {
+        name: 0 for name, _, _ in serialtransfer_utils.METADATA_SCHEMA
+        }
+
+    arduino_metadata["totalNumberOfTrials"] = num_trials
+
+    experiment_arrays = [
+        rng.integers(0, 2, num_trials).tolist(),
+        rng.integers(15000, 25000, num_trials).tolist(),
+        rng.integers(2000, 3000, num_trials).tolist(),
+        rng.integers(0, 2, num_trials).tolist(),
+        ]
+
+    return arduino_metadata, experiment_arrays
+
+
+def board_has_arrays(emulator: arduino_emulator.ArduinoEmulator,
+                     experiment_arrays: list) -> bool:
+    """
+    Checks that the emulated board started a session with the arrays sent.
+
+    Args:
+        emulator:
+            Emulated board the session was sent to
+        experiment_arrays:
+            Arrays that were sent
+
+    Returns:
+        Whether the board is running with exactly those arrays
+    """
+
+    return emulator.running_session and all(
+        emulator.array_values(array_idx) == list(array)
+        for array_idx, array in enumerate(experiment_arrays)
+        )
+
+
+def wait_for_trials(emulator: arduino_emulator.ArduinoEmulator,
+                    experiment_arrays: list) -> list:
+    """
+    Waits for the emulated board to play every streamed trial.
+
+    Args:
+        emulator:
+            Emulated board playing the session
+        experiment_arrays:
+            Arrays that were streamed
+
+    Returns:
+        Trials the board played
+    """
+
+    num_trials = len(experiment_arrays[0])
+
+    deadline = time.perf_counter() + 2 * num_trials * emulator.trial_s + 10
+
+    while len(emulator.played_trials) < num_trials and time.perf_counter() < deadline:
+        time.sleep(0.01)
+
+    return emulator.played_trials
+
+
+def corrupt_packets(write, targets: set):
+    """
+    Wraps a connection's write to damage chosen packets on their way out.
+
+    pySerialTransfer writes each packet in one call, so the packet ID is
+    always the second byte written and the payload starts at the fifth.
+
+    Args:
+        write:
+            Write method of the connection
+        targets:
+            Set of (packet ID, occurrence) for the packets to damage, counting
+            occurrences of each ID from 0
+
+    Returns:
+        Write function that flips the first payload byte of the targets
+    """
+
+    sent = Counter()
+
+    def corrupting_write(data):
+
+        data = bytearray(data)
+
+        packet_id = data[1]
+
+        if (packet_id, sent[packet_id]) in targets:
+            data[4] ^= 0xFF
+
+        sent[packet_id] += 1
+
+        return write(bytes(data))
+
+    return corrupting_write
+
+
+def upload_with_errors(emulator: arduino_emulator.ArduinoEmulator,
+                       arduino_metadata: dict, experiment_arrays: list,
+                       transfer_mode: str, host_targets: set = frozenset(),
+                       board_targets: set = frozenset()):
+    """
+    Sends a session while damaging chosen packets in either direction.
+
+    Args:
+        emulator:
+            Emulated board to send the session to
+        arduino_metadata:
+            Metadata for the session
+        experiment_arrays:
+            Arrays for the session
+        transfer_mode:
+            Either "windowed", "onepacket" or "streaming"
+        host_targets:
+            (packet ID, occurrence) of the packets Python sends to damage
+        board_targets:
+            (packet ID, occurrence) of the replies the board sends to damage
+
+    Returns:
+        session_upload, telemetry_reader
+    """
+
+    session = serialtransfer_utils.SerialSession(emulator.port)
+
+    # Open the link at its cached rate before anything is damaged
+    link = session.acquire()
+
+    session.release()
+
+    link.connection.write = corrupt_packets(link.connection.write, host_targets)
+
+    emulator.wire.write = corrupt_packets(emulator.wire.write, board_targets)
+
+    session_upload = serialtransfer_utils.SessionUpload(
+        arduino_metadata,
+        experiment_arrays,
+        transfer_mode,
+        session=session
+        )
+
+    telemetry_reader = session_upload.transfer()
+
+    if telemetry_reader is None:
+        session.close()
+
+    return session_upload, telemetry_reader
+
+
+def retries(session_upload: serialtransfer_utils.SessionUpload, packet_id: int) -> int:
+    """
+    Counts how many times packets with an ID were resent.
+
+    Args:
+        session_upload:
+            Upload the packets were sent by
+        packet_id:
+            ID of the packets
+
+    Returns:
+        Number of resends
+    """
+
+    rows = session_upload.packet_log.rows()
+
+    return int(rows["retries"][rows["packet_id"] == packet_id].sum())
+
+
+###############################################################################
+# Transfer Tests
+###############################################################################
+
+
+def test_onepacket_transfer(make_emulator):
+
+    emulator = make_emulator()
+
+    arduino_metadata, experiment_arrays = session_data(40)
+
+    serialtransfer_utils.transfer_data(
+        arduino_metadata,
+        experiment_arrays,
+        transfer_mode="onepacket",
+        port=emulator.port
+        )
+
+    assert board_has_arrays(emulator, experiment_arrays)
+
+
+def test_long_onepacket_transfer_is_sent_windowed(make_emulator):
+
+    emulator = make_emulator()
+
+    arduino_metadata, experiment_arrays = session_data(
+        serialtransfer_utils.ONEPACKET_MAX_TRIALS + 40
+        )
+
+    serialtransfer_utils.transfer_data(
+        arduino_metadata,
+        experiment_arrays,
+        transfer_mode="onepacket",
+        port=emulator.port
+        )
+
+    assert board_has_arrays(emulator, experiment_arrays)
+
+
+def test_windowed_transfer(make_emulator):
+
+    emulator = make_emulator()
+
+    arduino_metadata, experiment_arrays = session_data(150)
+
+    serialtransfer_utils.transfer_data(
+        arduino_metadata,
+        experiment_arrays,
+        transfer_mode="windowed",
+        port=emulator.port
+        )
+
+    assert board_has_arrays(emulator, experiment_arrays)
+
+
+def test_streaming_transfer(make_emulator):
+
+    emulator = make_emulator(trial_s=0.005)
+
+    arduino_metadata, experiment_arrays = session_data(60)
+
+    telemetry_reader = serialtransfer_utils.transfer_data(
+        arduino_metadata,
+        experiment_arrays,
+        transfer_mode="streaming",
+        port=emulator.port
+        )
+
+    played_trials = wait_for_trials(emulator, experiment_arrays)
+
+    telemetry_reader.stop()
+
+    assert played_trials == list(serialtransfer_utils.stream_trials(experiment_arrays))
+
+
+def test_transfer_rejects_arrays_too_big_for_board(make_emulator):
+
+    emulator = make_emulator(pool_bytes=64)
+
+    arduino_metadata, experiment_arrays = session_data(40)
+
+    with pytest.raises(serialtransfer_utils.TransferError):
+        serialtransfer_utils.transfer_data(
+            arduino_metadata,
+            experiment_arrays,
+            transfer_mode="windowed",
+            port=emulator.port
+            )
+
+    assert not emulator.running_session
+
+
+###############################################################################
+# Resend Tests
+###############################################################################
+
+
+def test_onepacket_resends_damaged_array(make_emulator):
+
+    emulator = make_emulator()
+
+    arduino_metadata, experiment_arrays = session_data(40)
+
+    session_upload, _ = upload_with_errors(
+        emulator,
+        arduino_metadata,
+        experiment_arrays,
+        "onepacket",
+        host_targets={(2, 0)}
+        )
+
+    assert retries(session_upload, 2) >= 1
+
+    assert board_has_arrays(emulator, experiment_arrays)
+
+
+def test_onepacket_resends_array_with_lost_reply(make_emulator):
+
+    emulator = make_emulator()
+
+    arduino_metadata, experiment_arrays = session_data(40)
+
+    # Replies on ID 0 are the metadata echo, then each array's CRC. The board
+    # has already stored the second array when its reply is lost, so the
+    # resend must replace it in the session digest rather than add to it.
+    session_upload, _ = upload_with_errors(
+        emulator,
+        arduino_metadata,
+        experiment_arrays,
+        "onepacket",
+        board_targets={(serialtransfer_utils.METADATA_PACKET_ID, 2)}
+        )
+
+    assert retries(session_upload, 2) >= 1
+
+    assert board_has_arrays(emulator, experiment_arrays)
+
+
+def test_windowed_resends_damaged_chunk(make_emulator):
+
+    emulator = make_emulator()
+
+    arduino_metadata, experiment_arrays = session_data(150)
+
+    session_upload, _ = upload_with_errors(
+        emulator,
+        arduino_metadata,
+        experiment_arrays,
+        "windowed",
+        host_targets={(serialtransfer_utils.CHUNK_PACKET_ID, 3)}
+        )
+
+    assert retries(session_upload, serialtransfer_utils.CHUNK_PACKET_ID) >= 1
+
+    assert board_has_arrays(emulator, experiment_arrays)
+
+
+def test_windowed_survives_damaged_acks(make_emulator):
+
+    emulator = make_emulator()
+
+    arduino_metadata, experiment_arrays = session_data(150)
+
+    upload_with_errors(
+        emulator,
+        arduino_metadata,
+        experiment_arrays,
+        "windowed",
+        board_targets={
+            (serialtransfer_utils.CHUNK_ACK_PACKET_ID, 2),
+            (serialtransfer_utils.CHUNK_ACK_PACKET_ID, 3),
+            (serialtransfer_utils.CHUNK_ACK_PACKET_ID, 4),
+            (serialtransfer_utils.CHUNK_ACK_PACKET_ID, 5),
+            }
+        )
+
+    assert board_has_arrays(emulator, experiment_arrays)
+
+
+@pytest.mark.parametrize("transfer_mode", ["windowed", "streaming"])
+def test_session_starts_when_status_reply_is_lost(make_emulator, transfer_mode):
+
+    emulator = make_emulator(trial_s=0.005)
+
+    arduino_metadata, experiment_arrays = session_data(60)
+
+    # Windowed and streamed sessions only reply on ID 0 to the metadata and
+    # then the status. The board has started by the time its reply is lost,
+    # so it has to confirm the resent status while running.
+    session_upload, telemetry_reader = upload_with_errors(
+        emulator,
+        arduino_metadata,
+        experiment_arrays,
+        transfer_mode,
+        board_targets={(serialtransfer_utils.METADATA_PACKET_ID, 1)}
+        )
+
+    if telemetry_reader is not None:
+        wait_for_trials(emulator, experiment_arrays)
+        telemetry_reader.stop()
+
+    assert retries(session_upload, serialtransfer_utils.PYTHON_STATUS_PACKET_ID) >= 1
+
+    assert emulator.running_session
+
+
+def test_streaming_resends_damaged_trial_blocks(make_emulator):
+
+    emulator = make_emulator(trial_s=0.005)
+
+    arduino_metadata, experiment_arrays = session_data(60)
+
+    # Damage a block on its way to the board and the echo of another
+    session_upload, telemetry_reader = upload_with_errors(
+        emulator,
+        arduino_metadata,
+        experiment_arrays,
+        "streaming",
+        host_targets={(serialtransfer_utils.TRIAL_BLOCK_PACKET_ID, 0)},
+        board_targets={(serialtransfer_utils.TRIAL_BLOCK_PACKET_ID, 0)}
+        )
+
+    played_trials = wait_for_trials(emulator, experiment_arrays)
+
+    telemetry_reader.stop()
+
+    assert retries(session_upload, serialtransfer_utils.TRIAL_BLOCK_PACKET_ID) >= 1
+
+    assert played_trials == list(serialtransfer_utils.stream_trials(experiment_arrays))
+
+
+###############################################################################
+# Baud Rate Tests
+###############################################################################
+
+
+def test_negotiates_fastest_reliable_baud(make_emulator):
+
+    emulator = make_emulator(cached_baud=None, max_baud=500000)
+
+    session = serialtransfer_utils.SerialSession(emulator.port)
+
+    link = session.acquire()
+
+    session.release()
+
+    session.close()
+
+    assert link.connection.baudrate == 500000
+
+    assert serialtransfer_utils.read_baud_cache() == {emulator.port: 500000}
+
+
+def test_negotiation_retries_a_noisy_baud(make_emulator, monkeypatch):
+
+    emulator = make_emulator(cached_baud=None)
+
+    loopback_test = serialtransfer_utils.loopback_test
+
+    noisy_bauds = [1000000]
+
+    # Report errors the first time 1000000 is tried, like a burst of noise
+    def noisy_loopback_test(link, *args, **kwargs):
+
+        result = loopback_test(link, *args, **kwargs)
+
+        if link.connection.baudrate in noisy_bauds:
+            noisy_bauds.remove(link.connection.baudrate)
+            result["error_rate"] = 0.1
+
+        return result
+
+    monkeypatch.setattr(serialtransfer_utils, "loopback_test", noisy_loopback_test)
+
+    link = serialtransfer_utils.InstrumentedTransfer(
+        emulator.port,
+        serialtransfer_utils.BASE_BAUD,
+        restrict_ports=False
+        )
+
+    link.open()
+
+    baud = serialtransfer_utils.negotiate_baud(link)
+
+    link.close()
+
+    assert baud == FASTEST_BAUD
+
+
+def test_baud_cache_key_is_the_linked_board(baud_cache, monkeypatch):
+
+    converter_key = "0403:6001:A10KXYZ"
+
+    serialtransfer_utils.write_board_registry({
+        "2341:0042:8503631303635": {"name": "Arduino Mega", "link": converter_key},
+        })
+
+    monkeypatch.setattr(
+        serialtransfer_utils,
+        "port_key",
+        lambda port: converter_key if port == "COM12" else None
+        )
+
+    assert serialtransfer_utils.baud_cache_key("COM12") == "2341:0042:8503631303635"
+
+    # Converters without a registered board, then ports without a USB device
+    serialtransfer_utils.write_board_registry({})
+
+    assert serialtransfer_utils.baud_cache_key("COM12") == converter_key
+
+    assert serialtransfer_utils.baud_cache_key("/dev/pts/3") == "/dev/pts/3"
+
+
+def test_uses_cached_baud(make_emulator, capsys):
+
+    emulator = make_emulator(cached_baud=1000000)
+
+    session = serialtransfer_utils.SerialSession(emulator.port)
+
+    link = session.acquire()
+
+    session.release()
+
+    session.close()
+
+    assert link.connection.baudrate == 1000000
+
+    assert "Negotiating" not in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("forget_failed", [True, False])
+def test_failed_cached_baud(make_emulator, forget_failed):
+
+    emulator = make_emulator(cached_baud=2000000, max_baud=500000)
+
+    link = serialtransfer_utils.InstrumentedTransfer(
+        emulator.port,
+        serialtransfer_utils.BASE_BAUD,
+        restrict_ports=False
+        )
+
+    link.open()
+
+    serialtransfer_utils.use_negotiated_baud(link, forget_failed)
+
+    link.close()
+
+    # The link is left at BASE_BAUD, where the board falls back to
+    assert link.connection.baudrate == serialtransfer_utils.BASE_BAUD
+
+    if forget_failed:
+        assert serialtransfer_utils.read_baud_cache() == {}
+
+    else:
+        assert serialtransfer_utils.read_baud_cache() == {emulator.port: 2000000}
+
+
+def test_keepalive_holds_baud_between_sessions(make_emulator):
+
+    emulator = make_emulator()
+
+    session = serialtransfer_utils.SerialSession(emulator.port)
+
+    # Open the link so the keepalive is running while the session sits idle
+    session.acquire()
+
+    session.release()
+
+    for seed in range(2):
+
+        arduino_metadata, experiment_arrays = session_data(40, seed)
+
+        # Sit idle for longer than the board waits before falling back
+        time.sleep(serialtransfer_utils.BAUD_FALLBACK * 1.5)
+
+        serialtransfer_utils.transfer_data(
+            arduino_metadata,
+            experiment_arrays,
+            transfer_mode="windowed",
+            session=session
+            )
+
+        assert board_has_arrays(emulator, experiment_arrays)
+
+        emulator.end_session()
+
+    session.close()
+
+    assert session.reconnects == 0
+
+    assert session.link.connection.baudrate == FASTEST_BAUD
+
+    assert serialtransfer_utils.read_baud_cache() == {emulator.port: FASTEST_BAUD}
@@ -0,0 +1,110 @@
+# Sync Index Tests
+# Builds the sync index of a small synthetic session and checks where its
+# events, trials and video frames land on the T-Series' timeline.
+
+###############################################################################
+# Import Packages
+###############################################################################
+
+# Import numpy for building the session's streams
+import numpy as np
+
+# Import the sync index functions under test
+import serialtransfer_utils
+import sync_utils
+
+###############################################################################
+# Setup
+###############################################################################
+
+# 2P frames arrive every 100 ms from the trigger on
+TSERIES_TIMES = np.arange(100) * 0.1
+
+
+###############################################################################
+# Functions
+###############################################################################
+
+
+def telemetry_events(events: list) -> np.ndarray:
+    """
+    Builds a telemetry log from (event name, trial, micros) tuples.
+
+    Args:
+        events:
+            Events in the order they happened
+
+    Returns:
+        Array of serialtransfer_utils.TELEMETRY_DTYPE events
+    """
+
+    return np.array(
+        [(sync_utils.EVENT_CODES[name], trial, micros, 0, 0.0) for name, trial, micros in events],
+        dtype=serialtransfer_utils.TELEMETRY_DTYPE
+        )
+
+
+###############################################################################
+# Tests
+###############################################################################
+
+
+def test_camera_frame_triggers_skip_dropped_frames():
+
+    triggers = sync_utils.camera_frame_triggers(5, [1, 3])
+
+    assert triggers.tolist() == [0, 2, 4, 5, 6]
+
+
+def test_build_sync_index():
+
+    events = telemetry_events([
+        ("lick", 0, 900000),
+        ("bruker_trigger", 0, 1000000),
+        ("trial_start", 0, 1500000),
+        ("trial_start", 1, 3000000),
+        ])
+
+    # The third trial never started
+    experiment_arrays = [[0, 1, 0], [15000, 16000, 17000], [2000, 2000, 2000], [0, 0, 0]]
+
+    sync_index = sync_utils.build_sync_index(
+        events,
+        TSERIES_TIMES,
+        num_video_frames=100,
+        dropped_frames=[2],
+        experiment_arrays=experiment_arrays
+        )
+
+    # Events are timed from the trigger, the lick came before the first frame
+    np.testing.assert_allclose(sync_index["event_s"], [-0.1, 0.0, 0.5, 2.0])
+
+    assert sync_index["event_tseries_frame"].tolist() == [
+        sync_utils.BEFORE_FIRST_FRAME, 0, 5, 20
+        ]
+
+    np.testing.assert_allclose(sync_index["trial_start_s"], [0.5, 2.0, np.nan])
+
+    assert sync_index["trial_tseries_frame"].tolist() == [5, 20, sync_utils.BEFORE_FIRST_FRAME]
+
+    # Video frames follow their triggers, skipping the dropped one
+    assert sync_index["camera_tseries_frame"][:4].tolist() == [0, 1, 3, 4]
+
+    np.testing.assert_allclose(sync_index["camera_frame_s"][:4], [0.0, 0.1, 0.3, 0.4])
+
+    # The last video frame was triggered after the last 2P frame
+    assert np.isnan(sync_index["camera_frame_s"][-1])
+
+    assert sync_index["trial_camera_frame"].tolist() == [4, 19, sync_utils.BEFORE_FIRST_FRAME]
+
+    assert sync_index["trialArray"].tolist() == experiment_arrays[0]
+
+
+def test_events_line_up_on_first_trial_without_trigger():
+
+    events = telemetry_events([
+        ("trial_start", 0, 2000000),
+        ("lick", 0, 2250000),
+        ])
+
+    np.testing.assert_allclose(sync_utils.events_to_tseries(events), [0.0, 0.25])
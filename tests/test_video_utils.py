@@ -0,0 +1,113 @@
+# Video Utils Tests
+# Checks the shared memory frame ring's overrun detection and the preview's
+# precomputed grid without a camera attached.
+
+###############################################################################
+# Import Packages
+###############################################################################
+
+# Import numpy for building frames
+import numpy as np
+
+# Import the frame ring and grid under test
+import video_utils
+
+###############################################################################
+# Setup
+###############################################################################
+
+# Small frames keep the ring's shared memory tiny
+HEIGHT = 2
+WIDTH = 3
+
+
+###############################################################################
+# Functions
+###############################################################################
+
+
+def frame(value: int) -> np.ndarray:
+    """
+    Builds a 1D frame payload like a Harvester buffer's.
+
+    Args:
+        value:
+            Value of every pixel
+
+    Returns:
+        Frame payload
+    """
+
+    return np.full(HEIGHT * WIDTH, value, dtype=np.uint8)
+
+
+###############################################################################
+# Tests
+###############################################################################
+
+
+def test_frame_ring_detects_overwritten_frames():
+
+    ring = video_utils.FrameRing(4, HEIGHT, WIDTH, held=False)
+
+    for frame_number in range(6):
+        ring.write(frame_number, frame(frame_number))
+
+    # The first two frames were overwritten by the last two
+    assert ring.read(0) is None
+    assert ring.read(1) is None
+
+    frame_number, _, data = ring.read(2)
+
+    assert frame_number == 2
+
+    assert (data == 2).all()
+
+    # A reader that falls behind sees its frame overwritten underneath it
+    assert ring.valid(2)
+
+    ring.write(6, frame(6))
+
+    assert not ring.valid(2)
+
+    assert ring.latest() == 6
+
+
+def test_held_frame_ring_waits_for_encoder():
+
+    ring = video_utils.FrameRing(4, HEIGHT, WIDTH)
+
+    for frame_number in range(4):
+        ring.write(frame_number, frame(frame_number))
+
+    assert ring.full()
+
+    assert ring.pending() == 4
+
+    # Releasing a frame frees its slot and every slot before it
+    ring.release(1)
+
+    assert not ring.full()
+
+    assert ring.pending() == 2
+
+
+def test_grid_mask_lines():
+
+    height, width, rows, cols = 80, 120, 8, 6
+
+    mask = video_utils.grid_mask(height, width, rows, cols)
+
+    assert mask.shape == (height, width)
+
+    line_cols = np.flatnonzero((mask == 255).all(axis=0))
+    line_rows = np.flatnonzero((mask == 255).all(axis=1))
+
+    # Evenly spaced lines between the edges, none on them
+    assert line_cols.tolist() == [20, 40, 60, 80, 100]
+    assert line_rows.tolist() == [10, 20, 30, 40, 50, 60, 70]
+
+    # Everything off the lines is left alone
+    assert mask.sum() == 255 * (
+        len(line_cols) * height + len(line_rows) * width - len(line_cols) * len(line_rows)
+        )